@@ -8,12 +8,13 @@ This file contains classes to perform analysis of the data generated by msfr.py
 
 import math
 import numpy as np
-import matplotlib.pyplot as plt
 import sys
 import os
 
-import serpentTools
-serpentTools.settings.rc['verbosity'] = 'error'
+from lazyimport import LazyModule
+plt = LazyModule('matplotlib.pyplot')       # Imported on the first plot
+serpentTools = LazyModule('serpentTools',
+    lambda st: st.settings.rc.__setitem__('verbosity', 'error'))
 
 class Resistivity(object):
     '''Class relating to resistivity calcualtions [miloOhm cm]
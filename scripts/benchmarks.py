@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Benchmark suite of the hot paths in salt handling, deck generation, and output analysis.
+Runs offline, Serpent is not needed: the analyzers read synthetic _dep.m and _res.m files.
+Each case reports wall time and peak Python memory (tracemalloc), results can be saved
+as JSON to compare runs for regressions.
+
+# Example usage:
+$ ./benchmarks.py                               # all cases, table on stdout
+$ ./benchmarks.py -o bench.json --nuclides 3000 --steps 20
+$ ./benchmarks.py --cases salt_ deck_           # cases whose names start with these
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+import molmass
+from salts import Salt, get_salt, salt_cache, salt_grid
+
+# Import time budget [s] of the modules that deck generation jobs start with
+IMPORT_TIME_BUDGET = {'salts': 0.5, 'msfr': 0.5}
+
+# Full 40-year depletion decks that have to render per minute
+DECK_RATE_TARGET = 10000
+
+BENCH_SALTS = [("66.66%NaCl+33.34%UCl3", 0.1975), ("72%LiF + 16%BeF2 + 12%UF4", 0.02)]
+
+
+# ------------------------------------------------------------------------------
+# Synthetic Serpent output
+
+def synthetic_zais(n_nuclides:int) -> list:
+    '''Returns n_nuclides ZAIs ordered like a Serpent inventory: nuclides with
+    cross sections by increasing ZAI, then the rest, again from low ZAI. Always has Ag, Pd, Cd, Pt.'''
+    zais = [471070, 471090, 461050, 461060, 461080, 481100, 481130, 781950, 922350, 922380]
+    Z, A = 1, 1
+    while len(zais) < n_nuclides:
+        for I in (0, 1):
+            zai = Z*10000 + A*10 + I
+            if zai not in zais and len(zais) < n_nuclides:
+                zais.append(zai)
+        A += 1
+        if A > 2.6*Z + 10:      # Next element
+            Z = Z % 99 + 1
+            A = Z
+    n_xs = (2 * n_nuclides) // 3
+    return sorted(zais[:n_xs]) + sorted(zais[n_xs:])
+
+def synthetic_name(zai:int) -> str:
+    'Serpent nuclide name, e.g. Ag110m'
+    (Z, A, I) = (zai // 10000, (zai // 10) % 1000, zai % 10)
+    return molmass.ELEMENTS[Z].symbol + str(A) + ('m' if I else '')
+
+def _mat_array(name:str, values:np.ndarray, rownames:list=None) -> str:
+    'Serpent matrix, nuclide rows end with a "% name" comment'
+    if values.ndim == 1:
+        return name + ' = [ ' + ' '.join('%.5E' % v for v in values) + ' ];\n'
+    return name + ' = [\n' + '\n'.join(' '.join('%.5E' % v for v in row) + ' % ' + n
+                                        for (row, n) in zip(values, rownames)) + '\n];\n'
+
+def write_dep_file(fname:str, materials:list, n_nuclides:int=3000, days:list=None, seed:int=1):
+    'Writes synthetic Serpent _dep.m file with the materials depleted over days'
+    rng   = np.random.default_rng(seed)
+    days  = np.array(days if days is not None else np.linspace(0.0, 3650.0, 11))
+    zais  = synthetic_zais(n_nuclides) + [666, 0]
+    names = [synthetic_name(z) for z in zais[:-2]] + ['lost', 'total']
+    bu    = days * 0.05
+    with open(fname, 'w') as f:
+        f.write('ZAI = [\n' + '\n'.join(str(z) for z in zais) + '\n];\n\n')
+        f.write('NAMES = [\n' + '\n'.join("'%-16s'" % n for n in names) + '\n];\n\n')
+        for mat in materials:
+            adens = rng.lognormal(-25.0, 4.0, (len(zais), len(days)))
+            adens[-2] = 0.0                                 # lost
+            adens[-1] = adens[:-2].sum(axis=0)              # total
+            f.write(_mat_array('MAT_%s_VOLUME' % mat, np.full(len(days), 1e6)))
+            f.write(_mat_array('MAT_%s_BURNUP' % mat, bu))
+            f.write(_mat_array('MAT_%s_ADENS' % mat, adens, names))
+            f.write(_mat_array('MAT_%s_MDENS' % mat, adens * 100.0, names))
+        f.write(_mat_array('BU', bu))
+        f.write(_mat_array('DAYS', days))
+
+def write_res_file(fname:str, days:list=None, seed:int=1):
+    '''Writes synthetic Serpent _res.m file with k-eff and conversion ratio at each step.
+    Integer run parameters (POP, CYCLES, ...) are left out, serpentTools 0.11 fails on them with numpy 2'''
+    rng  = np.random.default_rng(seed)
+    days = days if days is not None else np.linspace(0.0, 3650.0, 11)
+    with open(fname, 'w') as f:
+        for d in days:
+            keff = 1.0 + 0.01*rng.standard_normal()
+            f.write(f'''
+% Increase counter:
+
+if (exist('idx', 'var'));
+  idx = idx + 1;
+else;
+  idx = 1;
+end;
+
+VERSION                   (idx, [1: 14])  = 'Serpent 2.1.32' ;
+MIN_MACROXS               (idx, [1:   4]) = [  5.00000E-02 0.0E+00  0.00000E+00 0.0E+00 ];
+BURNUP                    (idx, [1:  2])  = [  {d*0.05:.5E}  {d*0.05:.5E} ];
+BURN_DAYS                 (idx, 1)        =  {d:.5E} ;
+CONVERSION_RATIO          (idx, [1:   2]) = [  {0.6 + 0.01*rng.standard_normal():.5E} 0.00300 ];
+ANA_KEFF                  (idx, [1:   6]) = [  {keff:.5E} 0.00040  {keff - 0.007:.5E} 0.00040  7.00000E-03 0.00500 ];
+IMP_KEFF                  (idx, [1:   2]) = [  {keff:.5E} 0.00030 ];
+ABS_KEFF                  (idx, [1:   2]) = [  {keff:.5E} 0.00030 ];
+''')
+
+def write_synthetic_run(path:str, n_nuclides:int=3000, n_steps:int=11):
+    '''Writes synthetic MSFR depletion with silver shell (msfr_dep.m, msfr_res.m),
+    and wire depletion steps (wire_step-XXX_dep.m) into path'''
+    os.makedirs(path, exist_ok=True)
+    days = np.linspace(0.0, 3650.0, n_steps)
+    write_dep_file(path + '/msfr_dep.m', ['fuelsalt', 'silver'], n_nuclides, days)
+    write_res_file(path + '/msfr_res.m', days)
+    for step in range(1, n_steps):
+        write_dep_file(f'{path}/wire_step-{step:03d}_dep.m', ['silver'], n_nuclides,
+                       [days[step-1], days[step]], seed=step)
+
+
+# ------------------------------------------------------------------------------
+# Benchmark cases: prepare(cfg) does the setup, returns (work, n),
+# work() is the timed callable, n is the number of items it processes
+
+def case_salt_construction(cfg):
+    'Salt construction'
+    def work():
+        for i in range(cfg.salts):
+            (f, e) = BENCH_SALTS[i % len(BENCH_SALTS)]
+            Salt(f, e).set_chlorine_37Cl_fraction(0.99999)
+    return (work, cfg.salts)
+
+def case_salt_serpent_mat(cfg):
+    'Salt construction and Serpent material cards, no cache'
+    n = cfg.salts // 10
+    def work():
+        for i in range(n):
+            (f, e) = BENCH_SALTS[i % len(BENCH_SALTS)]
+            s = Salt(f, e)
+            s.set_chlorine_37Cl_fraction(0.99999)
+            s.serpent_mat(900.0)
+    return (work, n)
+
+def case_salt_get_salt(cfg):
+    'Cached get_salt and Serpent material cards'
+    def work():
+        salt_cache.clear()
+        for i in range(cfg.salts):
+            (f, e) = BENCH_SALTS[i % len(BENCH_SALTS)]
+            get_salt(f, e, 0.99999).serpent_mat(900.0)
+    return (work, cfg.salts)
+
+def case_salt_grid(cfg):
+    'Vectorized salt composition grid'
+    enr  = np.linspace(0.05, 0.2, cfg.salts // 100)[:,None,None]
+    x    = np.linspace(0.2, 0.5, 50)[None,:,None]
+    cl37 = np.array([0.24, 0.99999])
+    return (lambda: salt_grid(enr, x, cl37), enr.size * x.size * cl37.size)
+
+def case_salt_density(cfg):
+    'Chloride salt density over a temperature array'
+    s = get_salt(BENCH_SALTS[0][0], BENCH_SALTS[0][1], 0.99999)
+    tempK = np.linspace(900.0, 1200.0, 100*cfg.salts)
+    return (lambda: s.densityK(tempK), tempK.size)
+
+def _deck_case(make_core, cfg):
+    def work():
+        for i in range(cfg.decks):
+            core = make_core(i)
+            core.deplete = 40
+            core.refuel_flow = 2.8e-10
+            core.get_deck()
+    return (work, cfg.decks)
+
+def case_deck_msfr(cfg):
+    'MSFR.get_deck, 40-year depletion with silver shell'
+    import msfr
+    return _deck_case(lambda i: msfr.MSFR(120.0 + 0.01*i, 520.0, 0.1975, "66.66%NaCl+33.34%UCl3", 300.0), cfg)
+
+def case_deck_mcre(cfg):
+    'MCRE.get_deck, 40-year depletion'
+    import msfr
+    return _deck_case(lambda i: msfr.MCRE(20.0 + 0.01*i, 90.0, 35.0, 0.9, "66.66%NaCl+33.34%UCl3", 'MCRE'), cfg)
+
+def case_sweep_generate(cfg):
+    'Sweep.generate, refuel rate x core radius campaign written by a process pool'
+    import sweep
+    spec = {'core': 'MSFR',
+            'fixed': {'refl': 522.0, 'e': 0.1975, 'salt': "66.66%NaCl+33.34%UCl3", 'Ag_r': 300.0, 'deplete': 40},
+            'product': {'refuel_flow': {'geomspace': [1e-12, 1e-8, 50]},
+                        'r': {'linspace': [120.0, 130.0, max(1, cfg.decks // 10)]}}}
+    s = sweep.Sweep(spec, cfg.workdir + '/sweep')
+    return (s.generate, len(s.points()))
+
+def case_deck_agwire(cfg):
+    'AgWire.wire_deck over all depletion steps of a synthetic fuel'
+    import msfr
+    w = msfr.AgWire(0.2, 'half-submerged')
+    (w.deck_path, w.deck_name) = (cfg.workdir, 'msfr')
+    w.load_data()
+    def work():
+        for step in range(1, len(w.fuel.days)):
+            w.wire_deck(step)
+    return (work, len(w.fuel.days) - 1)
+
+def case_ana_calc_agfrac(cfg):
+    'AgMSFRAnalyzer.calc_agfrac'
+    import agmsfr
+    a = agmsfr.AgMSFRAnalyzer(cfg.workdir + '/msfr')
+    return (a.calc_agfrac, len(a.ag.days))
+
+def case_ana_get_EOCfrac(cfg):
+    'AgMSFRAnalyzer.get_EOCfrac for Ag, Pd, Cd'
+    import agmsfr
+    a = agmsfr.AgMSFRAnalyzer(cfg.workdir + '/msfr')
+    def work():
+        for ele in ('Ag', 'Pd', 'Cd'):
+            a.get_EOCfrac(ele)
+    return (work, 3)
+
+def case_ana_read_wires(cfg):
+    'AgWireAnalyzer.read_wires, reads all wire step files'
+    import agmsfr
+    a = agmsfr.AgWireAnalyzer(cfg.workdir + '/msfr')
+    def work():
+        (a.wires, a.wdeps, a.agtot, a.agfrac) = ([], [], [], [])
+        a.read_wires()
+    return (work, len(a.fuel.days) - 1)
+
+CASES = [case_salt_construction, case_salt_serpent_mat, case_salt_get_salt, case_salt_grid,
+         case_salt_density, case_deck_msfr, case_deck_mcre, case_sweep_generate, case_deck_agwire,
+         case_ana_calc_agfrac, case_ana_get_EOCfrac, case_ana_read_wires]
+
+
+def run_case(prepare, cfg) -> dict:
+    'Runs one case: timed run, then a run under tracemalloc for peak memory'
+    (work, n) = prepare(cfg)
+    t0 = time.perf_counter()
+    work()
+    elapsed = time.perf_counter() - t0
+    tracemalloc.start()
+    work()
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'case': prepare.__name__[5:], 'description': prepare.__doc__, 'n': n,
+            'time_s': elapsed, 'time_per_item_s': elapsed / n, 'peak_mem_MB': peak / 2**20}
+
+
+# ------------------------------------------------------------------------------
+# Deck rendering rate
+
+def measure_deck_rate(n:int=5000) -> float:
+    '''Full 40-year depletion decks rendered per minute, alternating
+    MSFR with silver shell, MCRE, and MCFR, each deck with a different core radius'''
+    import msfr
+    cores = [msfr.MSFR(120.0, 520.0, 0.1975, "66.66%NaCl+33.34%UCl3", 300.0),
+             msfr.MCRE(20.0, 90.0, 35.0, 0.9, "66.66%NaCl+33.34%UCl3", 'MCRE'),
+             msfr.MCRE(200.0, 200.0, 250.0, 0.05, "66.66%NaCl+33.34%UCl3", 'MCFR')]
+    for core in cores:
+        core.deplete = 40
+        core.refuel_flow = 2.8e-10
+    r0 = [core.r for core in cores]
+    t0 = time.perf_counter()
+    for i in range(n):
+        core = cores[i % len(cores)]
+        core.r = r0[i % len(cores)] + 1e-4*i
+        core.get_deck()
+    return 60.0 * n / (time.perf_counter() - t0)
+
+def check_deck_rate(results:list=None, n:int=5000) -> bool:
+    'Checks that deck rendering keeps up with DECK_RATE_TARGET'
+    rate = measure_deck_rate(n)
+    print("deck rate %10.0f decks/min, target %d" % (rate, DECK_RATE_TARGET))
+    if results is not None:
+        results.append({'case': 'deck_rate', 'description': 'Full depletion decks per minute',
+                        'n': n, 'decks_per_minute': rate, 'target': DECK_RATE_TARGET})
+    if rate < DECK_RATE_TARGET:
+        print("  --> below target!")
+        return False
+    return True
+
+
+# ------------------------------------------------------------------------------
+# Import time
+
+def measure_import_time(module:str, repeat:int=3) -> float:
+    'Best of repeat cold imports of the module in a fresh interpreter [s]'
+    code = "import time; t0 = time.perf_counter(); import %s; print(time.perf_counter() - t0)" % module
+    here = os.path.dirname(os.path.abspath(__file__))
+    return min(float(subprocess.run([sys.executable, '-c', code], cwd=here, check=True,
+                capture_output=True, text=True).stdout) for i in range(repeat))
+
+def check_import_time(results:list=None) -> bool:
+    'Checks that module imports stay under IMPORT_TIME_BUDGET'
+    ok = True
+    for (module, budget) in IMPORT_TIME_BUDGET.items():
+        t = measure_import_time(module)
+        print("import %-8s %8.3f s, budget %5.2f s" % (module, t, budget))
+        if results is not None:
+            results.append({'case': 'import_' + module, 'description': 'Cold import of ' + module,
+                            'n': 1, 'time_s': t, 'time_per_item_s': t, 'budget_s': budget})
+        if t > budget:
+            print("  --> over budget!")
+            ok = False
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MSFR benchmark suite')
+    parser.add_argument('-o', '--output', help='JSON file with the results')
+    parser.add_argument('--cases', nargs='*', default=[], help='Run cases starting with these names')
+    parser.add_argument('--salts', type=int, default=10000, help='Salts per salt case')
+    parser.add_argument('--decks', type=int, default=200, help='Decks per deck case')
+    parser.add_argument('--rate-decks', type=int, default=5000, help='Decks for the deck rate check')
+    parser.add_argument('--nuclides', type=int, default=3000, help='Nuclides in synthetic outputs')
+    parser.add_argument('--steps', type=int, default=11, help='Depletion steps in synthetic outputs')
+    cfg = parser.parse_args()
+
+    cfg.workdir = tempfile.mkdtemp(prefix='msfr_bench_')
+    results = []
+    try:
+        write_synthetic_run(cfg.workdir, cfg.nuclides, cfg.steps)
+        print("%-20s %8s %12s %14s %10s" % ('case', 'n', 'time [s]', 'per item [us]', 'peak [MB]'))
+        for prepare in CASES:
+            name = prepare.__name__[5:]
+            if cfg.cases and not any(name.startswith(c) for c in cfg.cases):
+                continue
+            r = run_case(prepare, cfg)
+            results.append(r)
+            print("%-20s %8d %12.4f %14.3f %10.2f" % (name, r['n'], r['time_s'],
+                  1e6*r['time_per_item_s'], r['peak_mem_MB']))
+        ok = check_deck_rate(results, cfg.rate_decks)
+        ok = check_import_time(results) and ok
+    finally:
+        shutil.rmtree(cfg.workdir)
+    if cfg.output:
+        with open(cfg.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'host': platform.node(),
+                       'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'nuclides': cfg.nuclides,
+                       'steps': cfg.steps, 'results': results}, f, indent=1)
+        print("Saved results: ", cfg.output)
+    if not ok:
+        sys.exit(1)
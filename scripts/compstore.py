@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+On-disk store of material compositions: fresh salt isotopic weight fractions
+and depleted material compositions read from Serpent _dep.m files.
+
+Each entry is a set of .npy arrays plus a .json header in one directory,
+named by the hash of the entry key. Arrays are loaded memory-mapped.
+
+# Example usage:
+import compstore, msfr
+store = compstore.CompositionStore('/home/ondrejch/APump/compositions')
+mycore = msfr.MSFR(122, 522, 0.1975, "66.66%NaCl+33.34%UCl3")
+mycore.comp_store = store       # Fresh salt is read from / saved to the store
+w = msfr.AgWire()
+w.comp_store = store            # Burned fuel is read from the store after the first load_data()
+'''
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from salts import Salt, ISO_WF_DTYPE
+
+
+def salt_key(f:str, e:float, cl37:float=None, li7dep:float=0.99990) -> str:
+    'Store key of a fresh salt'
+    return "salt:%s:%r:%r:%r" % (f.replace(" ", ""), float(e),
+        None if cl37 is None else float(cl37), float(li7dep))
+
+
+class CompositionStore(object):
+    '''Directory of composition tables, lookup by key'''
+    def __init__(self, path:str, mmap:bool=True):
+        self.path:str  = path       # Store directory
+        self.mmap:bool = mmap       # Memory-map arrays on load
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return "CompositionStore: %s, %d entries" % (self.path, len(self.keys()))
+
+    def _fname(self, key:str, suffix:str) -> str:
+        'File name of an entry part'
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + suffix)
+
+    def _write(self, fname:str, write):
+        'Writes a file atomically, so concurrent runs never see partial entries'
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp, fname)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def __contains__(self, key:str) -> bool:
+        return os.path.exists(self._fname(key, '.json'))
+
+    def keys(self) -> list:
+        'Returns keys of all stored entries'
+        keys = []
+        for fname in sorted(os.listdir(self.path)):
+            if fname.endswith('.json'):
+                with open(os.path.join(self.path, fname)) as f:
+                    keys.append(json.load(f)['key'])
+        return keys
+
+    def save(self, key:str, arrays:dict, meta:dict=None):
+        'Saves named numpy arrays and json metadata under the key'
+        for (name, a) in arrays.items():
+            self._write(self._fname(key, '.%s.npy' % name), lambda f: np.save(f, np.asarray(a)))
+        header = {'key': key, 'arrays': sorted(arrays), 'meta': meta or {}}
+        self._write(self._fname(key, '.json'), lambda f: f.write(json.dumps(header).encode()))
+
+    def load(self, key:str) -> tuple:
+        'Returns (arrays, meta) stored under the key, raises KeyError if missing'
+        try:
+            with open(self._fname(key, '.json')) as f:
+                header = json.load(f)
+        except FileNotFoundError:
+            raise KeyError(key)
+        mmap_mode = 'r' if self.mmap else None
+        arrays = { name: np.load(self._fname(key, '.%s.npy' % name), mmap_mode=mmap_mode)
+                   for name in header['arrays'] }
+        return (arrays, header['meta'])
+
+    def save_salt(self, s:Salt):
+        'Saves isotopic weight fractions of a salt'
+        self.save(salt_key(s.formula, s.enr, s.Cl37enr, s.Li7dep), {'composition': s.wflist.view(np.ndarray)},
+                  {'formula': s.formula, 'enr': s.enr, 'cl37': s.Cl37enr, 'li7dep': s.Li7dep,
+                   'mol_mass': s.get_molar_mass()})
+
+    def load_salt(self, f:str, e:float, cl37:float=None, li7dep:float=0.99990) -> Salt:
+        'Returns frozen salt with the stored composition, raises KeyError if missing'
+        (arrays, meta) = self.load(salt_key(f, e, cl37, li7dep))
+        s = Salt(meta['formula'], meta['enr'], meta['li7dep'])
+        if meta['cl37'] is not None:
+            s.set_chlorine_37Cl_fraction(meta['cl37'])
+        s.mol_mass    = meta['mol_mass']
+        s.composition = np.asarray(arrays['composition'], dtype=ISO_WF_DTYPE)
+        s.freeze()
+        return s
+
+    def save_material(self, key:str, mat):
+        '''Saves a serpentTools DepletedMaterial: nuclide names, ZAIs, days,
+        and all nuclide x step data (adens, mdens, ...)'''
+        arrays = {'zai': np.array(mat.zai, dtype=np.int64), 'days': np.asarray(mat.days)}
+        if mat.names is not None:
+            arrays['names'] = np.array(mat.names, dtype=str)
+        for (name, a) in mat.data.items():
+            if isinstance(a, np.ndarray):
+                arrays['data_' + name] = a
+        self.save(key, arrays, {'name': mat.name})
+
+    def load_material(self, key:str):
+        'Returns serpentTools DepletedMaterial with the stored data, raises KeyError if missing'
+        from serpentTools.objects import DepletedMaterial
+        (arrays, meta) = self.load(key)
+        mat = DepletedMaterial(meta['name'], {
+            'zai':   arrays['zai'].tolist(),
+            'names': arrays['names'].tolist() if 'names' in arrays else None,
+            'days':  arrays['days']})
+        for (name, a) in arrays.items():
+            if name.startswith('data_'):
+                mat.data[name[5:]] = a
+        return mat
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a composition store module.")
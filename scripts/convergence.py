@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Fission source convergence of criticality runs, from the Shannon entropy of the source.
+
+Serpent writes the cycle-wise Shannon entropy into the _his.m history file when a deck has
+"set his 1" (MSFRbase.entropy). From a finished pilot or neighbour run this module sizes
+the next run: the inactive cycles from the cycle where the entropy settled, the active
+cycles from the k_eff uncertainty reached and a target uncertainty, which falls
+as one over the square root of the active cycles. check_run() flags finished runs
+whose source had not converged before the active cycles, or missed the target uncertainty.
+
+# Example usage:
+import convergence
+(his, n_inactive) = convergence.read_history('/tmp/mcfr_input_his0.m')
+print(convergence.check_run('/tmp/mcfr_input_his0.m', '/tmp/mcfr_input_res.m', 30e-5))
+'''
+
+import re
+import math
+import numpy as np
+import resfile
+
+ENTROPY_KEY = 'HIS_ENTR_SPT'    # Spatial entropy: cycle, then (value, mean, rel. error) of total, x, y, z
+KEFF_KEY    = 'ANA_KEFF'
+
+
+def read_history(fname:str) -> tuple:
+    '''Returns ({name: 2-D array, cycle x values without the cycle number}, number of inactive cycles)
+    of a Serpent _his.m file. Raises IOError if the file cannot be read.
+    The inactive cycles are guessed from the restart of the cycle numbers, 0 if they run on,
+    inactive_run() reads them from the _res.m file.'''
+    with open(fname) as f:
+        text = f.read()
+    his = {}
+    n_inactive = None
+    for (name, body) in re.findall(r'^(\w+)\s*=\s*\[(.*?)\];', text, re.M | re.S):
+        rows = []
+        for line in body.splitlines():
+            line = line.split('%')[0].split()
+            if line:
+                rows.append([float(v) for v in line])
+        if not rows:
+            continue
+        cycle = [r[0] for r in rows]
+        restart = [i for i in range(1, len(cycle)) if cycle[i] <= cycle[i-1]]  # Active cycles count from 1
+        if n_inactive is None:
+            n_inactive = restart[0] if restart else 0
+        his[name] = np.array([r[1:] for r in rows])
+    return (his, n_inactive or 0)
+
+def inactive_run(res_file:str, his_guess:int=0) -> int:
+    'Inactive cycles of a finished run, SKIP of its _res.m file, his_guess if it cannot be read'
+    try:
+        return int(resfile.read_res(res_file, ['SKIP'])['SKIP'][0,0])
+    except (IOError, KeyError, IndexError):
+        return his_guess
+
+def entropy_converged_cycle(h:np.ndarray, z:float=2.0) -> int:
+    '''Number of cycles before the entropy h first enters its stationary band,
+    mean +- z standard deviations of the second half of the cycles'''
+    h = np.asarray(h)
+    tail = h[len(h)//2:]
+    (mean, std) = (tail.mean(), tail.std())
+    inside = np.nonzero(np.abs(h - mean) <= z * max(std, 1e-12))[0]
+    return int(inside[0]) if len(inside) else len(h)
+
+def entropy_drift(h:np.ndarray, batch:int=10) -> float:
+    '''Difference of the entropy means of the first and second half of h,
+    in standard deviations estimated from batch means, which absorbs cycle correlations'''
+    h = np.asarray(h)
+    n = (len(h) // (2*batch)) * batch
+    if n < 2*batch:
+        return 0.0
+    halves = [h[:n].reshape(-1, batch).mean(1), h[len(h)-n:].reshape(-1, batch).mean(1)]
+    se = math.sqrt(sum(b.var(ddof=1) / len(b) for b in halves))
+    return float(abs(halves[1].mean() - halves[0].mean()) / se) if se > 0 else 0.0
+
+def inactive_cycles(h:np.ndarray, safety:float=1.5, minimum:int=10, z:float=2.0) -> int:
+    'Inactive cycles for a run like the one with entropy history h'
+    return max(minimum, int(math.ceil(safety * entropy_converged_cycle(h, z))))
+
+def active_cycles(sigma:float, n_active:int, target:float, minimum:int=20, maximum:int=5000) -> int:
+    '''Active cycles to reach standard deviation target, from sigma reached in n_active cycles
+    with the same population'''
+    if target <= 0.0:
+        raise ValueError("Target k_eff uncertainty has to be positive: ", target)
+    return int(min(maximum, max(minimum, math.ceil(n_active * (sigma / target)**2))))
+
+def size_run(his_file:str, res_file:str, target:float=None, safety:float=1.5) -> dict:
+    '''Sizes a run from a finished one: {'inactive': cycles, 'active': cycles or None without target}'''
+    (his, n_inactive) = read_history(his_file)
+    if ENTROPY_KEY not in his:
+        raise ValueError("No source entropy in history file, set his 1: ", his_file)
+    sizes = {'inactive': inactive_cycles(his[ENTROPY_KEY][:,0], safety), 'active': None}
+    if target is not None:
+        (k, sigma) = resfile.keff(res_file, KEFF_KEY)
+        n_active = len(his[ENTROPY_KEY]) - inactive_run(res_file, n_inactive)
+        sizes['active'] = active_cycles(sigma, n_active, target)
+    return sizes
+
+def check_run(his_file:str, res_file:str, target:float=None, z:float=3.0) -> dict:
+    '''Convergence check of a finished run. Returns a dict with converged, problems,
+    the cycle where the entropy settled, inactive cycles run, k_eff and its sigma.'''
+    result = {'converged': True, 'problems': []}
+    try:
+        (his, n_inactive) = read_history(his_file)
+    except IOError as e:
+        return {'converged': False, 'problems': ["No history file: %s" % e]}
+    if ENTROPY_KEY not in his:
+        return {'converged': False, 'problems': ["No source entropy in " + his_file]}
+    h = his[ENTROPY_KEY][:,0]
+    n_inactive = inactive_run(res_file, n_inactive)
+    result['entropy_cycle'] = entropy_converged_cycle(h)
+    result['inactive'] = n_inactive
+    if result['entropy_cycle'] > n_inactive:
+        result['problems'].append("Source entropy settled in cycle %d, after %d inactive cycles" %
+                                  (result['entropy_cycle'], n_inactive))
+    drift = entropy_drift(h[n_inactive:])
+    if drift > z:
+        result['problems'].append("Source entropy drifts in active cycles, %.1f sigma" % drift)
+    try:
+        (result['keff'], result['sigma']) = resfile.keff(res_file, KEFF_KEY)
+        if target is not None and result['sigma'] > target:
+            result['problems'].append("k_eff sigma %.2g above target %.2g" % (result['sigma'], target))
+    except (IOError, ValueError, IndexError) as e:
+        result['problems'].append("No k_eff: %s" % e)
+    result['converged'] = not result['problems']
+    return result
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a source convergence module.")
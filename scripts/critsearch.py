@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Stochastic criticality search: finds the value of a core parameter (radius, enrichment,
+Cl-37 fraction, height, ...) where k_eff reaches the target, typically 1.
+
+Each iteration runs a batch of Serpent decks concurrently. k_eff is fitted around the
+root by a straight line weighted by the inverse k_eff variances (a noise-aware secant),
+and the next batch is placed around the root estimate, inside the bracket formed by points
+that are statistically above and below the target. The search stops once the bracket is
+as narrow as the statistical error of a single run allows, i.e. when points closer to
+the root could no longer be told apart from the target.
+
+# Example usage:
+import critsearch
+s = critsearch.CritSearch('r', (110.0, 140.0), core='MSFR',
+        fixed={'refl': 522.0, 'e': 0.1975, 'salt': "66.66%NaCl+33.34%UCl3",
+               'queue': 'fill', 'ompcores': 64, 'histories': 50000},
+        path='/home/ondrejch/APump/final_run/small_core/crit_search')
+result = s.run()
+print(result['x'], result['sigma_x'])
+'''
+
+import os
+import numpy as np
+import sweep
+import resfile
+import schedulers
+
+
+def run_decks(core:str, fixed:dict, param:str, values:list, path:str,
+              scheduler:schedulers.Scheduler, poll_interval:float=30.0, warm_from:list=None) -> list:
+    '''Runs a deck for each value of param concurrently through the scheduler,
+    in directories named as sweep points under path. Waits for the jobs,
+    returns the _res.m file names. Decks that already have results are not run again.
+    Runs with the source entropy on are checked for source convergence.
+    With warm_from, the values of earlier runs, each deck saves its fission source
+    and starts from the source of the nearest earlier run.'''
+    cores = []
+    handles = []
+    for x in values:
+        point = {param: x}
+        c = sweep.make_core(core, dict(fixed, **point))
+        c.deck_path = os.path.join(path, sweep.point_dirname(point))
+        c.qsub_file = os.path.join(c.deck_path, 'run.sh')
+        c.scheduler = scheduler
+        if warm_from is not None:
+            c.save_source = True
+            c.warm_source = sweep.nearest_source(point, [({param: v}, os.path.join(path,
+                sweep.point_dirname({param: v}), c.deck_name + '.src')) for v in warm_from])
+        c.save_deck()
+        c.save_qsub_file()
+        if not os.path.exists(os.path.join(c.deck_path, c.deck_name + '_res.m')):
+            c.run_deck()
+            if c.job is not None:
+                handles.append(c.job)
+        cores.append(c)
+    schedulers.JobPoller(scheduler, poll_interval).wait(handles)
+    for c in cores:
+        if c.entropy:       # Flags runs whose source did not converge
+            c.check_convergence()
+    return [os.path.join(c.deck_path, c.deck_name + '_res.m') for c in cores]
+
+
+class CritSearch(object):
+    '''Criticality search on one core parameter'''
+    def __init__(self, param:str, bracket:tuple, core:str='MSFR', fixed:dict=None,
+                 path:str='/tmp/critsearch', target:float=1.0, batch:int=3,
+                 scheduler:schedulers.Scheduler=None, evaluator=None):
+        if len(bracket) != 2 or bracket[0] == bracket[1]:
+            raise ValueError("Bad bracket: ", bracket)
+        self.param:str      = param         # Core parameter to vary
+        self.bracket:tuple  = tuple(sorted(bracket))  # Initial search range
+        self.core:str       = core          # 'MSFR' or 'MCRE'
+        self.fixed:dict     = dict(fixed or {})  # Other core parameters, as in sweep specs
+        self.path:str       = path          # Search directory, one deck directory per point
+        self.target:float   = target        # Target k_eff
+        self.batch:int      = batch         # Points run concurrently per iteration
+        self.z:float        = 2.0           # Sigmas a point has to be off target to bound the bracket
+        self.max_iter:int   = 10            # Iteration limit
+        self.xtol:float     = 0.0           # Stop also when the root is known this well
+        self.keff_key:str   = 'ANA_KEFF'    # Result used as k_eff
+        self.poll_interval:float = 30.0     # Seconds between job status polls
+        self.warm_start:bool = False        # Start runs from the fission source of the nearest earlier run
+        self.scheduler      = scheduler or schedulers.LocalScheduler()
+        self.evaluator      = evaluator or self.run_points  # values -> [(k, sigma_k)]
+        self.points:list    = []            # Evaluated (x, k, sigma_k)
+        self.history:list   = []            # Root estimate after each iteration
+
+    def __repr__(self):
+        return "CritSearch of %s in %s for k=%g, %d points" % (self.param, self.bracket, self.target,
+                                                               len(self.points))
+
+    def run_points(self, values:list) -> list:
+        '''Runs decks for the parameter values concurrently through the scheduler,
+        returns [(k, sigma_k)], None for failed runs'''
+        results = []
+        warm_from = [p[0] for p in self.points] if self.warm_start else None
+        for res_file in run_decks(self.core, self.fixed, self.param, values, self.path,
+                                  self.scheduler, self.poll_interval, warm_from):
+            try:
+                results.append(resfile.keff(res_file, self.keff_key))
+            except (IOError, ValueError, IndexError) as e:
+                print("[WARNING] No k_eff in ", res_file, e)
+                results.append(None)
+        return results
+
+    def fit(self, points:list) -> tuple:
+        '''Straight line k = a + b*x through points, weighted by 1/sigma_k^2.
+        Returns (a, b, covariance), the covariance is scaled up by the reduced chi^2
+        when the points scatter more than their errors (curvature, underestimated errors).'''
+        (x, k, s) = (np.array(v) for v in zip(*points))
+        X = np.vstack([np.ones_like(x), x]).T
+        W = 1.0 / s**2
+        cov = np.linalg.inv(X.T @ (X * W[:,None]))
+        beta = cov @ (X.T @ (W * k))
+        if len(points) > 2:
+            chi2 = np.sum(W * (k - X @ beta)**2) / (len(points) - 2)
+            cov *= max(1.0, chi2)
+        return (beta[0], beta[1], cov)
+
+    def root(self, a:float, b:float, cov:np.ndarray) -> tuple:
+        'Returns the root of the line and its standard deviation'
+        if b == 0.0:
+            raise ValueError("k_eff does not depend on ", self.param)
+        x0 = (self.target - a) / b
+        g = np.array([-1.0 / b, -x0 / b])       # d x0 / d(a, b)
+        return (x0, float(np.sqrt(g @ cov @ g)))
+
+    def current_bracket(self, direction:float) -> tuple:
+        '''Returns (lo, hi) from points statistically below and above the target,
+        None for a side without such points. direction is the sign of dk/dx.'''
+        below = [x for (x, k, s) in self.points if direction*(k - self.target) < -self.z*s]
+        above = [x for (x, k, s) in self.points if direction*(k - self.target) >  self.z*s]
+        return (float(max(below)) if below else None, float(min(above)) if above else None)
+
+    def resolution(self, b:float) -> float:
+        'Parameter change that moves k_eff by one standard deviation of a single run'
+        return float(np.median([s for (x, k, s) in self.points]) / abs(b))
+
+    def estimate(self) -> dict:
+        'Root estimate from the points near the bracket'
+        (a, b, cov) = self.fit(self.points)         # Global fit for the direction
+        (lo, hi) = self.current_bracket(np.sign(b))
+        if lo is not None and hi is not None and lo < hi:
+            local = [p for p in self.points if lo <= p[0] <= hi]
+            if len(local) >= 2:
+                (a, b, cov) = self.fit(local)
+        (x0, sx0) = self.root(a, b, cov)
+        return {'x': float(x0), 'sigma_x': sx0, 'slope': float(b), 'bracket': (lo, hi), 'resolution': self.resolution(b)}
+
+    def next_points(self, est:dict) -> list:
+        'Parameter values of the next batch'
+        (lo, hi) = est['bracket']
+        xs = [p[0] for p in self.points]
+        span = max(xs) - min(xs)
+        if lo is None or hi is None or lo >= hi:    # Not bracketed yet, extrapolate the secant
+            x0 = float(np.clip(est['x'], min(xs) - 2*span, max(xs) + 2*span))
+            width = max(est['sigma_x'], est['resolution'], 0.1*span)
+            (lo, hi) = (x0 - 2*width, x0 + 2*width)
+        else:
+            x0 = est['x']
+            width = max(2*est['sigma_x'], (self.z + 1)*est['resolution'])   # Outside the z sigma band
+        margin = 0.05 * (hi - lo)
+        if self.batch == 1:
+            values = [x0]
+        else:
+            values = x0 + width * np.linspace(-1.0, 1.0, self.batch)
+        values = np.clip(values, lo + margin, hi - margin)
+        values = sorted(set(float('%.6g' % v) for v in values) - set(float('%.6g' % x) for x in xs))
+        return values or [float(x0)]
+
+    def evaluate(self, values:list):
+        'Runs the values and adds the successful points'
+        for (x, r) in zip(values, self.evaluator(values)):
+            if r is not None:
+                self.points.append((x, r[0], r[1]))
+
+    def converged(self, est:dict) -> bool:
+        'Whether the bracket is down to the statistical error, or the root known to xtol'
+        (lo, hi) = est['bracket']
+        if lo is not None and hi is not None and hi - lo <= 2*(self.z + 1)*est['resolution']:
+            return True
+        return est['sigma_x'] <= self.xtol
+
+    def run(self) -> dict:
+        '''Runs the search, returns the root estimate: x, sigma_x, slope dk/dx, bracket,
+        resolution, number of runs, iterations, and whether it converged'''
+        if len(self.points) < 2:
+            self.evaluate([float(x) for x in np.linspace(self.bracket[0], self.bracket[1], max(2, self.batch))])
+        est = None
+        for it in range(1, self.max_iter + 1):
+            if len(self.points) < 2:
+                raise ValueError("Too few successful runs to search: ", self.points)
+            est = self.estimate()
+            est.update(iterations=it, runs=len(self.points), converged=self.converged(est))
+            self.history.append(est)
+            print("[critsearch] %d: %s = %.6g +- %.3g, bracket %s, %d runs" %
+                  (it, self.param, est['x'], est['sigma_x'], est['bracket'], est['runs']))
+            if est['converged'] or it == self.max_iter:
+                break
+            self.evaluate(self.next_points(est))
+        return est
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a criticality search module.")
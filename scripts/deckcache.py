@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Content-addressed cache of Serpent runs.
+
+The key of a run is the hash of the rendered deck and of the run settings that are not
+in the deck text (histories, ompcores, nuclear data libraries). The first deck saved
+with a key owns it: the cache records where that deck lives. Identical decks saved
+later, in the same sweep or in a re-run of a campaign, are not run again.
+Once the owner has finished, its results are linked (or copied) next to the duplicates.
+An owner that has not finished within stale_after seconds of its claim is presumed dead,
+the next identical deck takes the key over and runs; release() clears an owner at once.
+
+# Example usage:
+import msfr, deckcache
+mycore = msfr.MSFR(122, 522, 0.1975, "66.66%NaCl+33.34%UCl3")
+mycore.deck_cache = deckcache.DeckCache('/home/ondrejch/APump/deck_cache')
+mycore.deck_path  = '/home/ondrejch/APump/final_run/small_core/0122.0'
+mycore.save_deck()      # Links results of an identical finished run, if any
+mycore.run_deck()       # Submits only if no identical deck was run or is running
+'''
+
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import resfile
+import xsindex
+
+RESULT_FILES = ['{deck_name}_*.m', 'done.out']   # Run products reused from the owner
+STALE_AFTER  = 14 * 24 * 3600.0                 # Seconds after the claim an unfinished owner is dead
+
+
+def deck_key(sections:list, histories:int, ompcores:int, nuc_libs:str) -> str:
+    'Cache key of a deck given as a list of sections, and of its run settings'
+    h = hashlib.sha1()
+    for section in sections:
+        h.update(section.encode())
+    h.update(("\n%% run: histories %s ompcores %s nuc_libs %s" % (histories, ompcores, nuc_libs)).encode())
+    return h.hexdigest()
+
+def text_sha1(text:str) -> str:
+    'Hash of a deck text, as file_sha1 of the saved deck'
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def file_sha1(fname:str) -> str:
+    'Hash of a file content, None if missing'
+    try:
+        with open(fname, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+class DeckCache(object):
+    '''Directory of run records, one json file per key'''
+    def __init__(self, path:str, copy:bool=False):
+        self.path:str  = path       # Cache directory
+        self.copy:bool = copy       # Copy results instead of symlinking
+        self.stale_after:float = STALE_AFTER    # Seconds after the claim an unfinished owner is dead
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return "DeckCache: %s" % self.path
+
+    def _fname(self, key:str) -> str:
+        return os.path.join(self.path, key + '.json')
+
+    def lookup(self, key:str) -> dict:
+        '''Returns record of the deck that owns the key, None if not cached.
+        Records of decks that were removed or overwritten since are stale, None too,
+        and so are owners that have not finished within stale_after seconds of their claim.'''
+        try:
+            with open(self._fname(key)) as f:
+                record = json.load(f)
+            claimed = os.path.getmtime(self._fname(key))
+        except (IOError, ValueError):
+            return None
+        if file_sha1(record['deck_file']) != record['deck_sha1']:
+            return None
+        if time.time() - claimed > self.stale_after and not self.is_finished(record):
+            print("[WARNING] Deck cache owner presumed dead: ", record['deck_file'])
+            return None
+        return record
+
+    def release(self, key:str):
+        'Clears the owner of the key, e.g. a crashed run, the next identical deck claims it'
+        try:
+            os.unlink(self._fname(key))
+        except FileNotFoundError:
+            pass
+
+    def claim(self, key:str, deck_file:str, deck_sha1:str) -> dict:
+        '''Registers saved deck_file with text_sha1 deck_sha1 as the owner of the key,
+        unless a live owner exists. Returns the owner record, the new one if the claim succeeded.'''
+        record = {'key': key, 'deck_file': os.path.abspath(deck_file), 'deck_sha1': deck_sha1}
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        try:
+            try:                    # Atomic, fails if someone owns the key already
+                os.link(tmp, self._fname(key))
+                return record
+            except FileExistsError:
+                owner = self.lookup(key)
+                if owner is not None:
+                    return owner
+                os.replace(tmp, self._fname(key))   # Stale owner, take over
+                return record
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def is_finished(self, record:dict) -> bool:
+        '''Whether the owner run has ended and has results of all its depletion steps.
+        Serpent rewrites _res.m after every step, so the file alone does not tell a finished
+        run from a running or crashed one: the run script writes done.out when Serpent exits
+        with status 0, and the last BURN_STEP has to match the steps of the dep card.'''
+        deck_file = record['deck_file']
+        if not (os.path.exists(os.path.join(os.path.dirname(deck_file), 'done.out')) and
+                os.path.exists(deck_file + '_res.m')):
+            return False
+        try:
+            with open(deck_file) as f:
+                cards = xsindex.deck_cards(xsindex.expand_includes(f.read(), os.path.dirname(deck_file)))
+            steps = sum(1 for c in cards if c[0] == 'dep' for a in c[1:] if xsindex._is_number(a))
+            if steps == 0:
+                return True
+            res = resfile.read_res(deck_file + '_res.m', ['BURN_STEP'])
+            return 'BURN_STEP' in res and int(res['BURN_STEP'][-1,0]) == steps
+        except (IOError, ValueError):
+            return False
+
+    def result_files(self, record:dict) -> list:
+        'Result files of the owner run'
+        (path, name) = os.path.split(record['deck_file'])
+        files = []
+        for pattern in RESULT_FILES:
+            files += glob.glob(os.path.join(path, pattern.format(deck_name=glob.escape(name))))
+        return sorted(files)
+
+    def link_results(self, record:dict, deck_file:str) -> list:
+        '''Links or copies owner results next to deck_file, named after it.
+        Returns list of the files created.'''
+        (owner_path, owner_name) = os.path.split(record['deck_file'])
+        (path, name) = os.path.split(os.path.abspath(deck_file))
+        created = []
+        for src in self.result_files(record):
+            base = os.path.basename(src)
+            if base.startswith(owner_name + '_'):
+                base = name + base[len(owner_name):]
+            dst = os.path.join(path, base)
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            if self.copy:
+                shutil.copy2(src, dst)
+            else:
+                os.symlink(src, dst)
+            created.append(dst)
+        return created
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a deck cache module.")
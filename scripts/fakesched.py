@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Stand-in batch scheduler to try job workflows on a single Linux box.
+It understands the subset of TORQUE and Slurm commands that schedulers.py uses,
+jobs run right away in the background, job records are kept in a spool directory.
+
+# Example usage:
+import schedulers, fakesched
+sched = schedulers.TorqueScheduler(commands=fakesched.commands('torque'))
+job = sched.submit('run.sh', '/tmp/deck')
+schedulers.JobPoller(sched, interval=1).wait([job])
+
+# Or from the shell:
+$ ./fakesched.py qsub -W depend=afterok:1.fake run.sh
+$ ./fakesched.py qstat -f 1.fake 2.fake
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+
+SPOOL = os.environ.get('FAKESCHED_SPOOL', '/tmp/fakesched')   # Job records
+HOST  = 'fake'
+SLURM_STATES = {'Q': 'PENDING', 'R': 'RUNNING'}
+
+
+def commands(flavor:str='torque', spool:str=None) -> dict:
+    'Scheduler commands for schedulers.TorqueScheduler or SlurmScheduler that call this script'
+    me = [sys.executable, os.path.abspath(__file__)]
+    if spool is not None:
+        me += ['--spool', spool]
+    names = {'torque': ['qsub', 'qstat', 'qdel'], 'slurm': ['sbatch', 'squeue', 'sacct', 'scancel']}[flavor]
+    return {name: me + [name] for name in names}
+
+def _record_file(job_id:str) -> str:
+    return os.path.join(SPOOL, job_id.split('.')[0] + '.json')
+
+def load(job_id:str) -> dict:
+    'Job record, None if unknown'
+    try:
+        with open(_record_file(job_id)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def save(job:dict):
+    'Writes job record atomically'
+    tmp = _record_file(job['id']) + '.%d.tmp' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp, _record_file(job['id']))
+
+def submit(script:str, after:list) -> str:
+    'Registers and starts the job, returns its number'
+    os.makedirs(SPOOL, exist_ok=True)
+    n = 1
+    while True:             # Claim the next free job number
+        try:
+            os.close(os.open(os.path.join(SPOOL, '%d.id' % n), os.O_CREAT | os.O_EXCL))
+            break
+        except FileExistsError:
+            n += 1
+    job = {'id': str(n), 'script': os.path.abspath(script), 'cwd': os.getcwd(), 'after': after,
+           'state': 'Q', 'exit_status': None, 'pid': None}
+    save(job)
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), '--spool', SPOOL, '_run', str(n)],
+                     cwd=job['cwd'], start_new_session=True,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return str(n)
+
+def run(job_id:str):
+    'Job process: waits for dependencies, then runs the script'
+    job = load(job_id)
+    while True:
+        deps = [load(d) for d in job['after']]
+        if any(d is None or (d['state'] == 'C' and d['exit_status'] != 0) for d in deps):
+            job.update(state='C', exit_status=-1)   # Dependency failed, never runs
+            save(job)
+            return
+        if all(d['state'] == 'C' for d in deps):
+            break
+        time.sleep(0.2)
+        if load(job_id)['state'] == 'C':            # Cancelled while waiting
+            return
+    env = dict(os.environ, PBS_O_WORKDIR=job['cwd'], SLURM_SUBMIT_DIR=job['cwd'],
+               PBS_JOBID=job_id + '.' + HOST, SLURM_JOB_ID=job_id)
+    name = os.path.basename(job['script'])
+    with open(os.path.join(job['cwd'], '%s.o%s' % (name, job_id)), 'w') as out:
+        proc = subprocess.Popen(['bash', job['script']], cwd=job['cwd'], env=env, stdout=out, stderr=out)
+        if load(job_id)['state'] == 'C':            # Cancelled while starting
+            proc.kill()
+            return
+        job.update(state='R', pid=os.getpid())
+        save(job)
+        exit_status = proc.wait()
+    job = load(job_id)
+    if job['state'] != 'C':
+        job.update(state='C', exit_status=exit_status)
+        save(job)
+
+def cancel(job_id:str):
+    'Kills the job, it ends with TORQUE exit status 271'
+    job = load(job_id)
+    if job is None or job['state'] == 'C':
+        return
+    job.update(state='C', exit_status=271)
+    save(job)
+    if job['pid']:
+        try:
+            os.killpg(job['pid'], signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+def _option(args:list, name:str) -> str:
+    'Removes option and its value from args, returns the value'
+    for (i, a) in enumerate(args):
+        if a == name:
+            args.pop(i)
+            return args.pop(i)
+        if a.startswith(name + '='):
+            args.pop(i)
+            return a[len(name) + 1:]
+    return None
+
+def _afterok(depend:str) -> list:
+    if depend is None:
+        return []
+    if not depend.startswith('afterok:'):
+        raise ValueError("Only afterok dependencies are supported: ", depend)
+    return [d.split('.')[0] for d in depend[len('afterok:'):].split(':') if d]
+
+def main(args:list) -> int:
+    global SPOOL
+    if args[:1] == ['--spool']:
+        SPOOL = args[1]
+        args = args[2:]
+    (cmd, args) = (args[0], args[1:])
+    if cmd == '_run':
+        run(args[0])
+    elif cmd == 'qsub':
+        depend = _option(args, '-W')            # depend=afterok:...
+        if depend is not None and depend.startswith('depend='):
+            depend = depend[len('depend='):]
+        print(submit(args[-1], _afterok(depend)) + '.' + HOST)
+    elif cmd == 'qstat':
+        for job_id in [a for a in args if not a.startswith('-')]:
+            job = load(job_id)
+            if job is None:
+                print("qstat: Unknown Job Id " + job_id, file=sys.stderr)
+                continue
+            print("Job Id: %s.%s\n    job_state = %s" % (job['id'], HOST, job['state']))
+            if job['state'] == 'C':
+                print("    exit_status = %d" % job['exit_status'])
+    elif cmd in ('qdel', 'scancel'):
+        for job_id in args:
+            cancel(job_id)
+    elif cmd == 'sbatch':
+        args = [a for a in args if a != '--parsable']
+        print(submit(args[-1], _afterok(_option(args, '--dependency'))))
+    elif cmd == 'squeue':
+        for job_id in (_option(args, '-j') or '').split(','):
+            job = load(job_id)
+            if job is not None and job['state'] != 'C':
+                print(job['id'], SLURM_STATES[job['state']])
+    elif cmd == 'sacct':
+        for job_id in (_option(args, '-j') or '').split(','):
+            job = load(job_id)
+            if job is not None and job['state'] == 'C':
+                state = {0: 'COMPLETED', 271: 'CANCELLED'}.get(job['exit_status'], 'FAILED')
+                print('%s|%s' % (job['id'], state))
+    else:
+        print("Unknown command: " + cmd, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
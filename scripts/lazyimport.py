@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Deferred imports of heavy modules (scipy, serpentTools, matplotlib),
+so that deck generation scripts start fast and headless analysis never loads plotting.
+
+# Example usage:
+from lazyimport import LazyModule
+plt = LazyModule('matplotlib.pyplot')   # Imported on the first plt.something
+'''
+
+import importlib
+
+
+class LazyModule(object):
+    '''Module proxy that imports the module on first attribute access.
+    setup(module) is called once after the import.'''
+    def __init__(self, name:str, setup=None):
+        self._name   = name     # Full module name
+        self._setup  = setup    # Called with the module after import
+        self._module = None     # Module, once imported
+
+    def __repr__(self):
+        return "LazyModule: %s, %s" % (self._name, "imported" if self._module else "not imported")
+
+    def _load(self):
+        'Imports the module'
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._setup is not None:
+                self._setup(module)
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attr:str):
+        return getattr(self._load(), attr)
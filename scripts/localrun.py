@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Local execution of Serpent jobs on a workstation or a single big node.
+
+LocalRunner runs at most total_cores // ompcores jobs at a time, each in its own
+working directory, without changing the working directory of the Python process.
+Output of every job goes to stdout/stderr files in its directory, exit codes are kept.
+Jobs can have a timeout and can be cancelled, queued or running.
+
+# Example usage:
+import msfr, localrun
+runner = localrun.LocalRunner(ompcores=8)        # All cores of this box, 8 per job
+for r in [121, 122, 123]:
+    mycore = msfr.MSFR(r, r + 400.0, 0.1975, "66.66%NaCl+33.34%UCl3")
+    mycore.queue        = 'local'
+    mycore.ompcores     = 8
+    mycore.local_runner = runner    # run_deck() returns right away, job in mycore.job
+    mycore.deck_path    = "/tmp/small_core/%06.1f" % r
+    mycore.qsub_file    = mycore.deck_path + "/run.sh"
+    mycore.save_qsub_file()
+    mycore.save_deck()
+    mycore.run_deck()
+runner.wait()
+'''
+
+import os
+import time
+import signal
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+JOB_STATES = ['queued', 'running', 'done', 'failed', 'timeout', 'cancelled']
+
+
+class LocalJob(object):
+    '''Job handle: command run in a working directory'''
+    def __init__(self, command, cwd:str, name:str=None, timeout:float=None, env:dict=None, after:list=None):
+        self.command          = command     # Command list, or a shell command string
+        self.cwd:str          = cwd         # Working directory
+        self.name:str         = name or os.path.basename(os.path.normpath(cwd))
+        self.timeout:float    = timeout     # Wall time limit [s], None for no limit
+        self.env:dict         = env         # Extra environment variables
+        self.after:list       = after or [] # Jobs that have to succeed before this one starts
+        self.state:str        = 'queued'    # One of JOB_STATES
+        self.returncode:int   = None        # Exit code, negative is the signal that killed the job
+        self.stdout_file:str  = os.path.join(cwd, self.name + '.stdout')
+        self.stderr_file:str  = os.path.join(cwd, self.name + '.stderr')
+        self.start_time:float = None
+        self.end_time:float   = None
+        self.proc             = None        # subprocess.Popen while running
+        self.future           = None        # Future of the runner pool
+        self.cancelled:bool   = False
+
+    def __repr__(self):
+        return "LocalJob %s: %s, exit code %s" % (self.name, self.state, self.returncode)
+
+    def done(self) -> bool:
+        'Whether the job has ended, one way or another'
+        return self.state in ['done', 'failed', 'timeout', 'cancelled']
+
+    def wait(self, timeout:float=None) -> str:
+        'Waits for the job to end, returns its state'
+        if self.future is not None:
+            try:
+                self.future.exception(timeout)
+            except CancelledError:
+                pass
+        return self.state
+
+    def walltime(self) -> float:
+        'Run time [s], so far if running'
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.time()) - self.start_time
+
+    def _read(self, fname:str) -> str:
+        try:
+            with open(fname) as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    @property
+    def stdout(self) -> str:
+        'Captured standard output'
+        return self._read(self.stdout_file)
+
+    @property
+    def stderr(self) -> str:
+        'Captured standard error'
+        return self._read(self.stderr_file)
+
+
+class LocalRunner(object):
+    '''Bounded pool of local jobs'''
+    def __init__(self, total_cores:int=None, ompcores:int=16):
+        self.total_cores:int = total_cores or os.cpu_count()   # Cores to use
+        self.ompcores:int    = ompcores     # OMP threads per job
+        self.max_jobs:int    = max(1, self.total_cores // ompcores)  # Concurrent jobs
+        self.jobs:list       = []           # All submitted jobs
+        self.lock            = threading.Lock()
+        self.pool            = ThreadPoolExecutor(self.max_jobs, thread_name_prefix='localrun')
+
+    def __repr__(self):
+        states = [j.state for j in self.jobs]
+        return "LocalRunner: %d jobs at a time, " % self.max_jobs + \
+            ", ".join("%d %s" % (states.count(s), s) for s in JOB_STATES if s in states)
+
+    def submit(self, command, cwd:str, name:str=None, timeout:float=None, env:dict=None,
+               after:list=None) -> LocalJob:
+        '''Queues command to run in directory cwd, returns the job handle.
+        With after, the job runs only if all these earlier jobs succeed, it is cancelled otherwise.'''
+        if not os.path.isdir(cwd):
+            raise ValueError("Job directory does not exist: ", cwd)
+        job = LocalJob(command, cwd, name, timeout, env, after)
+        with self.lock:
+            self.jobs.append(job)
+            job.future = self.pool.submit(self._run, job)
+        return job
+
+    def _run(self, job:LocalJob):
+        'Pool thread: runs one job to its end'
+        env = dict(os.environ, OMP_NUM_THREADS=str(self.ompcores), PBS_O_WORKDIR=job.cwd)
+        env.update(job.env or {})
+        for dep in job.after:       # Submitted earlier, so ahead in the queue
+            if dep.wait() != 'done':
+                job.cancelled = True
+        with self.lock:
+            if job.cancelled:
+                job.state = 'cancelled'
+                return
+            job.state = 'running'
+            job.start_time = time.time()
+            with open(job.stdout_file, 'w') as out, open(job.stderr_file, 'w') as err:
+                job.proc = subprocess.Popen(job.command, cwd=job.cwd, env=env, stdout=out, stderr=err,
+                    shell=isinstance(job.command, str), start_new_session=True)
+        try:
+            job.returncode = job.proc.wait(job.timeout)
+        except subprocess.TimeoutExpired:
+            self._kill(job.proc)
+            job.returncode = job.proc.wait()
+            job.state = 'timeout'
+        job.end_time = time.time()
+        if job.state == 'running':
+            if job.cancelled:
+                job.state = 'cancelled'
+            else:
+                job.state = 'done' if job.returncode == 0 else 'failed'
+        job.proc = None
+
+    def _kill(self, proc:subprocess.Popen):
+        'Kills the job process group, sss2 runs as a child of the run script'
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def cancel(self, job:LocalJob):
+        'Cancels a queued job, kills a running one'
+        with self.lock:
+            if job.done():
+                return
+            job.cancelled = True
+            if job.state == 'queued':
+                job.future.cancel()
+                job.state = 'cancelled'
+                return
+            proc = job.proc
+        if proc is not None:
+            self._kill(proc)
+
+    def cancel_all(self):
+        'Cancels all jobs that have not ended'
+        for job in list(self.jobs):
+            self.cancel(job)
+
+    def wait(self, jobs:list=None, timeout:float=None) -> list:
+        'Waits for the jobs to end, all submitted jobs by default, returns them'
+        jobs = self.jobs if jobs is None else jobs
+        deadline = None if timeout is None else time.time() + timeout
+        for job in list(jobs):
+            if job.state == 'cancelled':
+                continue
+            job.wait(None if deadline is None else max(0.0, deadline - time.time()))
+        return jobs
+
+    def shutdown(self, cancel:bool=False):
+        'Stops the runner, cancels pending jobs first if asked to'
+        if cancel:
+            self.cancel_all()
+        self.pool.shutdown(wait=True)
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a local job runner module.")
@@ -11,16 +11,30 @@ MSFR(MSFRbase) is a basic spherical MSFR, which can have a silver shell embedded
 
 AgWire(MSFRbase) describes trasmutation of a silver wire in a a depleted MSFR salt. The key issue is that the irraditing salt (the radiation source) has to be built manually for each depletion step. This is done at the end of method AgWire.wired_deck().
 
-liquidusNaClUCl3 is a helper function to obtain liquidus temperature of NaCl-UCl3 salt.
+With include_dir set, blocks that repeat across the decks of a campaign (salt, reflector materials,
+library cards, U_stock refuel material, depletion cards) are written once as content-hashed files
+in include_dir, and the decks reference them with Serpent include cards.
+
+liquidusNaClUCl3 is a helper function to obtain liquidus temperature of NaCl-UCl3 salt,
+liquidusNaClUCl3_range is its inverse, giving compositions that satisfy a liquidus margin.
 '''
 
 import os
 import math
-import re
-from scipy import interpolate
+import shlex
+import warnings
+import numpy as np
 from textwrap import dedent
-from salts import Salt
-import serpentTools
+from collections import OrderedDict
+from salts import Salt, get_salt
+import deckcache
+import localrun
+import xsindex
+import convergence
+import perftune
+from lazyimport import LazyModule
+interpolate  = LazyModule('scipy.interpolate')   # Only for the liquidus
+serpentTools = LazyModule('serpentTools')        # Only for AgWire.load_data
 
 do_plots = True
 my_debug = False
@@ -28,6 +42,30 @@ my_debug = False
 NUCLEAR_LIBRARIES = ['endf7','jeff33','endf8']
 
 
+class CoreSalt(object):
+    '''Fuel salt of a core. Reads go to the shared frozen salt of the core, MSFRbase.fuel_salt().
+    The deprecated set_chlorine_37Cl_fraction() sets the core cl37, as modifying the salt used to.'''
+    def __init__(self, core):
+        self._core = core
+
+    def __getattr__(self, name):
+        return getattr(self._core.fuel_salt(), name)
+
+    def __repr__(self):
+        return repr(self._core.fuel_salt())
+
+    def set_chlorine_37Cl_fraction(self, f:float):
+        'Deprecated, sets the Cl-37 fraction of the core, use core.cl37 instead'
+        if f<0 or f>1.0:
+            raise ValueError("Cl37 enrichment has to be 0-1: ", f)
+        warnings.warn("core.s.set_chlorine_37Cl_fraction() is deprecated, set core.cl37", DeprecationWarning, stacklevel=2)
+        self._core.cl37 = f
+        return self._core.fuel_salt()
+
+_INCLUDE_CARDS = OrderedDict()     # (include_dir, name, text hash): (file, mtime) written, least recently used first
+INCLUDE_CARDS_MAX = 256            # Maximum number of remembered include files
+
+
 class MSFRbase(object):
     '''Common base class for the MSFR project'''
     def __init__(self):
@@ -48,6 +86,48 @@ class MSFRbase(object):
         self.deck_path:str = '/tmp'     # Where to run the Serpent deck
         self.nuc_libs:str  = 'jeff33'   # Nuclear data libraries
         self.qsub_file:str = os.path.expanduser('~/') + '/run.sh'  # qsub script path
+        self.comp_store    = None       # compstore.CompositionStore with prebuilt compositions
+        self.deck_cache    = None       # deckcache.DeckCache, identical decks are run once
+        self.cache_owner:dict = None    # Cache record of the run that owns this deck
+        self.local_runner  = None       # localrun.LocalRunner for concurrent local runs
+        self.job           = None       # Handle of the last job run_deck started
+        self.qsub_chain:bool = False    # qsub_file submits a chain of jobs, see save_qsub_chain
+        self.chain_files:list = []      # Job scripts of the chain, in order
+        self.scheduler     = None       # schedulers.Scheduler backend, None for TORQUE via qsub
+        self.include_dir:str = None     # Shared include files of a campaign, None for self-contained decks
+        self.validate:bool = False      # Check decks against the nuclear data index before running
+        self.cycles:int    = 240        # Active criticality cycles
+        self.inactive:int  = 40         # Inactive criticality cycles, from a flat source
+        self.save_source:bool = False   # Save the converged fission source into source_file()
+        self.warm_source:str = None     # Saved fission source of a neighbour run to start from
+        self.warm_inactive:int = 10     # Inactive cycles when starting from warm_source
+        self.entropy:bool  = False      # Cycle-wise Shannon entropy of the fission source in the history file
+        self.entropy_bins:int = 10      # Entropy mesh bins along each axis
+        self.keff_sigma:float = None    # Target k_eff standard deviation, sizes active cycles in size_cycles
+        self.perf_tune:bool = False     # Performance options sized to the problem, job memory request
+        self.node_memory_gb:float = 256.0  # Memory of a compute node [GB]
+        self.nodes:int     = 1          # Compute nodes of a run
+        self.mpi_tasks:int = 1          # MPI tasks per node, each runs ompcores OMP threads
+        self.mpirun:str    = 'mpirun'   # MPI launcher, Open MPI options
+        self.seed:int      = None       # Random number seed, None for a clock based one; distinct for replicas
+        self.li7dep:float  = 0.99990    # Li-7 depletion level of lithium salts
+
+    def fuel_salt(self) -> Salt:
+        '''Fuel salt, a frozen composition shared through the salt cache.
+        Change salt_formula, enr, cl37, or li7dep instead of modifying it.'''
+        return get_salt(self.salt_formula, self.enr, self.cl37, self.li7dep, store=self.comp_store)
+
+    @property
+    def s(self):
+        'Fuel salt of the core, see CoreSalt'
+        return CoreSalt(self)
+
+    @s.setter
+    def s(self, salt:Salt):
+        self.salt_formula = salt.formula
+        self.enr          = salt.enr
+        self.cl37         = salt.Cl37enr
+        self.li7dep       = salt.Li7dep
 
     def rho_silver(self) -> float:
         # https://www.sciencedirect.com/science/article/abs/pii/0022190262801882
@@ -93,14 +173,292 @@ set declib "/opt/ENDFB-8.0/sss_endfb80.dec"
 set nfylib "/opt/ENDFB-8.0/sss_endfb80.nfy"
 '''
 
+    def source_file(self) -> str:
+        'Fission source file the run writes with save_source'
+        return os.path.join(self.deck_path, self.deck_name + '.src')
+
+    def inactive_cycles(self) -> int:
+        'Inactive cycles, fewer if the run starts from a converged source'
+        return self.warm_inactive if self.warm_source else self.inactive
+
+    def source_cards(self) -> str:
+        'Cards that save the converged fission source, and read the initial one'
+        cards = ''
+        if self.save_source:
+            cards += f'''
+% Save the converged fission source for warm starts
+set savesrc "{self.deck_name}.src"
+'''
+        if self.warm_source:
+            cards += f'''
+% Initial fission source from a converged neighbour run
+src warm sf "{os.path.abspath(self.warm_source)}" 1
+'''
+        return cards
+
+    def seed_cards(self) -> str:
+        'Random number seed card, empty without a seed'
+        if self.seed is None:
+            return ''
+        return f'''
+% Random number seed
+set seed {self.seed}
+'''
+
+    def problem_size(self, sections:list=None) -> dict:
+        'Size of the deck, see perftune.problem_size'
+        if sections is None:
+            sections = self.deck_sections()
+        return perftune.problem_size(''.join(sections), self.histories, self.ompcores, self.deck_path)
+
+    def perf_cards(self, sections:list) -> str:
+        'Performance options tuned to the deck made of sections'
+        size = self.problem_size(sections)
+        return perftune.cards(perftune.tune(size, self.task_memory_gb()), size)
+
+    def task_memory_gb(self) -> float:
+        'Node memory available to one MPI task'
+        return self.node_memory_gb / self.mpi_tasks
+
+    def memory_request(self) -> int:
+        '''Memory request [GB] of one MPI task from the estimated Serpent memory, None without perf_tune.
+        Every MPI task holds its own copy of the data.'''
+        if not self.perf_tune:
+            return None
+        return perftune.memory_request_gb(perftune.tune(self.problem_size(), self.task_memory_gb()))
+
+    def pbs_mem(self) -> str:
+        'Memory resource for the TORQUE nodes request, the whole job, empty without perf_tune'
+        mem = self.memory_request()
+        return '' if mem is None else ',mem=%dgb' % (mem * self.nodes * self.mpi_tasks)
+
+    def pbs_resources(self) -> str:
+        'TORQUE nodes request: nodes, cores per node for all MPI tasks and their OMP threads'
+        return f'nodes={self.nodes}:ppn={self.mpi_tasks * self.ompcores}' + self.pbs_mem()
+
+    def total_cores(self) -> int:
+        'Cores of a run over all nodes'
+        return self.nodes * self.mpi_tasks * self.ompcores
+
+    def serpent_command(self, deck:str, out:str) -> str:
+        'Command line that runs Serpent on deck, through mpirun with more than one MPI task'
+        run = f'sss2 -omp {self.ompcores} {deck} > {out}'
+        ranks = self.nodes * self.mpi_tasks
+        if ranks == 1:
+            return run
+        return (f'{self.mpirun} -np {ranks} --map-by ppr:{self.mpi_tasks}:node:pe={self.ompcores} '
+                f'-x OMP_NUM_THREADS={self.ompcores} ' + run)
+
+    def entropy_cards(self) -> str:
+        '''Cards for the source entropy in the history file, on the mesh over source_box(),
+        the fuel salt bounding box (xmin, xmax, ymin, ymax, zmin, zmax) of criticality cores'''
+        if not self.entropy:
+            return ''
+        n = self.entropy_bins
+        box = ' '.join('%g' % x for x in self.source_box())
+        return f'''
+% Shannon entropy of the fission source, cycle-wise in the history file
+set his 1
+set entr {n} {n} {n} {box}
+'''
+
+    def his_file(self) -> str:
+        'Serpent history file of the deck'
+        return os.path.join(self.deck_path, self.deck_name + '_his0.m')
+
+    def size_cycles(self, run_path:str):
+        '''Sets inactive cycles from the source entropy of a finished run of a similar deck
+        in run_path (a pilot or a neighbour), and active cycles from it and keff_sigma if set'''
+        sizes = convergence.size_run(os.path.join(run_path, self.deck_name + '_his0.m'),
+                                     os.path.join(run_path, self.deck_name + '_res.m'), self.keff_sigma)
+        self.inactive = sizes['inactive']
+        self.warm_inactive = min(self.warm_inactive, self.inactive)
+        if sizes['active'] is not None:
+            self.cycles = sizes['active']
+
+    def check_convergence(self) -> dict:
+        'Checks the finished run of the deck, see convergence.check_run, prints problems found'
+        result = convergence.check_run(self.his_file(), os.path.join(self.deck_path, self.deck_name + '_res.m'),
+                                       self.keff_sigma)
+        for problem in result['problems']:
+            print("[WARNING] Not converged", self.deck_path, problem)
+        return result
+
+    def xs_index(self) -> xsindex.NuclideIndex:
+        'Index of the nuclear data libraries of lib_deck, None if they are not on this machine'
+        paths = xsindex.library_paths(self.lib_deck())
+        try:
+            return xsindex.get_index(paths['acelib'], paths.get('declib'))
+        except IOError:
+            return None
+
+    def deck_files(self) -> list:
+        'Serpent input files that the run script runs'
+        return [os.path.join(self.deck_path, self.deck_name)]
+
+    def check_deck(self):
+        'Checks the saved decks, raises ValueError listing the problems found'
+        index = self.xs_index()
+        problems = []
+        for fname in self.deck_files():
+            try:
+                with open(fname) as f:
+                    text = f.read()
+            except IOError:
+                problems.append(fname + ': deck not found')
+                continue
+            problems += [fname + ': ' + p for p in xsindex.check_deck(text, index, os.path.dirname(fname))]
+        if problems:
+            raise ValueError("Deck check failed:\n" + "\n".join(problems))
+
+    def include_section(self, name:str, text:str) -> str:
+        '''With include_dir set, writes the deck block text once into a content-hashed
+        include file there and returns the Serpent include card, otherwise returns text.
+        The block has to consist of whole cards, Serpent cards do not continue across files.'''
+        if self.include_dir is None:
+            return text
+        sha1 = deckcache.text_sha1(text)
+        key = (self.include_dir, name, sha1)
+        fname = os.path.join(os.path.abspath(self.include_dir), '%s-%s.inc' % (name, sha1[:16]))
+        try:
+            mtime = os.stat(fname).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if _INCLUDE_CARDS.get(key) == (fname, mtime):
+            _INCLUDE_CARDS.move_to_end(key)
+        else:                   # Written once per campaign, atomically, again if removed or changed since
+            if mtime is None or deckcache.file_sha1(fname) != sha1:
+                os.makedirs(os.path.dirname(fname), exist_ok=True)
+                tmp = fname + '.%d.tmp' % os.getpid()
+                with open(tmp, 'w') as f:
+                    f.write(text)
+                os.replace(tmp, fname)
+            _INCLUDE_CARDS[key] = (fname, os.stat(fname).st_mtime_ns)
+            if len(_INCLUDE_CARDS) > INCLUDE_CARDS_MAX:
+                _INCLUDE_CARDS.popitem(last=False)
+        return 'include "%s"\n' % fname
+
+    def cache_deck(self, sections:list):
+        '''Registers the saved deck with deck_cache. If an identical deck
+        has finished already, its results are linked into deck_path.'''
+        deck_file = os.path.abspath(os.path.join(self.deck_path, self.deck_name))
+        key = deckcache.deck_key(sections, self.histories, self.ompcores, self.nuc_libs)
+        self.cache_owner = self.deck_cache.claim(key, deck_file, deckcache.text_sha1(''.join(sections)))
+        if self.cache_owner['deck_file'] != deck_file and self.deck_cache.is_finished(self.cache_owner):
+            self.deck_cache.link_results(self.cache_owner, deck_file)
+
+    def cached_run(self) -> bool:
+        '''True if the deck does not need to run: an identical deck
+        has run or is running, or this deck has finished already'''
+        if self.deck_cache is None or self.cache_owner is None:
+            return False
+        deck_file = os.path.abspath(os.path.join(self.deck_path, self.deck_name))
+        return self.cache_owner['deck_file'] != deck_file or self.deck_cache.is_finished(self.cache_owner)
+
     def run_deck(self):
         'Runs the deck using qsub_file script'
-        if self.queue == 'local':    # Run the deck locally
-            os.chdir(self.deck_path)
-            os.system(self.qsub_file)
+        if self.cached_run():
+            print("[cache] Not running ", self.deck_path, ", same deck as ", self.cache_owner['deck_file'])
+            return
+        if self.validate:
+            self.check_deck()
+        if self.scheduler is not None and self.qsub_chain:   # Chain through the backend, job is the last one
+            self.job = None
+            for fname in self.chain_files:
+                self.job = self.scheduler.submit(os.path.abspath(fname), self.deck_path,
+                    os.path.basename(fname)[:-3], after=[self.job] if self.job is not None else None)
+        elif self.scheduler is not None:    # Submit through the backend
+            self.job = self.scheduler.submit(os.path.abspath(self.qsub_file), self.deck_path, self.deck_name,
+                result_file=os.path.join(self.deck_path, self.deck_name + '_res.m'))
+        elif self.queue == 'local':    # Run the deck locally
+            if self.local_runner is None:   # One job at a time, wait for it
+                runner = localrun.LocalRunner(self.ompcores, self.ompcores)
+                self.job = runner.submit(['bash', self.qsub_file], self.deck_path)
+                runner.shutdown()
+            else:
+                self.job = self.local_runner.submit(['bash', self.qsub_file], self.deck_path)
+        elif self.qsub_chain:   # Submit the job chain on the cluster
+            os.system('cd ' + self.deck_path + ' && bash ' + self.qsub_file)
         else:               # Submit the job on the cluster
             os.system('cd ' + self.deck_path + ' && qsub ' + self.qsub_file)
 
+    def qsub_array_content(self, deck_paths:list, job_name:str='MSFR_S2', max_running:int=None) -> str:
+        '''TORQUE job array script, array job i runs deck_name in deck_paths[i].
+        max_running limits how many array jobs run at the same time.'''
+        if not deck_paths:
+            raise ValueError("Job array needs at least one deck path")
+        limit = '' if max_running is None else '%%%d' % max_running
+        paths = '\n'.join(shlex.quote(os.path.abspath(p)) for p in deck_paths)
+        return f'''#!/bin/bash
+#PBS -V
+#PBS -N {job_name}
+#PBS -q {self.queue}
+#PBS -l {self.pbs_resources()}
+#PBS -t 0-{len(deck_paths) - 1}{limit}
+
+DECK_PATHS=(
+{paths}
+)
+
+hostname
+cd "${{DECK_PATHS[$PBS_ARRAYID]}}" || exit 1
+rm -f done.dat
+module load mpi
+module load serpent
+
+{self.serpent_command(self.deck_name, 'myout.out')} && \\
+awk 'BEGIN{{ORS="\\t"}} /ANA_KEFF/ || /CONVERSION/ {{print $7" "$8;}}' {self.deck_name}_res.m > done.out
+'''
+
+    def save_qsub_chain(self, commands:list, job_name:str):
+        '''Writes one TORQUE job per command, and qsub_file that submits them from deck_path
+        as a chain: each job starts only after the previous one has finished successfully.
+        For the local queue, qsub_file runs the commands one after another instead.
+        With a scheduler backend, the jobs have its headers and run_deck submits the chain through it.'''
+        stem = self.qsub_file[:-3] if self.qsub_file.endswith('.sh') else self.qsub_file
+        step_files = []
+        try:
+            for (i, command) in enumerate(commands, 1):
+                step_files.append(f'{stem}-{i:03d}.sh')
+                if self.scheduler is not None:
+                    header = self.scheduler.header(f'{job_name}-{i:03d}', self.queue, self.ompcores,
+                                                   self.memory_request(), self.nodes, self.mpi_tasks)
+                    workdir = self.scheduler.workdir_var
+                else:
+                    header = f'''#!/bin/bash
+#PBS -V
+#PBS -N {job_name}-{i:03d}
+#PBS -q {self.queue}
+#PBS -l {self.pbs_resources()}
+'''
+                    workdir = '${PBS_O_WORKDIR}'
+                with open(step_files[-1], 'w') as f:
+                    f.write(header + f'''
+hostname
+cd {workdir}
+module load mpi
+module load serpent
+
+{command}
+''')
+            with open(self.qsub_file, 'w') as f:
+                f.write(f'#!/bin/bash\n# Chain of {len(commands)} jobs, each runs after the previous one succeeds\n')
+                f.write('cd %s || exit 1\n' % shlex.quote(os.path.abspath(self.deck_path)))
+                if self.queue == 'local':
+                    f.write('export PBS_O_WORKDIR=$(pwd)\n')
+                    f.write(' && \\\n'.join('bash ' + shlex.quote(fname) for fname in step_files) + '\n')
+                else:
+                    f.write('JOB=$(qsub %s) || exit 1\n' % shlex.quote(step_files[0]))
+                    for fname in step_files[1:]:
+                        f.write('JOB=$(qsub -W depend=afterok:$JOB %s) || exit 1\n' % shlex.quote(fname))
+                    f.write('echo $JOB\n')
+        except IOError as e:
+            print("Unable to write to qsub file", self.qsub_file)
+            print(e)
+            return
+        self.chain_files = step_files
+        self.qsub_chain = True
+
 
 AGWIRE_CASES = ['fully-submerged', 'half-submerged']
 
@@ -131,9 +489,19 @@ w.save_qsub_file()     '''
 
     def load_data(self):
         '''Open the depletion file and load the fuel data. Make sure that data path and names are
-        set correctly in the parent class'''
-        self.dep = serpentTools.read(self.deck_path + '/' + self.deck_name + '_dep.m')
+        set correctly in the parent class. With comp_store set, the fuel composition
+        is read from the store if there, and saved to it otherwise. The store key has
+        the size and modification time of the depletion file, a re-run depletion is read again.'''
+        dep_file = os.path.abspath(self.deck_path + '/' + self.deck_name + '_dep.m')
+        stat = os.stat(dep_file)
+        store_key = 'dep:%s:%d:%d:fuelsalt' % (dep_file, stat.st_size, stat.st_mtime_ns)
+        if self.comp_store is not None and store_key in self.comp_store:
+            self.fuel = self.comp_store.load_material(store_key)
+            return
+        self.dep = serpentTools.read(dep_file)
         self.fuel = self.dep.materials['fuelsalt']
+        if self.comp_store is not None:
+            self.comp_store.save_material(store_key, self.fuel)
 
     def volume_wire(self) -> float:
         '''Calculates the wire volume'''
@@ -151,6 +519,8 @@ w.save_qsub_file()     '''
         '''Returns wire-in-salt Serpent input deck for a particular burnup step calculation'''
         if(step < 1):
             return 'Error: step has to be >= 1, value passed: ' + str(step)
+        if self.entropy:
+            raise ValueError("Wire decks are decay source runs, no fission source entropy")
         prevstep = step - 1
         day      = self.fuel.days[step]
         prevday  = self.fuel.days[prevstep]
@@ -194,7 +564,7 @@ set mvol fuel     0  {self.volume_fuel()}
 set mvol silver   0  {self.volume_wire()}
 set mvol r-silver 0  {self.volume_fuel()}
 '''
-        output += self.lib_deck()
+        output += self.include_section('lib', self.lib_deck())
 
         if self.nfg is not None:
             output += f'''
@@ -238,26 +608,32 @@ mat fuel sum fix "{self.lib}" {self.tempK} rgb 50 210 50
         # Write material composition for the burned salt fuel
         # (this acts as a neutron source for the simulation)
         #
+        index = self.xs_index()     # Which nuclides have cross sections, if the library is here
         iso_has_xs:bool = True
         prevzai:int = 0
-        m_offset:int = 400  # isomer offset for ZA.id
         for zai in self.fuel.zai:
             if zai == 0:    # total
                 continue
             if zai == 666:  # lost
                 continue
-            if zai < prevzai:   # once the ZADs stop increasing, nuclides without cross sections follow
+            if index is not None:
+                iso_has_xs = index.has_xs(zai, self.lib)
+            elif zai < prevzai: # once the ZADs stop increasing, nuclides without cross sections follow
                 iso_has_xs = False
-            atomdensity = float(self.fuel.getValues('days', 'adens', [day], zai=zai))
+            atomdensity = self.fuel.getValues('days', 'adens', [day], zai=zai)[0,0]
             prevzai = zai
             if iso_has_xs:  # isotopes with xs data: <ZZAAA with isome offset> . library
-                isoID = str(zai//10 + m_offset*(zai%10)) + "." + self.lib
+                isoID = xsindex.NuclideIndex.xs_name(zai, self.lib)
             else:           # isotopes without xs data: ZAI
                 isoID = str(zai)
             if atomdensity: # skip 0 atom densities
                 output += f'{isoID}    {atomdensity}\n'
         return output
 
+    def deck_files(self) -> list:
+        'Wire depletion step decks'
+        return [f'{self.deck_path}/{self.wdeck_name}-{step:03d}' for step in range(1, len(self.fuel.days))]
+
     def save_decks(self):
         '''Writes input wire depletion to respective files'''
         for step in range(1, len(self.fuel.days)):
@@ -270,31 +646,43 @@ mat fuel sum fix "{self.lib}" {self.tempK} rgb 50 210 50
                 print("Unable to write to file", fname)
                 print(e)
 
-    def save_qsub_file(self):
+    def save_qsub_file(self, chain:bool=False):
         '''Writes a qsub job submission file to run all steps.
-        The depletion steps have to be run consecutively.'''
-        try:                # Write the script
-            frun = open(self.qsub_file, 'w')
-            frun.write(f'''#!/bin/bash
+        The depletion steps have to be run consecutively: in one job,
+        or with chain as one job per step, each waiting for the previous one.'''
+        if chain:
+            self.save_qsub_chain([self.serpent_command(f'{self.wdeck_name}-{step:03d}', f'myout_{step:03d}.out')
+                                  for step in range(1, len(self.fuel.days))], 'S2-wire')
+            return
+        if self.scheduler is not None:
+            header = self.scheduler.header('S2-wire', self.queue, self.ompcores, self.memory_request(),
+                                           self.nodes, self.mpi_tasks)
+            workdir = self.scheduler.workdir_var
+        else:
+            header = f'''#!/bin/bash
 #PBS -V
 #PBS -N S2-wire
 #PBS -q {self.queue}
-#PBS -l nodes=1:ppn={self.ompcores}
-
+#PBS -l {self.pbs_resources()}
+'''
+            workdir = '${PBS_O_WORKDIR}'
+        qsub_content = header + f'''
 hostname
 rm -f donewire.dat
-cd ${{PBS_O_WORKDIR}}
+cd {workdir}
 module load mpi
 module load serpent
-''')
+'''
+        for step in range(1, len(self.fuel.days)):
+            qsub_content += '\n' + self.serpent_command(f'{self.wdeck_name}-{step:03d}', f'myout_{step:03d}.out')
+        try:                # Write the script
+            with open(self.qsub_file, 'w') as frun:
+                frun.write(qsub_content + '\n')
         except IOError as e:
-            print("Unable to write to file", fname)
+            print("Unable to write to file", self.qsub_file)
             print(e)
-        for step in range(1, len(self.fuel.days)):
-            frun.write(f'''
-sss2 -omp {self.ompcores} {self.wdeck_name}-{step:03d} > myout_{step:03d}.out''')
-        frun.write('\n')
-        frun.close()
+            return
+        self.qsub_chain = False
 
 
 class MSFR(MSFRbase):
@@ -318,57 +706,47 @@ mycore.save_deck()
         self.refl_lib          = '06c'  # Reflector nuclear data library
         self.refl_tempK        = 873.0  # Reflector temperature [K]
         self.salt_formula:str  = salt   # Salt formula
+        self.enr:float         = e      # Uranium enrichment
+        self.cl37:float        = 0.99999 # Enriched chlorine-37
         self.refuel_flow:float = 0.0    # wt_fraction/s refuel flow
         self.silver_at_r:float = Ag_r   # Where to put silver semi-shpere [cm]
         self.silver_d:float    = 0.05   # Thickness of silver semi-sphere [cm]
-        self.s             = Salt(self.salt_formula, e) # Salt used
-        self.s.set_chlorine_37Cl_fraction(0.99999)      # Enriched chlorine-37
 
     def salt_volume(self) -> float:
         '''Get salt volume, twice the fuel sphere volume'''
         V = (4.0/3.0) * math.pi * self.r**3
         return 2.0 * V
 
-    def get_cells(self) -> str:
-        'Cell cards for Serpent input deck'
-        cells = '''
+    def source_box(self) -> tuple:
+        'Bounding box of the fuel salt sphere'
+        return (-self.r, self.r, -self.r, self.r, -self.r, self.r)
+
+    # Deck templates, formatted once per deck section
+    TITLE_TPL = 'set title "sphMCFR radius {self.r}, reflector {self.refl}"\n'
+    CELLS = '''
 %______________cell definitions_____________________________________
 cell 11  0  fuelsalt  -1      % fuel salt
 cell 31  0  refl       1 -2   % reflector'''
-        if self.silver_at_r <= self.r:
-            cells += '''
+    CELLS_NO_SILVER = CELLS + '''
 cell 99  0  outside    2      % graveyard
 '''
-        else:
-            cells += '''
+    CELLS_SILVER = CELLS + '''
 cell 20  0  silver     2 -3   % silver
 cell 32  0  refl       3 -4   % reflector
 cell 99  0  outside    4      % graveyard
 '''
-        return cells.format(**locals())
-
-    def get_surfaces(self) -> str:
-        'Surface cards for Serpent input deck'
-        surfaces = '''
+    SURFACES_TPL = '''
 %______________surface definitions__________________________________
 surf 1   sph  0.0 0.0 0.0 {self.r}      % fuel salt radius'''
-        if self.silver_at_r <= self.r:
-            surfaces += '''
+    SURFACES_NO_SILVER_TPL = SURFACES_TPL + '''
 surf 2   sph  0.0 0.0 0.0 {self.refl}   % reflector
 '''
-        else:
-            silver_r_max = self.silver_at_r + self.silver_d
-            surfaces += '''
+    SURFACES_SILVER_TPL = SURFACES_TPL + '''
 surf 2   sph  0.0 0.0 0.0 {self.silver_at_r}   % reflector
 surf 3   sph  0.0 0.0 0.0 {silver_r_max}       % silver
 surf 4   sph  0.0 0.0 0.0 {self.refl}   % reflector
 '''
-        return surfaces.format(**locals())
-
-    def get_materials(self) -> str:
-        'Material definitions, non-salt'
-        refl_lib  = self.refl_lib
-        materials = '''
+    MATERIALS_TPL = '''
 % Cast iron reflector
 mat refl   -7.034 tmp {self.refl_tempK} rgb 128 128 178
   6000.{refl_lib} -0.034000
@@ -395,20 +773,7 @@ mat refl   -7.034 tmp {self.refl_tempK} rgb 128 128 178
 %26057.{refl_lib}  -0.021190   %  Fe
 %26058.{refl_lib}  -0.002820   %  Fe
 '''
-
-        if self.silver_at_r > 0.0 and self.silver_at_r <= self.r:
-            raise ValueError('Silver shell inside fuel ', self.silver_at_r, self.r)
-        if self.silver_at_r >= self.refl:
-            raise ValueError('Silver shell outside reflector ', self.silver_at_r, self.refl)
-        if self.silver_at_r > self.r and self.silver_at_r < self.refl:
-            materials += self.matdeck_silver()
-
-        return materials.format(**locals())
-
-    def get_data_cards(self) -> str:
-        'Data cards for the reactor'
-        fs_volume = self.salt_volume()
-        data_cards = '''
+    DATA_CARDS_TPL = '''
 % Fuel salt volume
 set mvol fuelsalt 0 {fs_volume}
 
@@ -422,49 +787,31 @@ set bc 1
 % set arr 2
 
 % Neutron population and criticality cycles
-set pop {self.histories} 240 40
+set pop {self.histories} {self.cycles} {inactive}
 
 '''
-        if self.silver_at_r > self.r and self.silver_at_r < self.refl:
-            data_cards += '''
+    SILVER_DETECTOR = '''
 % Flux in silver shell
 det silverflux de fluxgrid dm silver
 ene fluxgrid 3 500 1e-11 2e1
 
 '''
-        if self.nfg is not None:
-            data_cards += f'''
+    NFG_TPL = '''
 % Use group structure for group constant generation
 set micro {self.nfg}
 set nfg {self.nfg}
 '''
-        else:
-            data_cards += f'''
+    NO_GC = '''
 % Turning off group constant generation hastens the calculation
 set gcu -1
 '''
-        data_cards += self.lib_deck()
-
-        if do_plots:
-            data_cards += '''
+    PLOTS = '''
 % Plots
 plot 3 1500 1500
 % mesh 3 1500 1500
 '''
-        return data_cards.format(**locals())
-
-    def get_repr_cards(self) -> str:
-        'Reprocessing setup'
-        refuel_lib = self.lib   # First, build refuel stream using the same material as fuel
-        refuel_tmp   = self.s.serpent_mat(self.tempK) # Same as fresh fuel
-        refuel_split = refuel_tmp.split('\n')
-        refuel_rho   = re.search(r'-[0-9.]+', refuel_split[1]).group()
-        if float(refuel_rho) > -1.0:     # Sanity check
-            raise ValueError('Refuel density problem, ',refuel_rho)
-        refuel_volume = self.salt_volume()
-        refuel  = 'mat U_stock {refuel_rho} burn 1 vol {refuel_volume} tmp {self.tempK}\n'.format(**locals())
-        refuel += '\n'.join(refuel_split[2:])   # Add isotopic density list
-        repr_cards = '''
+    U_STOCK_TPL = 'mat U_stock {refuel_rho} burn 1 vol {refuel_volume} tmp {self.tempK}\n'
+    REPR_CARDS_TPL = '''
 %___________Reprocessing___________
 % First we need some extra materials to do depletion with reprocessing correctly.
 
@@ -508,31 +855,19 @@ rc U_stock fuelsalt U_in 0
 rc fuelsalt offgastankcore offgasratecore 1
 rc fuelsalt overflow over 1
 '''
-        return repr_cards.format(**locals())
-
-    def get_depl_cards(self) -> str:
-        'Depletion data setup'
-        depl_cards = '''
+    DEPL_CARDS = '''
 % Depletion cards
 set inventory all
 dep
 pro source_rep
 daystep
 '''
-        return depl_cards.format(**locals())
-
-    def get_depl_1st_year(self) -> str:
-        '1st year of depletion in daysteps'
-        depl_1st_year ='''\
+    DEPL_1ST_YEAR = '''\
 0.05 0.15 0.3 0.5   % 1 day
 1 2 3               % 1 week
 7 7 7 14 14 14 14 28 28 28 28 42 42 42 44  % 1 year, 366 days
 '''
-        return depl_1st_year.format(**locals())
-
-    def get_depl_add_9years(self) -> str:
-        'Add 9 years in daysteps'
-        depl_add_9years = '''\
+    DEPL_ADD_9YEARS = '''\
 52 52 52 52 52 52 53    % 365
 52 52 52 52 52 52 53    % 365
 52 52 52 52 52 52 54    % 366
@@ -543,36 +878,139 @@ daystep
 52 52 52 52 52 52 53    % 365
 52 52 52 52 52 52 53    % 365
 '''
-        return depl_add_9years.format(**locals())
-
-    def get_depl_add_10years(self) -> str:
-        'Add 10 years in daysteps'
-        depl_add_10years = '''\
+    DEPL_ADD_10YEARS = '''\
 120 120 126 120 120 125 120 120 125 120 120 125
 120 120 126 120 120 125 120 120 125 120 120 125
 120 120 126 120 120 125
 '''
-        return depl_add_10years.format(**locals())
 
-    def save_deck(self):
-        'Saves Serpent deck into an input file'
+    def get_cells(self) -> str:
+        'Cell cards for Serpent input deck'
+        if self.silver_at_r <= self.r:
+            return self.CELLS_NO_SILVER
+        return self.CELLS_SILVER
+
+    def get_surfaces(self) -> str:
+        'Surface cards for Serpent input deck'
+        if self.silver_at_r <= self.r:
+            return self.SURFACES_NO_SILVER_TPL.format(self=self)
+        silver_r_max = self.silver_at_r + self.silver_d
+        return self.SURFACES_SILVER_TPL.format(self=self, silver_r_max=silver_r_max)
+
+    def get_materials(self) -> str:
+        'Material definitions, non-salt'
+        materials = self.MATERIALS_TPL.format(self=self, refl_lib=self.refl_lib)
+        if self.silver_at_r > 0.0 and self.silver_at_r <= self.r:
+            raise ValueError('Silver shell inside fuel ', self.silver_at_r, self.r)
+        if self.silver_at_r >= self.refl:
+            raise ValueError('Silver shell outside reflector ', self.silver_at_r, self.refl)
+        if self.silver_at_r > self.r and self.silver_at_r < self.refl:
+            materials += self.matdeck_silver()
+        return materials
+
+    def get_data_cards(self) -> str:
+        'Data cards for the reactor'
+        sections = [self.DATA_CARDS_TPL.format(self=self, fs_volume=self.salt_volume(), inactive=self.inactive_cycles()),
+                    self.seed_cards(), self.source_cards(), self.entropy_cards()]
+        if self.silver_at_r > self.r and self.silver_at_r < self.refl:
+            sections.append(self.SILVER_DETECTOR)
+        if self.nfg is not None:
+            sections.append(self.NFG_TPL.format(self=self))
+        else:
+            sections.append(self.NO_GC)
+        sections.append(self.include_section('lib', self.lib_deck()))
+        if do_plots:
+            sections.append(self.PLOTS)
+        return ''.join(sections)
+
+    def get_refuel_mat(self) -> str:
+        'Refuel stream material, the same salt as fresh fuel'
+        refuel_density = self.fuel_salt().densityK(self.tempK)  # Same as fresh fuel
+        if refuel_density < 1.0:        # Sanity check
+            raise ValueError('Refuel density problem, ',refuel_density)
+        refuel_rho = '%.8f' % (-1.0*refuel_density)
+        return self.U_STOCK_TPL.format(self=self, refuel_rho=refuel_rho, refuel_volume=self.salt_volume()) + \
+            self.fuel_salt().serpent_isotopes()   # Add isotopic density list
+
+    def get_repr_cards(self) -> str:
+        'Reprocessing setup'
+        return self.REPR_CARDS_TPL.format(self=self, refuel=self.include_section('ustock', self.get_refuel_mat()),
+                                          refuel_lib=self.lib)
+
+    def get_depl_cards(self) -> str:
+        'Depletion data setup'
+        return self.DEPL_CARDS
+
+    def get_depl_1st_year(self) -> str:
+        '1st year of depletion in daysteps'
+        return self.DEPL_1ST_YEAR
+
+    def get_depl_add_9years(self) -> str:
+        'Add 9 years in daysteps'
+        return self.DEPL_ADD_9YEARS
+
+    def get_depl_add_10years(self) -> str:
+        'Add 10 years in daysteps'
+        return self.DEPL_ADD_10YEARS
+
+    def get_depl_steps(self) -> list:
+        'Daystep sections for the depletion length'
+        steps = []
+        if self.deplete > 0.5:          # Hacky, but will do :)
+            steps.append(self.get_depl_1st_year())
+        if self.deplete > 9:
+            steps.append(self.get_depl_add_9years())
+        if self.deplete > 19:
+            steps += [self.get_depl_add_10years()] * int((self.deplete - 10) // 10)
+        return steps
+
+    def deck_sections(self) -> list:
+        'Serpent deck as a list of sections, each formatted once'
+        sections = [self.TITLE_TPL.format(self=self), self.get_surfaces(), self.get_cells(), "\n",
+                    self.include_section('salt', self.fuel_salt().serpent_mat(self.tempK)),
+                    self.include_section('materials', self.get_materials()), self.get_data_cards()]
+        if self.deplete > 0.0:
+            sections.append(self.get_repr_cards())
+            if self.include_dir is not None:    # Daysteps belong to the dep card
+                sections.append(self.include_section('depletion',
+                                ''.join([self.get_depl_cards()] + self.get_depl_steps())))
+            else:
+                sections += [self.get_depl_cards()] + self.get_depl_steps()
+        if self.perf_tune:
+            sections.append(self.perf_cards(sections))
+        return sections
+
+    def save_deck(self) -> list:
+        'Saves Serpent deck into an input file, returns its sections, None if it could not be written'
         try:
             os.makedirs(self.deck_path, exist_ok = True)
-            fh = open(self.deck_path + '/' + self.deck_name, 'w')
-            fh.write(self.get_deck())
-            fh.close()
+            sections = self.deck_sections()
+            with open(self.deck_path + '/' + self.deck_name, 'w') as fh:
+                fh.writelines(sections)
+            if self.deck_cache is not None:
+                self.cache_deck(sections)
+            return sections
         except IOError as e:
             print("[ERROR] Unable to write to deck file: ",
                   self.deck_path + '/' + self.deck_name)
             print(e)
-
-    def save_qsub_file(self):
-        'Writes run file for TORQUE.'
-        qsub_content = '''#!/bin/bash
+            return None
+
+    def save_qsub_file(self, deck_paths:list=None, max_running:int=None):
+        '''Writes run file for TORQUE, or for the scheduler backend if set. With deck_paths,
+        the file is a TORQUE job array running deck_name in each of the deck_paths.'''
+        self.qsub_chain = False
+        if deck_paths is not None:
+            qsub_content = self.qsub_array_content(deck_paths, max_running=max_running)
+        elif self.scheduler is not None:
+            qsub_content = self.scheduler.job_script(self)
+        else:
+            (resources, run) = (self.pbs_resources(), self.serpent_command(self.deck_name, 'myout.out'))
+            qsub_content = '''#!/bin/bash
 #PBS -V
 #PBS -N MSFR_S2
 #PBS -q {self.queue}
-#PBS -l nodes=1:ppn={self.ompcores}
+#PBS -l {resources}
 
 hostname
 rm -f done.dat
@@ -580,7 +1018,7 @@ cd ${{PBS_O_WORKDIR}}
 module load mpi
 module load serpent
 
-sss2 -omp {self.ompcores} {self.deck_name} > myout.out
+{run} && \\
 awk 'BEGIN{{ORS="\\t"}} /ANA_KEFF/ || /CONVERSION/ {{print $7" "$8;}}' {self.deck_name}_res.m > done.out
 #rm {self.deck_name}.out
 '''.format(**locals())
@@ -594,26 +1032,7 @@ awk 'BEGIN{{ORS="\\t"}} /ANA_KEFF/ || /CONVERSION/ {{print $7" "$8;}}' {self.dec
 
     def get_deck(self) -> str:
         'Serpent deck for the lattice'
-        deck = '''\
-set title "sphMCFR radius {self.r}, reflector {self.refl}"
-'''
-        deck += self.get_surfaces()
-        deck += self.get_cells()
-        deck += "\n"
-        deck += self.s.serpent_mat(self.tempK)
-        deck += self.get_materials()
-        deck += self.get_data_cards()
-        if self.deplete > 0.0:
-            deck += self.get_repr_cards()
-            deck += self.get_depl_cards()
-        if self.deplete > 0.5:          # Hacky, but will do :)
-            deck += self.get_depl_1st_year()
-        if self.deplete > 9:
-            deck += self.get_depl_add_9years()
-        if self.deplete > 19:
-            for i in range((self.deplete - 10) // 10):
-                deck += self.get_depl_add_10years()
-        return deck.format(**locals())
+        return ''.join(self.deck_sections())
 
 
 class MCRE(MSFRbase):
@@ -645,12 +1064,12 @@ class MCRE(MSFRbase):
         self.refl_lib          = '06c'  # Reflector nuclear data library
         self.refl_tempK        = 873.0  # Reflector temperature [K]
         self.salt_formula:str  = salt   # Salt formula
+        self.enr:float         = e      # Uranium enrichment
         self.refuel_flow:float = 0.0    # wt_fraction/s refuel flow
-        self.s             = Salt(self.salt_formula, e) # Salt used
         if design == 'MCRE':
-            self.s.set_chlorine_37Cl_fraction(0.24)      # Natural chlorine-37
+            self.cl37:float    = 0.24   # Natural chlorine-37
         elif design == 'MCFR':
-            self.s.set_chlorine_37Cl_fraction(0.90)      # Enriched chlorine-37
+            self.cl37:float    = 0.90   # Enriched chlorine-37
         self.design            = design  # MCRE or MCFR
 
     def salt_volume(self) -> float:
@@ -664,21 +1083,153 @@ class MCRE(MSFRbase):
         V = cylinder - t_cone - b_cone
         return 2.0 * V
 
+    def source_box(self) -> tuple:
+        'Bounding box of the fuel salt cylinder'
+        return (-self.r, self.r, -self.r, self.r, 0.0, self.h)
+
+    # Deck templates, dedented once per class and formatted once per deck section
+    TITLE_TPL = dedent('''\
+        set title "cylMCFR radius {self.r}, height {self.h}, reflector {self.refl}" ''')
+    CELLS = dedent('''
+        %______________cell definitions_____________________________________
+        cell 30  0  refl       1 -2 -3  4        % radial reflector
+        cell 31  0  refl      -2  3 -5           % upper reflector
+        cell 32  0  refl      -8 -3              % upper reflector cone
+        cell 33  0  refl      -2 -4  6           % lower reflector
+        cell 34  0  refl      -7 4 -9            % lower reflector cone
+        cell 50  0  fuelsalt  -1 -3  4 #32 #34   % fuel salt
+        cell 97  0  outside    2                 % outside
+        cell 98  0  outside    5                 % outside
+        cell 99  0  outside    -6                % outside
+        ''')
+    SURFACES_TPL = dedent('''
+        %______________surface definitions__________________________________
+        surf 1  cylz  0.0 0.0 {self.r}       % fuel salt
+        surf 2  cylz  0.0 0.0 {refl_r}       % radial reflector
+        surf 3  pz    {self.h}              % fuel top
+        surf 4  pz    0                  % fuel bottom
+        surf 5  pz    {refl_top}              % refl top
+        surf 6  pz    {refl_bottom}              % refl bottom
+        surf 7 cone   0 0 0 {bcone_r} {bcone_h}     % bottom refl cone, x y z r h
+        surf 8 cone   0 0 {self.h} {tcone_r} {tcone_h}      % top refl cone
+        surf 9 pz     {cutoff}                    % bottom cone refl cutoff
+        ''')
+    MATERIALS_MCRE = dedent('''
+        % MgO reflector
+        mat refl -3.5 tmp 873.0 rgb 75 75 75
+         12024.06c 1.0
+         8016.06c 1.0
+        ''')
+    MATERIALS_MCFR_TPL = dedent('''
+        % Lead reflector
+        mat refl -10.4 tmp 873.0 rgb 75 75 75
+         82204.{refl_lib} 0.014
+         82206.{refl_lib} 0.241
+         82207.{refl_lib} 0.221
+         82208.{refl_lib} 0.524
+        ''')
+    DATA_CARDS_TPL = dedent('''
+        set mvol fuelsalt 0 {fs_volume}  % Fuel salt volume
+
+        set bc 1  % Boundary condition, vacuum
+
+        % set arr 2  % Analog reaction rate
+
+        set pop {self.histories} {self.cycles} {inactive}  % N pop and criticality cycles
+        ''')
+    POWER = {
+        'MCRE': dedent('''
+            set power 300000.0  % Power, 300 thermal kW
+            '''),
+        'MCFR': dedent('''
+            set power 1800000000.0  % Power, 1.8 thermal GW
+            ''')}
+    NFG_TPL = dedent('''
+        % Use group structure for group constant generation
+        set micro {self.nfg}
+        set nfg {self.nfg}
+        ''')
+    NO_GC = dedent('''
+        set gcu -1  % Turning off group constant generation hastens the calculation
+        ''')
+    PLOTS = dedent('''
+        % Plots
+        plot 3 1500 1500
+        plot 2 1500 1500
+        ''')
+    U_STOCK_TPL = 'mat U_stock {refuel_rho} burn 1 vol 1e8 tmp {self.tempK}\n'
+    REPR_CARDS_TPL = dedent('''
+        %___________Reprocessing___________
+        % First we need some extra materials to do depletion with reprocessing correctly.
+
+        {refuel}  % stockpile of extra refuel
+
+        % tanks for offgases
+        mat offgastankcore 0.0007 burn 1 vol 1e6 tmp {self.tempK}
+        2004.{refuel_lib} 1
+
+        % overflow tank
+        mat overflow 0.0007 burn 1 vol 1e8 tmp {self.tempK}
+        2004.{refuel_lib} 1
+
+        % mass flow definitions
+        mflow U_in
+        all {self.refuel_flow}
+
+        mflow offgasratecore
+        Ne 1e-2
+        Ar 1e-2
+        He 1e-2
+        Kr 1e-2
+        Xe 1e-2
+        Rn 1e-2
+
+        % need to account for the increase in volume with refueling
+        mflow over
+        all {self.refuel_flow}
+
+        % predictor-corrector must be turned off to use depletion
+        set pcc 0
+        % dumps depletion matrices if needed. should be one per burnt material.
+        % set depmtx 1
+
+        %syntax:
+        % rc <from_mat> <to_mat> <mflow> <setting> where setting is either 0, 1 or 2.
+
+        rep source_rep
+        rc U_stock fuelsalt U_in 0
+        rc fuelsalt offgastankcore offgasratecore 1
+        rc fuelsalt overflow over 1
+        ''')
+    DEPL_CARDS = dedent('''
+        % Depletion cards
+        set inventory all
+        dep
+        pro source_rep
+        daystep
+        ''')
+    DEPL_1ST_YEAR = dedent('''\
+        0.05 0.15 0.3 0.5   % 1 day
+        1 2 3               % 1 week
+        7 7 7 14 14 14 14 28 28 28 28 42 42 42 44  % 1 year, 366 days''')
+    DEPL_ADD_9YEARS = dedent('''\
+        52 52 52 52 52 52 53    % 365
+        52 52 52 52 52 52 53    % 365
+        52 52 52 52 52 52 54    % 366
+        52 52 52 52 52 52 53    % 365
+        52 52 52 52 52 52 53    % 365
+        52 52 52 52 52 52 54    % 366
+        52 52 52 52 52 52 53    % 365
+        52 52 52 52 52 52 53    % 365
+        52 52 52 52 52 52 53    % 365''')
+    DEPL_ADD_10YEARS = dedent('''\
+        120 120 126 120 120 125 120 120 125 120 120 125
+        120 120 126 120 120 125 120 120 125 120 120 125
+        120 120 126 120 120 125''')
+
     def get_cells(self) -> str:
         'Cell cards for Serpent input deck'
-        cells = dedent('''
-            %______________cell definitions_____________________________________
-            cell 30  0  refl       1 -2 -3  4        % radial reflector
-            cell 31  0  refl      -2  3 -5           % upper reflector
-            cell 32  0  refl      -8 -3              % upper reflector cone
-            cell 33  0  refl      -2 -4  6           % lower reflector
-            cell 34  0  refl      -7 4 -9            % lower reflector cone
-            cell 50  0  fuelsalt  -1 -3  4 #32 #34   % fuel salt
-            cell 97  0  outside    2                 % outside
-            cell 98  0  outside    5                 % outside
-            cell 99  0  outside    -6                % outside
-            ''')
-        return cells.format(**locals())
+        return self.CELLS
 
     def get_surfaces(self) -> str:
         'Surface cards for Serpent input deck'
@@ -692,196 +1243,117 @@ class MCRE(MSFRbase):
             cutoff = 3/5 * self.refl
             bcone_r = self.r/2
         tcone_h, bcone_h = -self.h/20, cutoff+3
-        surfaces = dedent('''
-            %______________surface definitions__________________________________
-            surf 1  cylz  0.0 0.0 {self.r}       % fuel salt
-            surf 2  cylz  0.0 0.0 {refl_r}       % radial reflector
-            surf 3  pz    {self.h}              % fuel top
-            surf 4  pz    0                  % fuel bottom
-            surf 5  pz    {refl_top}              % refl top
-            surf 6  pz    {refl_bottom}              % refl bottom
-            surf 7 cone   0 0 0 {bcone_r} {bcone_h}     % bottom refl cone, x y z r h
-            surf 8 cone   0 0 {self.h} {tcone_r} {tcone_h}      % top refl cone
-            surf 9 pz     {cutoff}                    % bottom cone refl cutoff
-            ''')
-        return surfaces.format(**locals())
+        return self.SURFACES_TPL.format(self=self, refl_r=refl_r, refl_top=refl_top, refl_bottom=refl_bottom,
+            tcone_r=tcone_r, tcone_h=tcone_h, bcone_r=bcone_r, bcone_h=bcone_h, cutoff=cutoff)
 
     def get_materials(self) -> str:
         'Material definitions, non-salt'
-        refl_lib  = self.refl_lib
         if self.design == 'MCRE':
-            materials = dedent('''
-                % MgO reflector
-                mat refl -3.5 tmp 873.0 rgb 75 75 75
-                 12024.06c 1.0
-                 8016.06c 1.0
-                ''')
+            return self.MATERIALS_MCRE
         elif self.design == 'MCFR':
-            materials = dedent('''
-                % Lead reflector
-                mat refl -10.4 tmp 873.0 rgb 75 75 75
-                 82204.{refl_lib} 0.014
-                 82206.{refl_lib} 0.241
-                 82207.{refl_lib} 0.221
-                 82208.{refl_lib} 0.524
-                ''')
-        return materials.format(**locals())
+            return self.MATERIALS_MCFR_TPL.format(refl_lib=self.refl_lib)
 
     def get_data_cards(self) -> str:
         'Data cards for the reactor'
-        fs_volume = self.salt_volume()
-        data_cards = dedent('''
-            set mvol fuelsalt 0 {fs_volume}  % Fuel salt volume
-
-            set bc 1  % Boundary condition, vacuum
-
-            % set arr 2  % Analog reaction rate
-
-            set pop {self.histories} 240 40  % N pop and criticality cycles
-            ''')
-        if self.design == 'MCRE':
-            data_cards += dedent(f'''
-                set power 300000.0  % Power, 300 thermal kW
-                ''')
-        elif self.design == 'MCFR':
-            data_cards += dedent(f'''
-                set power 1800000000.0  % Power, 1.8 thermal GW
-                ''')
+        sections = [self.DATA_CARDS_TPL.format(self=self, fs_volume=self.salt_volume(), inactive=self.inactive_cycles()),
+                    self.seed_cards(), self.source_cards(), self.entropy_cards(), self.POWER[self.design]]
         if self.nfg is not None:
-            data_cards += dedent(f'''
-                % Use group structure for group constant generation
-                set micro {self.nfg}
-                set nfg {self.nfg}
-                ''')
+            sections.append(self.NFG_TPL.format(self=self))
         else:
-            data_cards += dedent(f'''
-                set gcu -1  % Turning off group constant generation hastens the calculation
-                ''')
-        data_cards += self.lib_deck()
-
+            sections.append(self.NO_GC)
+        sections.append(self.include_section('lib', self.lib_deck()))
         if do_plots:
-            data_cards += dedent('''
-                % Plots
-                plot 3 1500 1500
-                plot 2 1500 1500
-                ''')
-        return data_cards.format(**locals())
+            sections.append(self.PLOTS)
+        return ''.join(sections)
+
+    def get_refuel_mat(self) -> str:
+        'Refuel stream material, the same salt as fresh fuel'
+        refuel_density = self.fuel_salt().densityK(self.tempK)  # Same as fresh fuel
+        if refuel_density < 1.0:        # Sanity check
+            raise ValueError('Refuel density problem, ',refuel_density)
+        refuel_rho = '%.8f' % (-1.0*refuel_density)
+        return self.U_STOCK_TPL.format(self=self, refuel_rho=refuel_rho) + \
+            self.fuel_salt().serpent_isotopes()   # Add isotopic density list
 
     def get_repr_cards(self) -> str:
         'Reprocessing setup'
-        refuel_lib = self.lib   # First, build refuel stream using the same material as fuel
-        refuel_tmp   = self.s.serpent_mat(self.tempK) # Same as fresh fuel
-        refuel_split = refuel_tmp.split('\n')
-        refuel_rho   = re.search(r'-[0-9.]+', refuel_split[1]).group()
-        if float(refuel_rho) > -1.0:     # Sanity check
-            raise ValueError('Refuel density problem, ',refuel_rho)
-        refuel  = 'mat U_stock {refuel_rho} burn 1 vol 1e8 tmp {self.tempK}\n'.format(**locals())
-        refuel += '\n'.join(refuel_split[2:])   # Add isotopic density list
-        repr_cards = dedent('''
-            %___________Reprocessing___________
-            % First we need some extra materials to do depletion with reprocessing correctly.
-
-            {refuel}  % stockpile of extra refuel
-
-            % tanks for offgases
-            mat offgastankcore 0.0007 burn 1 vol 1e6 tmp {self.tempK}
-            2004.{refuel_lib} 1
-
-            % overflow tank
-            mat overflow 0.0007 burn 1 vol 1e8 tmp {self.tempK}
-            2004.{refuel_lib} 1
-
-            % mass flow definitions
-            mflow U_in
-            all {self.refuel_flow}
-
-            mflow offgasratecore
-            Ne 1e-2
-            Ar 1e-2
-            He 1e-2
-            Kr 1e-2
-            Xe 1e-2
-            Rn 1e-2
-
-            % need to account for the increase in volume with refueling
-            mflow over
-            all {self.refuel_flow}
-
-            % predictor-corrector must be turned off to use depletion
-            set pcc 0
-            % dumps depletion matrices if needed. should be one per burnt material.
-            % set depmtx 1
-
-            %syntax:
-            % rc <from_mat> <to_mat> <mflow> <setting> where setting is either 0, 1 or 2.
-
-            rep source_rep
-            rc U_stock fuelsalt U_in 0
-            rc fuelsalt offgastankcore offgasratecore 1
-            rc fuelsalt overflow over 1
-            ''')
-        return repr_cards.format(**locals())
+        return self.REPR_CARDS_TPL.format(self=self, refuel=self.include_section('ustock', self.get_refuel_mat()),
+                                          refuel_lib=self.lib)
 
     def get_depl_cards(self) -> str:
         'Depletion data setup'
-        depl_cards = dedent('''
-            % Depletion cards
-            set inventory all
-            dep
-            pro source_rep
-            daystep
-            ''')
-        return depl_cards.format(**locals())
+        return self.DEPL_CARDS
 
     def get_depl_1st_year(self) -> str:
         '1st year of depletion in daysteps'
-        depl_1st_year = dedent('''\
-            0.05 0.15 0.3 0.5   % 1 day
-            1 2 3               % 1 week
-            7 7 7 14 14 14 14 28 28 28 28 42 42 42 44  % 1 year, 366 days''')
-        return depl_1st_year.format(**locals())
+        return self.DEPL_1ST_YEAR
 
     def get_depl_add_9years(self) -> str:
         'Add 9 years in daysteps'
-        depl_add_9years = dedent('''\
-            52 52 52 52 52 52 53    % 365
-            52 52 52 52 52 52 53    % 365
-            52 52 52 52 52 52 54    % 366
-            52 52 52 52 52 52 53    % 365
-            52 52 52 52 52 52 53    % 365
-            52 52 52 52 52 52 54    % 366
-            52 52 52 52 52 52 53    % 365
-            52 52 52 52 52 52 53    % 365
-            52 52 52 52 52 52 53    % 365''')
-        return depl_add_9years.format(**locals())
+        return self.DEPL_ADD_9YEARS
 
     def get_depl_add_10years(self) -> str:
         'Add 10 years in daysteps'
-        depl_add_10years = dedent('''\
-            120 120 126 120 120 125 120 120 125 120 120 125
-            120 120 126 120 120 125 120 120 125 120 120 125
-            120 120 126 120 120 125''')
-        return depl_add_10years.format(**locals())
-
-    def save_deck(self):
-        'Saves Serpent deck into an input file'
+        return self.DEPL_ADD_10YEARS
+
+    def get_depl_steps(self) -> list:
+        'Daystep sections for the depletion length'
+        steps = []
+        if self.deplete > 0.5:          # Hacky, but will do :)
+            steps.append(self.get_depl_1st_year())
+        if self.deplete > 9:
+            steps.append(self.get_depl_add_9years())
+        if self.deplete > 19:
+            steps += [self.get_depl_add_10years()] * int((self.deplete - 10) // 10)
+        return steps
+
+    def deck_sections(self) -> list:
+        'Serpent deck as a list of sections, each formatted once'
+        sections = [self.TITLE_TPL.format(self=self), self.get_surfaces(), self.get_cells(), "\n",
+                    self.include_section('salt', self.fuel_salt().serpent_mat(self.tempK)),
+                    self.include_section('materials', self.get_materials()), self.get_data_cards()]
+        if self.deplete > 0.0:
+            sections.append(self.get_repr_cards())
+            if self.include_dir is not None:    # Daysteps belong to the dep card
+                sections.append(self.include_section('depletion',
+                                ''.join([self.get_depl_cards()] + self.get_depl_steps())))
+            else:
+                sections += [self.get_depl_cards()] + self.get_depl_steps()
+        if self.perf_tune:
+            sections.append(self.perf_cards(sections))
+        return sections
+
+    def save_deck(self) -> list:
+        'Saves Serpent deck into an input file, returns its sections, None if it could not be written'
         try:
             os.makedirs(self.deck_path, exist_ok = True)
-            fh = open(self.deck_path + '/' + self.deck_name, 'w')
-            fh.write(self.get_deck())
-            fh.close()
+            sections = self.deck_sections()
+            with open(self.deck_path + '/' + self.deck_name, 'w') as fh:
+                fh.writelines(sections)
+            if self.deck_cache is not None:
+                self.cache_deck(sections)
+            return sections
         except IOError as e:
             print("[ERROR] Unable to write to deck file: ",
                   self.deck_path + '/' + self.deck_name)
             print(e)
-
-    def save_qsub_file(self):
-        'Writes run file for TORQUE.'
-        qsub_content = dedent('''#!/bin/bash
+            return None
+
+    def save_qsub_file(self, deck_paths:list=None, max_running:int=None):
+        '''Writes run file for TORQUE, or for the scheduler backend if set. With deck_paths,
+        the file is a TORQUE job array running deck_name in each of the deck_paths.'''
+        self.qsub_chain = False
+        if deck_paths is not None:
+            qsub_content = self.qsub_array_content(deck_paths, max_running=max_running)
+        elif self.scheduler is not None:
+            qsub_content = self.scheduler.job_script(self)
+        else:
+            (resources, run) = (self.pbs_resources(), self.serpent_command(self.deck_name, 'myout.out'))
+            qsub_content = dedent('''#!/bin/bash
             #PBS -V
             #PBS -N MSFR_S2
             #PBS -q {self.queue}
-            #PBS -l nodes=1:ppn={self.ompcores}
+            #PBS -l {resources}
 
             hostname
             rm -f done.dat
@@ -889,7 +1361,7 @@ class MCRE(MSFRbase):
             module load mpi
             module load serpent
 
-            sss2 -omp {self.ompcores} {self.deck_name} > myout.out
+            {run} && \\
             awk 'BEGIN{{ORS="\\t"}} /ANA_KEFF/ || /CONVERSION/ {{print $7" "$8;}}' {self.deck_name}_res.m > done.out
             #rm {self.deck_name}.out
             ''').format(**locals())
@@ -903,62 +1375,84 @@ class MCRE(MSFRbase):
 
     def get_deck(self) -> str:
         'Serpent deck for the lattice'
-        deck = dedent('''\
-            set title "cylMCFR radius {self.r}, height {self.h}, reflector {self.refl}" ''')
-        deck += self.get_surfaces()
-        deck += self.get_cells()
-        deck += "\n"
-        deck += self.s.serpent_mat(self.tempK)
-        deck += self.get_materials()
-        deck += self.get_data_cards()
-        if self.deplete > 0.0:
-            deck += self.get_repr_cards()
-            deck += self.get_depl_cards()
-        if self.deplete > 0.5:          # Hacky, but will do :)
-            deck += self.get_depl_1st_year()
-        if self.deplete > 9:
-            deck += self.get_depl_add_9years()
-        if self.deplete > 19:
-            for i in range((self.deplete - 10) // 10):
-                deck += self.get_depl_add_10years()
-        return deck.format(**locals())
-
-
-def liquidusNaClUCl3(xUCl3:float) -> float:
+        return ''.join(self.deck_sections())
+
+
+# NaCl-UCl3 liquidus from https://doi.org/10.1016/j.jnucmat.2015.07.050
+# digitized using https://automeris.io/WebPlotDigitizer/
+# UCl3 molar fraction [0:1]
+LIQUIDUS_NaClUCl3_X = [0.00, 0.022808207269860187, 0.05567526666146555, 0.0855318371043732,
+    0.11387291763560031, 0.1407171777187291, 0.16456696209224897,
+    0.1884138246188261, 0.2107710222408382, 0.23162585386851375,
+    0.2524871254853691, 0.2733369482325713, 0.2956844262412841,
+    0.32067373092247503, 0.3332737833099288, 0.3525508723644844,
+    0.376626682469361, 0.40220160875921956, 0.43226157010619365,
+    0.4653201812298379, 0.49837469417854924, 0.5314182786607735,
+    0.5667049308894863, 0.5929777611919551, 0.633510191172695,
+    0.6665269098414717, 0.6995413517463969, 0.7325526061819301,
+    0.7655634052646927, 0.7985687401142121, 0.8315717981998796,
+    0.8645721241689257, 0.8975683519630391, 0.9305641244043819,
+    0.963555343318022, 0.9875390469412866, 1.0007021363224675]
+# Liquidus temperature [C]
+LIQUIDUS_NaClUCl3_T = [798.4941460942108, 790.8183271004245, 774.4729081656745,
+    755.0703266232713, 732.0772695140352, 709.2509663838887,
+    686.5901650127134, 663.3413419443107, 641.6993259910652,
+    619.1080228364567, 597.8127675043092, 574.2134271544534,
+    550.6153390247157, 531.2315977031835, 522.0155051642334,
+    541.7165932813905, 564.5434703457579, 587.6656104788574,
+    609.1954483798368, 631.3998155178843, 652.7794249507294,
+    671.9596805030346, 690.4545162978486, 703.3289043893245,
+    722.6299707234994, 736.4034813194771, 749.7187931903425,
+    762.3926268460502, 774.9748207567357, 786.4573377271508,
+    797.4816559724537, 807.9561357476216, 817.6058578175869,
+    827.1639401425298, 835.8056250172476, 840.0960726571891,
+    841.9715489376551]
+
+_liquidus_spline = None     # Cubic spline through the liquidus data, built on first use
+
+def _liquidusNaClUCl3_spline():
+    'Returns cubic spline of the NaCl-UCl3 liquidus, same as interp1d(kind=cubic)'
+    global _liquidus_spline
+    if _liquidus_spline is None:
+        _liquidus_spline = interpolate.make_interp_spline(LIQUIDUS_NaClUCl3_X, LIQUIDUS_NaClUCl3_T, k=3)
+    return _liquidus_spline
+
+def liquidusNaClUCl3(xUCl3):
     '''Returns liquidus temperature of NaCl-LiCl3 based on
     https://doi.org/10.1016/j.jnucmat.2015.07.050
     using https://automeris.io/WebPlotDigitizer/
-    xUCl3 is UCl3 molar fraction [0:1]
-    returns temperature in Celsius'''
-
-    x = [0.00, 0.022808207269860187, 0.05567526666146555, 0.0855318371043732,
-         0.11387291763560031, 0.1407171777187291, 0.16456696209224897,
-         0.1884138246188261, 0.2107710222408382, 0.23162585386851375,
-         0.2524871254853691, 0.2733369482325713, 0.2956844262412841,
-         0.32067373092247503, 0.3332737833099288, 0.3525508723644844,
-         0.376626682469361, 0.40220160875921956, 0.43226157010619365,
-         0.4653201812298379, 0.49837469417854924, 0.5314182786607735,
-         0.5667049308894863, 0.5929777611919551, 0.633510191172695,
-         0.6665269098414717, 0.6995413517463969, 0.7325526061819301,
-         0.7655634052646927, 0.7985687401142121, 0.8315717981998796,
-         0.8645721241689257, 0.8975683519630391, 0.9305641244043819,
-         0.963555343318022, 0.9875390469412866, 1.0007021363224675]
-
-    T = [798.4941460942108, 790.8183271004245, 774.4729081656745,
-         755.0703266232713, 732.0772695140352, 709.2509663838887,
-         686.5901650127134, 663.3413419443107, 641.6993259910652,
-         619.1080228364567, 597.8127675043092, 574.2134271544534,
-         550.6153390247157, 531.2315977031835, 522.0155051642334,
-         541.7165932813905, 564.5434703457579, 587.6656104788574,
-         609.1954483798368, 631.3998155178843, 652.7794249507294,
-         671.9596805030346, 690.4545162978486, 703.3289043893245,
-         722.6299707234994, 736.4034813194771, 749.7187931903425,
-         762.3926268460502, 774.9748207567357, 786.4573377271508,
-         797.4816559724537, 807.9561357476216, 817.6058578175869,
-         827.1639401425298, 835.8056250172476, 840.0960726571891,
-         841.9715489376551]
-    Tliquidus = interpolate.interp1d(x, T, kind='cubic')
-    return float(Tliquidus(xUCl3))
+    xUCl3 is UCl3 molar fraction [0:1], a number or numpy array
+    returns temperature in Celsius, float or numpy array'''
+    x = np.asarray(xUCl3, dtype=float)
+    if np.any(x < LIQUIDUS_NaClUCl3_X[0]) or np.any(x > LIQUIDUS_NaClUCl3_X[-1]):
+        raise ValueError("UCl3 fraction out of the liquidus data range: ", xUCl3)
+    Tliquidus = _liquidusNaClUCl3_spline()(x)
+    if x.ndim == 0:
+        return float(Tliquidus)
+    return Tliquidus
+
+def liquidusNaClUCl3_range(tempC:float, margin:float=0.0) -> list:
+    '''Inverse of liquidusNaClUCl3: returns list of (xmin, xmax) UCl3 molar fraction
+    intervals where the liquidus is at least margin below operating temperature tempC [C].
+    Empty list if no NaCl-UCl3 composition satisfies the margin.'''
+    Tmax   = tempC - margin
+    spline = _liquidusNaClUCl3_spline()
+    (x0, x1) = (LIQUIDUS_NaClUCl3_X[0], LIQUIDUS_NaClUCl3_X[-1])
+    roots  = interpolate.PPoly.from_spline(spline).solve(Tmax, extrapolate=False)
+    edges  = np.unique(np.concatenate(([x0], roots[(roots > x0) & (roots < x1)], [x1])))
+    ranges = []
+    for (xa, xb) in zip(edges[:-1], edges[1:]):
+        if spline(0.5*(xa + xb)) <= Tmax:   # Liquidus below Tmax in this interval
+            if ranges and ranges[-1][1] == xa:
+                ranges[-1] = (ranges[-1][0], float(xb))
+            else:
+                ranges.append((float(xa), float(xb)))
+    return ranges
+
+def liquidusNaClUCl3_feasible(xUCl3, tempC:float, margin:float=0.0):
+    '''Returns True where the liquidus of UCl3 molar fraction(s) xUCl3
+    is at least margin below operating temperature tempC [C]'''
+    return liquidusNaClUCl3(xUCl3) <= tempC - margin
 
 
 # ------------------------------------------------------------
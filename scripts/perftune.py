@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Serpent performance options sized to the problem.
+
+problem_size() counts what drives Serpent memory in a rendered deck: materials, burnable
+materials, transport nuclides, depletion steps, histories and threads. memory_estimate()
+is a rough model of the memory of each optimization mode (set opti):
+    1 - no unionized grid, nothing precalculated, least memory
+    2 - macroscopic cross sections precalculated
+    3 - unionized energy grid, macroscopic cross sections precalculated
+    4 - unionized grid, microscopic and macroscopic cross sections precalculated, fastest
+tune() picks the fastest mode that fits the node memory, thins the unionized grid
+and shares the OpenMP tally buffers for big depletion problems. The estimate
+is also the memory request of the batch job.
+
+# Example usage:
+import msfr
+mycore = msfr.MSFR(122, 522, 0.1975, "66.66%NaCl+33.34%UCl3")
+mycore.deplete   = 10
+mycore.ompcores  = 64
+mycore.perf_tune = True     # Deck gets tuned options, job script a memory request
+print(mycore.problem_size(), mycore.memory_request())
+'''
+
+import math
+import xsindex
+
+OPTI_MODES = {1: (False, False, False), 2: (False, True, False),    # Mode: (unionized grid,
+              3: (True, True, False), 4: (True, True, True)}        #   macro xs, micro xs precalculated)
+
+# Memory model, rough numbers for continuous energy data of fast spectrum chloride salt problems
+ACE_MB_PER_NUCLIDE    = 2.0     # Pointwise data of one nuclide at one temperature [MB]
+GRID_POINTS           = 300000  # Unionized energy grid points
+GRID_THINNING         = 0.6     # Fraction of grid points left by set egrid thinning
+EGRID_TOLERANCE       = 5e-5    # Thinning tolerance for big problems
+XS_PER_MATERIAL       = 6       # Precalculated macroscopic cross sections per material
+XS_PER_NUCLIDE        = 6       # Precalculated microscopic cross sections per nuclide
+INVENTORY_XS_NUCLIDES = 350     # Transport nuclides in burnable materials with set inventory all
+DEPLETION_NUCLIDES    = 1600    # Nuclides tracked in burnable materials
+DEPLETION_REACTIONS   = 10      # Reaction rate tallies per nuclide in a burnable material
+BYTES_PER_HISTORY     = 600     # Source, fission bank and event memory per neutron
+BASE_GB               = 0.5     # Serpent itself, geometry, tallies
+MEMFRAC               = 0.9     # Fraction of node memory Serpent may use
+HEADROOM              = 1.25    # Job memory request over the estimate
+
+
+def problem_size(text:str, histories:int, threads:int, deck_dir:str='.') -> dict:
+    'Counts materials, burnable materials, nuclides and depletion steps of a deck text'
+    cards = xsindex.deck_cards(xsindex.expand_includes(text, deck_dir))
+    (materials, burnable, nuclides, burn_nuclides, steps, inventory) = (0, 0, set(), set(), 0, False)
+    for card in cards:
+        (kind, args) = (card[0], card[1:])
+        if kind == 'mat' and len(args) >= 2:
+            materials += 1
+            i = 2
+            burn = False
+            while i < len(args) and args[i] in xsindex.MAT_OPTIONS:
+                burn = burn or (args[i] == 'burn' and i + 1 < len(args) and args[i+1] != '0')
+                i += 1 + xsindex.MAT_OPTIONS[args[i]]
+            ids = set(n for n in args[i::2] if '.' in n)
+            nuclides |= ids
+            if burn:
+                burnable += 1
+                burn_nuclides |= ids
+        elif kind == 'set' and args[:2] == ['inventory', 'all']:
+            inventory = True
+        elif kind == 'dep':
+            steps += sum(1 for a in args if xsindex._is_number(a))
+    n_burn_xs = len(burn_nuclides) + (INVENTORY_XS_NUCLIDES if inventory and burnable else 0)
+    return {'materials': materials, 'burnable': burnable, 'nuclides': len(nuclides - burn_nuclides) + n_burn_xs,
+            'burnable_nuclides': n_burn_xs, 'depletion_steps': steps, 'histories': histories, 'threads': threads}
+
+def memory_estimate(size:dict, opti:int=4, shbuf:int=0, egrid:bool=False) -> float:
+    'Estimated Serpent memory [GB] for the problem size in optimization mode opti'
+    (union, macro, micro) = OPTI_MODES[opti]
+    points = GRID_POINTS * (GRID_THINNING if egrid and union else 1.0)
+    b = BASE_GB * 1e9 + size['nuclides'] * ACE_MB_PER_NUCLIDE * 1e6
+    if union:
+        b += points * 8
+    if macro:
+        b += size['materials'] * points * XS_PER_MATERIAL * 8
+    if micro:
+        b += size['nuclides'] * points * XS_PER_NUCLIDE * 8
+    if size['burnable']:
+        buffers = 1 if shbuf else size['threads']   # Reaction rate tallies, per thread without shbuf
+        b += size['burnable'] * (DEPLETION_NUCLIDES * 8 * 4 +
+                                 size['burnable_nuclides'] * DEPLETION_REACTIONS * 8 * buffers)
+    b += size['histories'] * BYTES_PER_HISTORY * 3
+    return b / 1e9
+
+def tune(size:dict, node_memory_gb:float) -> dict:
+    '''Fastest options that fit MEMFRAC of the node memory: {opti, shbuf, egrid, memory_gb}.
+    Criticality problems keep the full grid, big depletion problems thin it and share buffers.'''
+    budget = MEMFRAC * node_memory_gb
+    big = size['burnable'] > 0 and size['burnable_nuclides'] > 100
+    egrid = big
+    shbuf = 1 if big and size['threads'] > 8 else 0
+    for opti in (4, 3, 2, 1):
+        memory = memory_estimate(size, opti, shbuf, egrid)
+        if memory <= budget:
+            break
+    if memory > budget:
+        print("[WARNING] Estimated Serpent memory %.1f GB is above %.1f GB even in opti 1" % (memory, budget))
+    return {'opti': opti, 'shbuf': shbuf, 'egrid': egrid and OPTI_MODES[opti][0], 'memory_gb': memory}
+
+def cards(tuned:dict, size:dict) -> str:
+    'Serpent cards of the tuned options'
+    output = f'''
+% Performance options for {size['materials']} materials ({size['burnable']} burnable), \
+{size['nuclides']} nuclides, {size['depletion_steps']} depletion steps
+% estimated memory {tuned['memory_gb']:.1f} GB
+set opti {tuned['opti']}
+set memfrac {MEMFRAC}
+set shbuf {tuned['shbuf']}
+'''
+    if tuned['egrid']:
+        output += 'set egrid %g 1e-11 20\n' % EGRID_TOLERANCE
+    return output
+
+def memory_request_gb(tuned:dict) -> int:
+    'Job memory request [GB] with headroom'
+    return int(math.ceil(HEADROOM * tuned['memory_gb']))
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a Serpent performance tuning module.")
@@ -2,11 +2,12 @@
 
 import math
 import numpy as np
-import matplotlib.pyplot as plt
 import sys
 import os
 
-import serpentTools
+from lazyimport import LazyModule
+plt = LazyModule('matplotlib.pyplot')       # Imported on the first plot
+serpentTools = LazyModule('serpentTools')
 
 
 class PlayWire(object):
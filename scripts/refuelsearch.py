@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Refuel rate search: finds the refuel_flow that keeps k_eff closest to the target
+over the whole depletion, instead of a dense grid of full depletion runs.
+
+Every finished run gives absKeff (ABS_KEFF) versus burnup. At each depletion step k_eff
+is fitted as a straight line in the refuel rate across the runs, weighted by the inverse
+k_eff variances. The proposed rate minimizes the time averaged squared deviation of the
+fitted trajectory from the target, each step weighted by the time it represents.
+The search stops when the proposed rate moves by less than rtol.
+
+# Example usage:
+import refuelsearch
+s = refuelsearch.RefuelSearch((2.0e-10, 4.0e-10), core='MSFR',
+        fixed={'r': 122.0, 'refl': 522.0, 'e': 0.1975, 'salt': "66.66%NaCl+33.34%UCl3",
+               'Ag_r': 300.0, 'power': 1e9, 'deplete': 10,
+               'queue': 'fill', 'ompcores': 32, 'histories': 10000},
+        path='/home/ondrejch/APump/final_run/refuel_search')
+result = s.run()
+print(result['rate'], result['rms'])
+'''
+
+import numpy as np
+import resfile
+import critsearch
+import schedulers
+
+
+def step_weights(days:np.ndarray) -> np.ndarray:
+    'Trapezoid rule weights of depletion steps, uniform without depletion'
+    if len(days) < 2 or days[-1] <= days[0]:
+        return np.ones(len(days))
+    w = np.zeros(len(days))
+    dt = np.diff(days)
+    w[:-1] += dt / 2.0
+    w[1:]  += dt / 2.0
+    return w
+
+
+class RefuelSearch(object):
+    '''Refuel rate search over the depletion trajectory'''
+    def __init__(self, rates:tuple, core:str='MSFR', fixed:dict=None, path:str='/tmp/refuelsearch',
+                 target:float=1.0, scheduler:schedulers.Scheduler=None, evaluator=None):
+        if len(set(rates)) < 2:
+            raise ValueError("At least two different starting refuel rates needed: ", rates)
+        self.rates:list     = sorted(rates)  # Starting refuel rates, run concurrently
+        self.core:str       = core          # 'MSFR' or 'MCRE'
+        self.fixed:dict     = dict(fixed or {})  # Other core parameters, with deplete and power
+        self.path:str       = path          # Search directory, one deck directory per rate
+        self.target:float   = target        # Target k_eff
+        self.rtol:float     = 0.01          # Stop when the proposed rate moves less than this fraction
+        self.max_runs:int   = 8             # Limit of submitted runs, including the starting rates, failed ones count
+        self.fit_runs:int   = 3             # Runs closest to target used in the fit
+        self.keff_key:str   = 'ABS_KEFF'    # absKeff
+        self.poll_interval:float = 60.0     # Seconds between job status polls
+        self.warm_start:bool = False        # Start runs from the fission source of the nearest earlier run
+        self.scheduler      = scheduler or schedulers.LocalScheduler()
+        self.evaluator      = evaluator or self.run_points  # rates -> [(days, k, sigma_k)]
+        self.runs:list      = []            # Finished (rate, days, k, sigma_k)
+        self.submitted:int  = 0             # Runs submitted, including failed ones
+        self.history:list   = []            # Proposal after each run
+
+    def __repr__(self):
+        return "RefuelSearch from %s for k=%g, %d runs" % (self.rates, self.target, len(self.runs))
+
+    def run_points(self, rates:list) -> list:
+        '''Runs depletion decks for the refuel rates concurrently through the scheduler,
+        returns [(days, k, sigma_k)], None for failed runs'''
+        results = []
+        warm_from = [r[0] for r in self.runs] if self.warm_start else None
+        for res_file in critsearch.run_decks(self.core, self.fixed, 'refuel_flow', rates, self.path,
+                                             self.scheduler, self.poll_interval, warm_from):
+            try:
+                results.append(resfile.trajectory(res_file, self.keff_key))
+            except (IOError, ValueError, IndexError) as e:
+                print("[WARNING] No k_eff trajectory in ", res_file, e)
+                results.append(None)
+        return results
+
+    def evaluate(self, rates:list) -> int:
+        '''Runs the rates and adds the trajectories. Only complete trajectories are kept,
+        those as long as the longest one so far. Returns how many of the rates were kept.'''
+        self.submitted += len(rates)
+        for (q, r) in zip(rates, self.evaluator(rates)):
+            if r is not None:
+                self.runs.append((q, np.asarray(r[0]), np.asarray(r[1]), np.asarray(r[2])))
+        steps = max([len(r[1]) for r in self.runs], default=0)
+        for r in self.runs:
+            if len(r[1]) < steps:
+                print("[WARNING] Incomplete depletion for refuel rate ", r[0], len(r[1]), "of", steps, "steps")
+        self.runs = [r for r in self.runs if len(r[1]) == steps]
+        return sum(1 for r in self.runs if r[0] in rates)
+
+    def deviation(self, days:np.ndarray, k:np.ndarray) -> float:
+        'Time averaged RMS deviation of a k_eff trajectory from the target'
+        w = step_weights(days)
+        return float(np.sqrt(np.sum(w * (k - self.target)**2) / np.sum(w)))
+
+    def fit(self, runs:list) -> tuple:
+        '''Per step straight line k = a + b*rate through the runs, weighted by 1/sigma_k^2.
+        Returns arrays (a, b).'''
+        q = np.array([r[0] for r in runs])[:,None]
+        k = np.array([r[2] for r in runs])
+        w = 1.0 / np.array([r[3] for r in runs])**2
+        (sw, sq, sqq) = (w.sum(0), (w*q).sum(0), (w*q*q).sum(0))
+        (sk, sqk) = ((w*k).sum(0), (w*q*k).sum(0))
+        b = (sw*sqk - sq*sk) / (sw*sqq - sq**2)
+        return ((sk - b*sq) / sw, b)
+
+    def propose(self) -> dict:
+        '''Proposes the next refuel rate from the runs closest to target.
+        Returns the rate, its predicted RMS deviation, and the best run so far.'''
+        days = self.runs[0][1]
+        rms = [self.deviation(days, r[2]) for r in self.runs]
+        near = [self.runs[i] for i in np.argsort(rms)[:max(2, self.fit_runs)]]
+        if len(set(r[0] for r in near)) < 2:
+            raise ValueError("Refuel rates in the fit are all the same: ", [r[0] for r in near])
+        (a, b) = self.fit(near)
+        w = step_weights(days)
+        if np.sum(w * b**2) == 0.0:
+            raise ValueError("k_eff does not depend on the refuel rate")
+        q = float(np.sum(w * b * (self.target - a)) / np.sum(w * b**2))
+        rates = [r[0] for r in self.runs]
+        span = max(rates) - min(rates)
+        q = float(np.clip(q, max(0.0, min(rates) - 2*span), max(rates) + 2*span))   # Limit extrapolation
+        best = int(np.argmin(rms))
+        return {'rate': q, 'rms': self.deviation(days, a + b*q),
+                'best_rate': self.runs[best][0], 'best_rms': rms[best]}
+
+    def converged(self, est:dict) -> bool:
+        'Whether the proposed rate is within rtol of a finished run'
+        return any(abs(est['rate'] - r[0]) <= self.rtol * abs(est['rate']) for r in self.runs)
+
+    def run(self) -> dict:
+        '''Runs the search, returns the last proposal: rate, predicted rms, best run
+        rate and its rms, number of runs, and whether it converged.
+        Stops after max_runs submitted runs, or when the proposed rate gives no usable run.'''
+        if len(self.runs) < 2:
+            self.evaluate(self.rates)
+        est = None
+        while True:
+            if len(self.runs) < 2:
+                raise ValueError("Too few finished runs to search: ", [r[0] for r in self.runs])
+            est = self.propose()
+            est.update(runs=len(self.runs), converged=self.converged(est))
+            self.history.append(est)
+            print("[refuelsearch] %d runs: refuel_flow = %.6g, predicted rms %.3g, best run %.6g rms %.3g" %
+                  (est['runs'], est['rate'], est['rms'], est['best_rate'], est['best_rms']))
+            if est['converged'] or self.submitted >= self.max_runs:
+                break
+            if self.evaluate([est['rate']]) == 0:
+                print("[WARNING] Run of the proposed refuel rate failed, stopping the search: ", est['rate'])
+                break
+        return est
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a refuel rate search module.")
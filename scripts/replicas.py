@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Replica-parallel runs: one long run split into independent replicas with distinct random seeds.
+
+Each replica is the same deck with its own "set seed" and a share of the active cycles.
+The replicas are small jobs that fit into whatever cores are free, and run concurrently.
+Their results are merged by inverse-variance weighting, per burnup step:
+    mean = sum(x_i / s_i^2) / sum(1 / s_i^2),   sigma = 1 / sqrt(sum(1 / s_i^2))
+The sigma of k_eff and the conversion ratio is scaled up by the Birge ratio sqrt(chi^2/ndf)
+when the replicas scatter more than their errors, e.g. from an unconverged source.
+Detector bins are merged the same way, without the Birge scaling, which is too noisy for single bins.
+Each replica repeats the inactive cycles, the price of the shorter wall-clock time.
+
+The merged results are written into the replica run directory as <deck_name>_res.m
+and <deck_name>_det<step>.m in the Serpent format, so resfile and the other readers work on them.
+
+# Example usage:
+import replicas
+r = replicas.ReplicaRun('MSFR', {'r': 122.0, 'refl': 522.0, 'e': 0.1975, 'salt': "66.66%NaCl+33.34%UCl3",
+        'Ag_r': 300.0, 'queue': 'fill', 'ompcores': 8, 'histories': 50000, 'cycles': 800},
+        8, '/home/ondrejch/APump/replicas')
+merged = r.run()
+(k, sigma_k, chi2) = merged['ANA_KEFF']     # Arrays, burnup step x values
+print(k[-1,0], sigma_k[-1,0], merged['CONVERSION_RATIO'][0][-1,0])
+'''
+
+import os
+import re
+import math
+import numpy as np
+import resfile
+import schedulers
+import sweep
+
+MERGE_KEYS = ['ANA_KEFF', 'IMP_KEFF', 'COL_KEFF', 'ABS_KEFF', 'CONVERSION_RATIO']   # (mean, rel. error) pairs
+COPY_KEYS  = ['BURN_STEP', 'BURNUP', 'BURN_DAYS']   # The same in every replica
+DETECTORS  = ['silverflux']
+DET_MEAN   = 10                 # Detector row: 10 bin indices, mean, relative error
+SEED_STRIDE = 1000003           # Seed spacing of replicas
+
+
+def merge(means:np.ndarray, sigmas:np.ndarray, birge:bool=False) -> tuple:
+    '''Inverse-variance merge along the first axis (replicas).
+    Returns arrays (mean, sigma, chi^2/ndf). Where a replica has a zero sigma, e.g. an empty
+    detector bin, the values are averaged with equal weights.'''
+    (x, s) = (np.asarray(means, dtype=float), np.asarray(sigmas, dtype=float))
+    n = len(x)
+    positive = np.all(s > 0.0, axis=0)
+    w = np.where(positive, 1.0 / np.where(s > 0.0, s, 1.0)**2, 1.0)
+    mean = (w * x).sum(0) / w.sum(0)
+    sigma = np.where(positive, 1.0 / np.sqrt(w.sum(0)), np.sqrt((s**2).sum(0)) / n)
+    chi2 = (w * (x - mean)**2).sum(0) / max(1, n - 1) if n > 1 else np.zeros_like(mean)
+    chi2 = np.where(positive, chi2, 0.0)
+    if birge:
+        sigma = sigma * np.sqrt(np.maximum(1.0, chi2))
+    return (mean, sigma, chi2)
+
+def merge_res(res_files:list, keys:list=MERGE_KEYS) -> dict:
+    '''Merges _res.m files of replicas. Returns {key: (mean, sigma, chi^2/ndf)} of arrays,
+    burnup step x values, and {key: array} for COPY_KEYS. Steps missing in some replica are dropped.'''
+    results = [resfile.read_res(f, keys + COPY_KEYS) for f in res_files]
+    merged = {}
+    for key in keys:
+        if not all(key in r for r in results):
+            continue
+        n = min(len(r[key]) for r in results)
+        rows = np.array([r[key][:n] for r in results])          # replica x step x values
+        (x, rel) = (rows[:,:,0::2], rows[:,:,1::2])
+        merged[key] = merge(x, np.abs(x * rel), birge=True)
+    for key in COPY_KEYS:
+        if all(key in r for r in results):
+            n = min(len(r[key]) for r in results)
+            merged[key] = results[0][key][:n]
+    return merged
+
+def read_det(fname:str) -> dict:
+    '''Returns {name: 2-D array} of the blocks of a Serpent _det.m file.
+    Raises IOError if the file cannot be read.'''
+    with open(fname) as f:
+        text = f.read()
+    det = {}
+    for (name, body) in re.findall(r'^(DET\w+)\s*=\s*\[(.*?)\];', text, re.M | re.S):
+        rows = [[float(v) for v in line.split('%')[0].split()] for line in body.splitlines()]
+        det[name] = np.array([r for r in rows if r])
+    return det
+
+def merge_det(det_files:list, detectors:list=DETECTORS) -> dict:
+    '''Merges the detectors of _det.m files of replicas. Returns {block: array} in the Serpent layout,
+    the detector blocks with merged mean and relative error, the energy and mesh blocks as they are.'''
+    dets = [read_det(f) for f in det_files]
+    merged = {}
+    for d in detectors:
+        name = 'DET' + d
+        if not all(name in det for det in dets):
+            print("[WARNING] Detector not in all replicas: ", d)
+            continue
+        rows = np.array([det[name] for det in dets])            # replica x bin x columns
+        x = rows[:,:,DET_MEAN]
+        (mean, sigma, chi2) = merge(x, np.abs(x * rows[:,:,DET_MEAN+1]))
+        block = rows[0].copy()
+        block[:,DET_MEAN] = mean
+        block[:,DET_MEAN+1] = np.divide(sigma, np.abs(mean), out=np.zeros_like(mean), where=mean != 0.0)
+        merged[name] = block
+        for (other, values) in dets[0].items():     # DET<name>E and the other grids
+            if other.startswith(name) and other != name:
+                merged[other] = values
+    return merged
+
+def res_text(merged:dict, n_replicas:int) -> str:
+    'Merged results in the _res.m format, one block per burnup step'
+    steps = max(len(v[0]) if isinstance(v, tuple) else len(v) for v in merged.values())
+    output = '\n%% Merged from %d replicas, inverse-variance weighted\n' % n_replicas
+    for i in range(steps):
+        output += '\nidx = %d;\n\n' % (i + 1)
+        output += '%-32s (idx, 1) = %d ;\n' % ('REPLICAS', n_replicas)
+        chi2 = []
+        for (key, v) in merged.items():
+            if isinstance(v, tuple):
+                (mean, sigma) = (v[0][i], v[1][i])
+                rel = np.divide(sigma, np.abs(mean), out=np.zeros_like(mean), where=mean != 0.0)
+                values = ' '.join('%12.5E %9.5f' % (m, r) for (m, r) in zip(mean, rel))
+                output += '%-32s (idx, [1: %3d]) = [ %s ];\n' % (key, 2*len(mean), values)
+                chi2.append(v[2][i][0])
+            elif i < len(v):
+                values = ' '.join('%12.5E' % x for x in v[i])
+                output += '%-32s (idx, [1: %3d]) = [ %s ];\n' % (key, len(v[i]), values)
+        output += '% chi^2/ndf of the first value of each merged result above, in order\n'
+        output += '%-32s (idx, [1: %3d]) = [ %s ];\n' % ('REPLICA_CHI2', len(chi2), ' '.join('%9.4f' % c for c in chi2))
+    return output
+
+def det_text(merged:dict, n_replicas:int, detectors:list=DETECTORS) -> str:
+    'Merged detectors in the _det.m format'
+    output = '\n%% Merged from %d replicas, inverse-variance weighted\n' % n_replicas
+    for (name, block) in merged.items():
+        output += '\n%s = [\n' % name
+        for row in block:
+            if name[3:] in detectors:      # Bin indices, mean, relative error
+                output += ' '.join('%4d' % v for v in row[:DET_MEAN]) + \
+                          ' %12.5E %7.5f\n' % (row[DET_MEAN], row[DET_MEAN+1])
+            else:
+                output += ' '.join('%12.5E' % v for v in row) + '\n'
+        output += '];\n'
+    return output
+
+def replica_seeds(n:int, seed0:int=1) -> list:
+    'Distinct random number seeds of n replicas'
+    return [seed0 + i * SEED_STRIDE for i in range(n)]
+
+
+class ReplicaRun(object):
+    '''One run split into replicas with distinct seeds, run concurrently and merged'''
+    def __init__(self, core:str, fixed:dict, replicas:int, path:str='/tmp/replicas',
+                 scheduler:schedulers.Scheduler=None):
+        if replicas < 1:
+            raise ValueError("At least one replica needed: ", replicas)
+        self.core:str       = core          # 'MSFR' or 'MCRE'
+        self.fixed:dict     = dict(fixed or {})  # Core parameters, as in sweep specs, cycles of the whole run
+        self.replicas:int   = replicas      # Number of replicas
+        self.path:str       = path          # Run directory, one directory per replica, merged results
+        self.seed0:int      = 1             # Seed of the first replica
+        self.split_cycles:bool = True       # Replicas share the active cycles, else each runs all of them
+        self.detectors:list = list(DETECTORS)  # Detectors to merge
+        self.poll_interval:float = 30.0     # Seconds between job status polls
+        self.scheduler      = scheduler or schedulers.LocalScheduler()
+        self.merged:dict    = None          # Merged results of run()
+
+    def __repr__(self):
+        return "ReplicaRun of %s, %d replicas" % (self.core, self.replicas)
+
+    def make_core(self, i:int):
+        'Core object of replica i, with its seed and deck directory'
+        c = sweep.make_core(self.core, dict(self.fixed, seed=replica_seeds(self.replicas, self.seed0)[i]))
+        if self.split_cycles:
+            c.cycles = int(math.ceil(c.cycles / self.replicas))
+        c.deck_path = os.path.join(self.path, 'replica-%03d' % i)
+        c.qsub_file = os.path.join(c.deck_path, 'run.sh')
+        c.scheduler = self.scheduler
+        return c
+
+    def run(self) -> dict:
+        '''Runs the replicas that have no results yet, merges the finished ones.
+        Returns the merged results, see merge_res.'''
+        (cores, handles) = ([], [])
+        for i in range(self.replicas):
+            c = self.make_core(i)
+            c.save_deck()
+            c.save_qsub_file()
+            if not os.path.exists(os.path.join(c.deck_path, c.deck_name + '_res.m')):
+                c.run_deck()
+                if c.job is not None:
+                    handles.append(c.job)
+            cores.append(c)
+        schedulers.JobPoller(self.scheduler, self.poll_interval).wait(handles)
+        return self.merge(cores)
+
+    def merge(self, cores:list=None) -> dict:
+        '''Merges the finished replicas, writes the merged _res.m and _det.m files
+        into the run directory, returns the merged results'''
+        if cores is None:
+            cores = [self.make_core(i) for i in range(self.replicas)]
+        deck_name = cores[0].deck_name
+        runs = [os.path.join(c.deck_path, c.deck_name) for c in cores
+                if os.path.exists(os.path.join(c.deck_path, c.deck_name + '_res.m'))]
+        if not runs:
+            raise ValueError("No finished replicas in ", self.path)
+        if len(runs) < len(cores):
+            print("[WARNING] Merging %d of %d replicas" % (len(runs), len(cores)))
+        self.merged = merge_res([r + '_res.m' for r in runs])
+        for key in ['ANA_KEFF', 'CONVERSION_RATIO']:
+            if key in self.merged and self.merged[key][2][-1,0] > 3.0:
+                print("[WARNING] Replicas disagree on %s, chi2/ndf %.1f" % (key, self.merged[key][2][-1,0]))
+        try:
+            with open(os.path.join(self.path, deck_name + '_res.m'), 'w') as f:
+                f.write(res_text(self.merged, len(runs)))
+            step = 0
+            while all(os.path.exists(r + '_det%d.m' % step) for r in runs):
+                det = merge_det([r + '_det%d.m' % step for r in runs], self.detectors)
+                if det:
+                    with open(os.path.join(self.path, deck_name + '_det%d.m' % step), 'w') as f:
+                        f.write(det_text(det, len(runs), self.detectors))
+                step += 1
+        except IOError as e:
+            print("[ERROR] Unable to write merged results into ", self.path, e)
+        return self.merged
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a replica-parallel run module.")
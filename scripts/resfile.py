@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Light reader of Serpent _res.m result files.
+
+Reads numeric result arrays, one row per burnup step, without parsing the whole file
+into objects. Serpent results come as (mean, relative error) pairs,
+keff() and value() return the mean with its absolute standard deviation.
+
+# Example usage:
+import resfile
+res = resfile.read_res('/tmp/msfr_res.m', ['ANA_KEFF', 'BURN_DAYS'])
+(k, sk) = resfile.keff('/tmp/msfr_res.m')    # k_eff at the last step
+(days, k, sk) = resfile.trajectory('/tmp/msfr_res.m', 'ABS_KEFF')
+'''
+
+import re
+import numpy as np
+
+RES_LINE = re.compile(r'^([A-Z][A-Z0-9_]*)\s+\(idx,\s*(?:\[[^\]]*\]|\d+)\)\s*=\s*\[?([^\];\']*)\]?\s*;', re.M)
+
+
+def read_res(fname:str, keys:list=None) -> dict:
+    '''Returns {name: 2-D array, burnup step x values} of the numeric results,
+    only those in keys if given. Raises IOError if the file cannot be read.'''
+    with open(fname) as f:
+        text = f.read()
+    rows = {}
+    for (name, values) in RES_LINE.findall(text):
+        if keys is not None and name not in keys:
+            continue
+        try:
+            rows.setdefault(name, []).append([float(v) for v in values.split()])
+        except ValueError:      # Not numeric
+            continue
+    res = {}
+    for (name, r) in rows.items():
+        if len(set(len(x) for x in r)) == 1:
+            res[name] = np.array(r)
+    return res
+
+def value(res:dict, key:str, step:int=-1, index:int=0) -> tuple:
+    '''Returns (mean, absolute standard deviation) of the result pair
+    at position index of the result key, at burnup step'''
+    if key not in res:
+        raise ValueError("Result not found: ", key)
+    row = res[key][step]
+    mean = row[2*index]
+    return (float(mean), float(abs(mean * row[2*index + 1])))
+
+def keff(fname:str, key:str='ANA_KEFF', step:int=-1) -> tuple:
+    'Returns (k_eff, standard deviation) at burnup step from a _res.m file'
+    return value(read_res(fname, [key]), key, step)
+
+def trajectory(fname:str, key:str='ABS_KEFF', time_key:str='BURN_DAYS') -> tuple:
+    'Returns arrays (burnup days, mean, standard deviation) of a result over the depletion'
+    res = read_res(fname, [key, time_key])
+    if key not in res or time_key not in res:
+        raise ValueError("Result not found: ", key, time_key)
+    n = min(len(res[key]), len(res[time_key]))     # Last step may be cut off in a killed run
+    mean = res[key][:n, 0]
+    return (res[time_key][:n, 0], mean, abs(mean * res[key][:n, 1]))
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a Serpent result file reader module.")
@@ -6,8 +6,10 @@
 # 2019-08-06
 # GNU/GPL
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import copy
+import threading
+import warnings
 import molmass          # https://pypi.org/project/molmass/
 import numpy as np
 
@@ -35,22 +37,75 @@ MOLARVOLUMES = { # Melt composition molar volumes at 600 and 800 degC
     'ThF4': (46.6,  47.7),
     'UF4' : (45.5,  46.7)}
 
+U236_MASS = 236.0455611    # Not in the molmass database
+
+def uranium_abundances(e):
+    '''Uranium isotopic abundances {A: abundance} for U-235 enrichment e,
+    U-234 and U-236 scale with the enrichment. Works on numpy arrays.'''
+    wf_u234 = 0.0089 * e
+    wf_u236 = 0.0046 * e
+    wf_u238 = 1.0 - (wf_u234 + e + wf_u236)
+    return {234: wf_u234, 235: e, 236: wf_u236, 238: wf_u238}
+
+# Material card line templates, one line per isotope
+SERPENT_ISO_CARD = "%3d%03d.%s  %14.12f    %%  %s-%d\n"    # ZA, lib, -wf, symbol, A
+MCNP_ISO_CARD    = "       %3d%03d.%s  %14.12f\n"          # ZA, lib, -wf
+SCALE_ISO_CARD   = "%s-%d %s den=%s %s %s end\n"          # symbol, A, mix, density, wf, tempK
+MAT_CARDS_CACHE_SIZE = 64   # Rendered cards kept per salt
+
+# Salt isotopic composition entry, isotopes repeat per melt parts
+SaltIso = namedtuple("SaltIso", "Z A atoms amass wfrac molefract")
+
 class MeltPart(object):
     'Storage for salt density fit calculation'
-    def __init__(self, f:str, molf:float, enr:float):
+    def __init__(self, f:str, molf:float, enr:float, li7dep:float=0.99990):
         try:
             self.molar_vols = MOLARVOLUMES[f]
         except:
             raise ValueError("Molar volumes of "+f+" undefined!")
         self.formula:str      = f
         self.molar_frac:float = molf
-        self.s = Salt("100%"+f, enr)
+        self.s = get_salt("100%"+f, enr, li7dep=li7dep)
     def __repr__(self):
         return "%s, %s" % (repr(self.formula), repr(self.s))
 
+class IsotopeTable(object):
+    '''Isotope database of a salt. Elements are looked up by symbol or Z, same as
+       molmass.ELEMENTS, which is shared by all salts and never modified.
+       Elements with changed abundances are copied to a small per-salt overlay on first write.'''
+    def __init__(self, base=molmass.ELEMENTS):
+        self.base     = base    # Shared read-only isotope database
+        self.overlay  = {}      # symbol -> private copy of the molmass.Element
+    def __getitem__(self, key):
+        ele = self.base[key]
+        return self.overlay.get(ele.symbol, ele)
+    def __contains__(self, key) -> bool:
+        return key in self.base
+    def __repr__(self):
+        return "IsotopeTable, overrides: %s" % repr(sorted(self.overlay.keys()))
+
+    def _writable(self, symbol:str):
+        'Returns private copy of an element, copy the isotopes from the base table if needed'
+        ele = self[symbol]
+        if ele.symbol not in self.overlay:
+            ele = copy.copy(ele)
+            ele.isotopes = { A: molmass.Isotope(i.mass, i.abundance, i.massnumber)
+                             for A, i in ele.isotopes.items() }
+            self.overlay[ele.symbol] = ele
+        return ele
+
+    def set_abundance(self, symbol:str, A:int, abundance:float, mass:float=None):
+        'Sets isotope abundance, adds the isotope to the element if its mass is passed'
+        ele = self._writable(symbol)
+        if mass is not None:
+            ele.isotopes[A] = molmass.Isotope(mass, abundance, A)
+        else:
+            ele.isotopes[A].abundance = abundance
+
+
 class IsoWeightFraction(object):
     '''Class for salts isotopic weight fractions.
-       Ntuples are immutable in Python, use a class instead'''
+       Kept for callers of the former list form of Salt.wflist, see Salt.iso_weight_fractions'''
     def __init__(self, Z:int, A:int, wf:float):
         self.Z:int      = Z
         self.A:int      = A
@@ -58,10 +113,106 @@ class IsoWeightFraction(object):
     def __repr__(self):
         return "%2i %3i  %10.8f" % (self.Z, self.A, self.wf)
 
+# Isotopic weight fractions of a salt, one row per unique isotope, sorted by ZA
+ISO_WF_DTYPE = np.dtype([('Z', np.int32), ('A', np.int32), ('amass', np.float64), ('wf', np.float64)])
+
+
+class ChlorideDensity(object):
+    '''Density of (1-x)NaCl-xUCl3 melts, x is the UCl3 mole fraction.
+    Coefficients for the salt composition are evaluated once, at construction.'''
+    # rho = a + b/1e3  T
+    XMOL = np.array([1.6, 8.7, 24.7, 53.8])           # mol% of UCl3 in NaCl+UCl3
+    A    = np.array([2.2075, 2.7796, 4.2900, 6.6390])
+    B    = np.array([-0.5655, -0.6828, -1.5903, -3.0582])
+
+    def __init__(self, x:float):
+        self.x:float = x                            # UCl3 mole fraction
+        (self.a, self.b) = self.coefficients(x)     # Interpolated a, b for this x
+
+    @classmethod
+    def from_melt_fracs(cls, melt_fracs:list):
+        'Model for Salt.melt_fracs, which has to be NaCl + UCl3'
+        if len(melt_fracs) != 2:
+            raise ValueError("Only NaCl + UCl3 melts are supported: ", melt_fracs)
+        ((mNaCl, wNaCl), (mUCl3, wUCl3)) = melt_fracs
+        if mNaCl != 'NaCl':
+            raise ValueError("First component has to be NaCl: ", melt_fracs)
+        if mUCl3 != 'UCl3':
+            raise ValueError("Second component has to be UCl3: ", melt_fracs)
+        if abs(wNaCl+wUCl3-1.0) > 0.1:
+            raise ValueError("Component mixture have to add to 100%: ", melt_fracs)
+        return cls(wUCl3)
+
+    @classmethod
+    def coefficients(cls, x):
+        '''Interpolation based on Table 572, page 1135 of https://aip.scitation.org/doi/pdf/10.1063/1.555527
+        Molten salts: Volume 4, part 2, chlorides and mixtures—electrical conductance, density,
+        viscosity, and surface tension data'''
+        x = np.asarray(x)*100.0                     # fraction -> %
+        if np.any(x<1.59) or np.any(x>53.81):
+            raise ValueError("UCl3 fraction has to be 1.6 to 53.8% :", x)
+        return (np.interp(x, cls.XMOL, cls.A), np.interp(x, cls.XMOL, cls.B))
+
+    @classmethod
+    def interpolation(cls, x, tempK):
+        'Density [g/cm3] for UCl3 mole fraction(s) x and temperature(s) in K'
+        (ia, ib) = cls.coefficients(x)
+        return ia + ib*1e-3*tempK
+
+    @staticmethod
+    def equation_BoLiShengDai(x, tempK):
+        '''Density calcualtion using Equation 4 from https://doi.org/10.1016/j.molliq.2019.112184
+        x is the UCl3 fraction '''
+        x = np.asarray(x)
+        rho = 2.1445 + 5.3997*x - 1.8586*(x**2) - 9.2338*(x**3) + 6.1912*(x**4) + \
+        (-5.4859e-4 - 1.2053e-4*x - 5.5020e-3*x**2 + 1.1547e-2*x**3 - 6.8864e-3*x**4)*tempK
+        return rho
+
+    def densityK(self, tempK, x=None):
+        'Density [g/cm3] at temperature(s) in K, for the salt or for UCl3 mole fraction(s) x'
+        if x is None:
+            return self.a + self.b*1e-3*tempK
+        return self.interpolation(x, tempK)
+
+    def densityC(self, tempC, x=None):
+        return self.densityK(tempC + 273.15, x)
+
+
+class MolarVolumeDensity(object):
+    '''Molar counting density of melts with known molar volumes at 600 and 800 degC,
+    linear in temperature. Coefficients for the salt composition are passed from the fit.'''
+    def __init__(self, comps:list, molar_masses:list, a:float, b:float):
+        self.comps       = comps                    # Melt components
+        self.molar_masses= np.array(molar_masses)   # Their molar masses [g/mole]
+        self.volumes     = np.array([MOLARVOLUMES[c] for c in comps])  # [ncomp x 2]
+        self.a:float     = a    # Linear density interpolation slope
+        self.b:float     = b    # Intercept
+
+    def coefficients(self, molefracs):
+        'Slope and intercept for mole fractions array [... x ncomp]'
+        molefracs = np.asarray(molefracs)
+        weight = molefracs @ self.molar_masses
+        volume = molefracs @ self.volumes
+        density_600C = weight / volume[...,0]
+        density_800C = weight / volume[...,1]
+        a = (density_800C - density_600C) / (800.0 - 600.0)
+        return (a, density_600C - a*600.0)
+
+    def densityC(self, tempC, molefracs=None):
+        'Density [g/cm3] at temperature(s) in degC, for the salt or for an array of mole fractions'
+        if molefracs is None:
+            return self.a * tempC + self.b
+        (a, b) = self.coefficients(molefracs)
+        return a * tempC + b
+
+    def densityK(self, tempK, molefracs=None):
+        return self.densityC(tempK - 273.15, molefracs)
+
+
 class Salt(object):
     'Class for salt parsing, based on salt formula and enrichment'
-    def __init__(self, f:str="72%LiF + 16%BeF2 + 12%UF4", e:float=0.02):
-        'Constructor using salt formula, uranium enrichment, and salt density'
+    def __init__(self, f:str="72%LiF + 16%BeF2 + 12%UF4", e:float=0.02, li7dep:float=0.99990):
+        'Constructor using salt formula, uranium enrichment, and Li-7 depletion level'
         try:
             f = f.strip().replace(" ", "")
         except:
@@ -70,32 +221,38 @@ class Salt(object):
             raise ValueError("Enrichment has to be 0-1: ", e)
 
         self.formula:str    = f         # Chemical formula for a salt
+        try:                            # Melt components and their mole fractions
+            self.melt_fracs = [ (comp, float(mfract)/100.0) for (mfract, comp) in
+                                (meltpart.split('%') for meltpart in f.split('+')) ]
+        except ValueError:
+            raise ValueError("Formula " + f + " error")
         self.enr:float      = e         # Uranium enrichment
-        self.Li7dep:float   = 0.99990   # Li-7 depletion level
+        self.Li7dep:float   = li7dep    # Li-7 depletion level
+        self.frozen:bool    = False     # Frozen salts are shared, see get_salt()
         self.mol_mass:float = None      # Molar mass of the salt
         # Salt isotopic composition - isotopes repeat per melt parts
         self.isolist = []   # For internal processing use only
-        self.SaltIso = namedtuple("SaltIso", "Z A atoms amass wfrac molefract")
-        # Salt isotopic weight fractions, each isotope is unique
-        self.wflist = []
+        self.SaltIso = SaltIso
+        # Salt isotopic weight fractions, each isotope is unique, ISO_WF_DTYPE array
+        self.composition = None
+        self.mat_rows    = None     # Composition rows for the card writers
+        self.mat_cards   = {}       # Rendered material cards cache
 
         # Update database if isotopes for our MSR enrichments
-        self.ELEMENTS = copy.deepcopy(molmass.ELEMENTS) # Local copy to allow different enrichments
-        self.ELEMENTS['Li'].isotopes[6].abundance  = 1.0 - self.Li7dep
-        self.ELEMENTS['Li'].isotopes[7].abundance  = self.Li7dep
-        wf_u234:float = 0.0089 * self.enr
-        wf_u236:float = 0.0046 * self.enr
-        wf_u238:float = 1.0 - (wf_u234 + self.enr + wf_u236)
-
-        self.ELEMENTS['U'].isotopes[234].abundance = wf_u234
-        self.ELEMENTS['U'].isotopes[235].abundance = self.enr
-        self.ELEMENTS['U'].isotopes[236]=molmass.Isotope(236.0455611, wf_u236, 236) # Add to dbase
-        self.ELEMENTS['U'].isotopes[238].abundance = wf_u238
+        self.ELEMENTS = IsotopeTable()  # Shared database, only Li, U, and Cl are overridden
+        self.ELEMENTS.set_abundance('Li', 6, 1.0 - self.Li7dep)
+        self.ELEMENTS.set_abundance('Li', 7, self.Li7dep)
+        for (A, wf_u) in uranium_abundances(self.enr).items():
+            if A == 236:    # Add to dbase
+                self.ELEMENTS.set_abundance('U', A, wf_u, U236_MASS)
+            else:
+                self.ELEMENTS.set_abundance('U', A, wf_u)
 
         # Density calculation
         self.melt_parts = []        # List of , enr:floatMeltPart objects
         self.density_a:float = None # Linear density interpolation slope
         self.density_b:float = None # Intercept
+        self.density_model   = None # ChlorideDensity or MolarVolumeDensity, see get_density_model()
         self.Cl37enr:float   = None # Chlorine-37 enrichment, None for natural Cl
 
         if my_debug:
@@ -108,21 +265,17 @@ class Salt(object):
                 result += "\n"+repr(i)
         if self.mol_mass:
             result += "\nMolar mass %f g/mole" % (self.mol_mass)
-        if self.wflist:
+        if self.composition is not None:
             result += "\nIsotopic Weight fractions:"
-            twf = 0.0
-            for w in self.wflist:
-                twf += w.wf
-                result += "\n"+repr(w)
-            result += "\n---Sum: %10.8f" % twf
+            for (Z, A, amass, wf) in self.composition.tolist():
+                result += "\n%2i %3i  %10.8f" % (Z, A, wf)
+            result += "\n---Sum: %10.8f" % self.composition['wf'].sum()
         return result
 
     def _formula_parse_iso(self):
         'Parse chemical formula of the salt and get list of all isotopes'
         tot_moles:float = 0.0                   # Total molar fraction, should add to 1
-        for meltpart in self.formula.split('+'):# Separate melt components
-            mfract, comp = meltpart.split('%')  # Separate component pct. fractions
-            mfract = float(mfract)/100.0        # Molar % -> fraction
+        for (comp, mfract) in self.melt_fracs:  # Melt components and molar fractions
             tot_moles += mfract                 # Add molar fractions of compositions
             comp_f = molmass.Formula(comp)      # Turn component into a molmass formula
             for symbol in comp_f._elements:     # Elements in a component
@@ -161,29 +314,54 @@ class Salt(object):
             self._formula_parse_iso()
         if not self.mol_mass:   # Establish molar mass of the salt
             self._molar_mass()
-        for i in self.isolist:  # Process all isotopes in the isolist
-            w_l = [x for x in self.wflist if x.Z==i.Z and x.A==i.A]
-            if not w_l:         # Isotope not in self.wflist, add new one
-                iwf = IsoWeightFraction(i.Z, i.A, i.molefract * i.atoms * i.amass * i.wfrac)
-                self.wflist.append(iwf)
-            else:               # Isotope is in self.wflist, add to the mass
-                if len(w_l) > 1:    # We should get list of length 1, each isotope is unique
-                    raise Exception("Error: there should only be one ", w_l)
-                w = w_l[0]
-                w.wf += i.molefract * i.atoms * i.amass * i.wfrac
-        twf = 0.0               # Total weight fraction, should add to 1
-        for w in self.wflist:   # Normalize each isotope by molar mass of the salt
-            w.wf /= self.mol_mass   # Fraction of the mass of that isotope
-            twf += w.wf         # Add each weight fraction
-        if abs(twf - 1.0) > 1e-12:          # Sanity check
+        iso = np.array(self.isolist, dtype=np.float64)  # Columns as in SaltIso
+        za  = iso[:,0].astype(np.int64)*1000 + iso[:,1].astype(np.int64)
+        (uza, first, idx) = np.unique(za, return_index=True, return_inverse=True)
+        comp = np.zeros(len(uza), dtype=ISO_WF_DTYPE)
+        comp['Z']     = uza // 1000
+        comp['A']     = uza % 1000
+        comp['amass'] = iso[first,3]
+        # Group by isotope: add masses of the isotope from all melt parts
+        comp['wf']    = np.bincount(idx, weights=iso[:,5]*iso[:,2]*iso[:,3]*iso[:,4], minlength=len(uza))
+        comp['wf']   /= self.mol_mass   # Normalize each isotope by molar mass of the salt
+        if abs(comp['wf'].sum() - 1.0) > 1e-12:          # Sanity check
             raise ValueError("Error: weight fractions do not add to 1.0!")
+        self.composition = comp
+        self.mat_rows    = None
+        self.mat_cards   = {}
+
+    @property
+    def wflist(self) -> np.recarray:
+        'Isotopic weight fractions, record array view with Z, A, amass, and wf fields'
+        if self.composition is None:    # Generate isotopic weight fractions
+            self._isotopic_fractions()
+        return self.composition.view(np.recarray)
+
+    def iso_wf(self, Z:int, A:int) -> float:
+        'Returns weight fraction of isotope Z, A; 0 if not in the salt'
+        comp = self.wflist
+        za = comp['Z'].astype(np.int64)*1000 + comp['A']
+        i  = np.searchsorted(za, Z*1000 + A)
+        if i < len(za) and za[i] == Z*1000 + A:
+            return float(comp['wf'][i])
+        return 0.0
+
+    def iso_weight_fractions(self) -> list:
+        'Isotopic weight fractions as a list of IsoWeightFraction copies, the former form of wflist'
+        return [IsoWeightFraction(int(Z), int(A), float(wf)) for (Z, A, amass, wf) in self.wflist.tolist()]
+
+    def freeze(self):
+        'Evaluates the composition and makes the salt read-only, so that it can be shared'
+        if self.composition is None:
+            self._isotopic_fractions()
+        self.isolist = tuple(self.isolist)
+        self.composition.flags.writeable = False
+        self.frozen = True
 
     def _fit_density(self):
         'Uses molar counting method to get density fit coefficients'
-        for m in self.formula.split('+'):   # Separate melt components
-            mfract, comp = m.split('%')     # Separate component pct. fractions
-            mfract = float(mfract)/100.0    # Molar % -> fraction
-            self.melt_parts.append( MeltPart(comp, mfract, self.enr) )
+        for (comp, mfract) in self.melt_fracs:  # Melt components and molar fractions
+            self.melt_parts.append( MeltPart(comp, mfract, self.enr, self.Li7dep) )
         weight_600C = 0.0
         weight_800C = 0.0
         volume_600C = 0.0
@@ -199,79 +377,77 @@ class Salt(object):
         density_800C = weight_800C / volume_800C
         self.density_a = (density_800C - density_600C) / (800.0 - 600.0)
         self.density_b = density_600C - self.density_a*600.0
+        self.density_model = MolarVolumeDensity([mp.formula for mp in self.melt_parts],
+            [mp.s.get_molar_mass() for mp in self.melt_parts], self.density_a, self.density_b)
         if my_debug:
             print("  Density at 600 and 800C:", density_600C, density_800C)
             print("  Fit a, b:", self.density_a, self.density_b)
 
-    def densityK(self, tempK:float) -> float:
-        'Returns density [g/cm3] based on temperature in Kelvin'
+    def get_density_model(self):
+        'Returns density model of the salt, built on the first call'
+        if self.density_model is None:
+            if 'UCl' in self.formula:   # Chlorides handled separately, no molar volumes available
+                self.density_model = ChlorideDensity.from_melt_fracs(self.melt_fracs)
+            else:
+                self._fit_density()
+        return self.density_model
+
+    def densityK(self, tempK):
+        'Returns density [g/cm3] based on temperature in Kelvin, works on numpy arrays'
         return self.densityC(tempK - 273.15)
 
-    def densityC(self, tempC:float) -> float:
-        'Returns density [g/cm3] based on temperature in degC'
+    def densityC(self, tempC):
+        'Returns density [g/cm3] based on temperature in degC, works on numpy arrays'
         if 'UCl' in self.formula:   # Chlorides handled separately, no molar volumes available
             return self.chloride_densityC(tempC)
-        if density_warn and (tempC < 600 or tempC > 800):
+        if density_warn and (np.any(tempC < 600) or np.any(tempC > 800)):
             print("Warning: temperature data is interpolated between 600 and 800C.")
-        if not self.density_a or not self.density_b:
-            self._fit_density()     # Necessary to prevent infinite recursion..
-        return self.density_a * tempC + self.density_b
+        return self.get_density_model().densityC(tempC)
 
     def set_chlorine_37Cl_fraction(self, f:float):
-        'Sets chlorine-37 mass fraction, only makes sense for chloride systems'
+        '''Sets chlorine-37 mass fraction, only makes sense for chloride systems. Returns the salt.
+        A frozen salt is shared and stays unchanged: this is deprecated for it, and returns
+        the salt with the Cl37 fraction from the salt cache instead.'''
         if f<0 or f>1.0:
             raise ValueError("Cl37 enrichment has to be 0-1: ", f)
+        if self.frozen:
+            warnings.warn("Frozen salt " + self.formula + " is not modified, use the returned salt, "
+                          "or get_salt() with the Cl37 fraction", DeprecationWarning, stacklevel=2)
+            return get_salt(self.formula, self.enr, f, self.Li7dep)
         self.Cl37enr = f
-        self.ELEMENTS['Cl'].isotopes[35].abundance  = 1.0 - self.Cl37enr
-        self.ELEMENTS['Cl'].isotopes[37].abundance  = self.Cl37enr
-
-    def chloride_densityK(self, tempK:float) -> float:
+        self.isolist     = []       # Composition depends on chlorine, evaluate it again
+        self.mol_mass    = None
+        self.composition = None
+        self.mat_rows    = None
+        self.mat_cards   = {}
+        self.ELEMENTS.set_abundance('Cl', 35, 1.0 - self.Cl37enr)
+        self.ELEMENTS.set_abundance('Cl', 37, self.Cl37enr)
+        return self
+
+    def chloride_densityK(self, tempK):
         return self.chloride_densityC(tempK - 273.15)
 
-    def chloride_densityC(self, tempC:float) -> float:
+    def chloride_densityC(self, tempC):
         '''Chlorides are handled separately, since there is no molar volume data for chlorides.
         If chlorine is not a natural mixture, set enrichment first, after defining the salt,
         by self.set_chlorine_37Cl_fraction()
         Returns salt density, thus far works only for (1-x)NaCl-xUCl3, such as 55%NaCl+45%UCl3'''
-        (mNaCl,mUCl3) = self.formula.split('+')    # Separate melt components
-        (wNaCl,mform) = mNaCl.split('%')           # Separate component pct. fractions
-        if mform != 'NaCl':
-            raise ValueError("First component has to be NaCl: ", self.formula)
-        (wUCl3,mform) = mUCl3.split('%')           # Separate component pct. fractions
-        if mform != 'UCl3':
-            raise ValueError("Second component has to be UCl3: ", self.formula)
-        wNaCl = float(wNaCl)/100.0
-        wUCl3 = float(wUCl3)/100.0
-        if abs(wNaCl+wUCl3-1.0) > 0.1:
-            raise ValueError("Component mixture have to add to 100%: ", self.formula)
+        model = self.get_density_model()
         if self.Cl37enr is None:
             print("Warning: using natural chlorine; salt.set_chlorine_37Cl_fraction() can change it.")
         tempK = tempC + 273.15
-        #print('x=',wUCl3)
-        return self.chloride_density_interpolation(wUCl3, tempK)
+        return model.densityK(tempK)
 
-    def chloride_density_interpolation(self, x:float, tempK:float) -> float:
+    def chloride_density_interpolation(self, x, tempK):
         '''Interpolation based on Table 572, page 1135 of https://aip.scitation.org/doi/pdf/10.1063/1.555527
         Molten salts: Volume 4, part 2, chlorides and mixtures—electrical conductance, density,
-        viscosity, and surface tension data'''
-        x = x*100.0                             # fraction -> %
-        if x<1.59 or x>53.81:
-            raise ValueError("UCl3 fraction has to be 1.6 to 53.8% :", x)
-        # rho = a + b/1e3  T
-        xmol = [1.6, 8.7, 24.7, 53.8]           # mol% of UCl3 in NaCl+UCl3
-        a    = [2.2075, 2.7796, 4.2900, 6.6390]
-        b    = [-0.5655, -0.6828, -1.5903, -3.0582]
-        ia = np.interp(x, xmol, a)
-        ib = np.interp(x, xmol, b)
-        #print(ia,ib)
-        return ia + ib*1e-3*tempK
+        viscosity, and surface tension data. Works on numpy arrays.'''
+        return ChlorideDensity.interpolation(x, tempK)
 
-    def chloride_density_equation_BoLiShengDai(self, x:float, tempK:float) -> float:
+    def chloride_density_equation_BoLiShengDai(self, x, tempK):
         '''Density calcualtion using Equation 4 from https://doi.org/10.1016/j.molliq.2019.112184
-        x is the UCl3 fraction '''
-        rho = 2.1445 + 5.3997*x - 1.8586*(x**2) - 9.2338*(x**3) + 6.1912*(x**4) + \
-        (-5.4859e-4 - 1.2053e-4*x - 5.5020e-3*x**2 + 1.1547e-2*x**3 - 6.8864e-3*x**4)*tempK
-        return rho
+        x is the UCl3 fraction. Works on numpy arrays.'''
+        return ChlorideDensity.equation_BoLiShengDai(x, tempK)
 
 #    def _check_chloride_interpolations(self):
 #        'Checks different density interpolations, do not use'
@@ -293,52 +469,175 @@ class Salt(object):
         'Return salt name with spaces around + sign'
         return self.formula.replace('+',' + ')
 
+    def _mat_rows(self) -> list:
+        'Composition rows (Z, A, symbol, wf) for the card writers, built once'
+        if self.mat_rows is None:
+            self.mat_rows = [ (Z, A, self.ELEMENTS[Z].symbol, wf) for (Z, A, amass, wf) in self.wflist.tolist() ]
+        return self.mat_rows
+
+    def _cached_card(self, key:tuple, render) -> str:
+        'Returns rendered card from the card cache, renders it on a miss'
+        card = self.mat_cards.get(key)
+        if card is None:
+            if len(self.mat_cards) >= MAT_CARDS_CACHE_SIZE:
+                self.mat_cards.clear()
+            card = render()
+            self.mat_cards[key] = card
+        return card
+
+    def serpent_isotopes(self, lib="09c", dens_mod=1.0) -> str:
+        'Returns isotope lines of the Serpent material cards'
+        return self._cached_card(('serpent_iso', lib, dens_mod), lambda:
+            ''.join([ SERPENT_ISO_CARD % (Z, A, lib, -1.0*wf*dens_mod, symbol, A)
+                      for (Z, A, symbol, wf) in self._mat_rows() ]))
+
     def serpent_mat(self, tempK:float=900.0, mat_tempK:float=900.0,
                     lib="09c", rgb:str="240 30 30", dens_mod=1.0)->str:
         '''Returns Serpent deck for the salt material
         tempK is the temperature for density calculation,
         mat_tempK is the material temperature.
         This is useful for Doppler feedback calculations.'''
-        if not self.wflist:         # Generate list of isotopic weight fractions
-            self._isotopic_fractions()
         if my_debug:                # Check uranium enrichment
-            u= 0.0
-            for w in self.wflist:
-                if w.Z == 92:
-                    u += w.wf
-            for w in self.wflist:
-                if w.Z == 92:
-                    print("DEBUG SALT: %d -> %8.3f" % (w.A, 100.0*w.wf/u) )
-        mat  = "% Fuel salt: " + self.nice_name() + ", U enrichment " + str(self.enr)
-        mat += "\nmat fuelsalt %12.8f rgb %s burn 1 tmp %8.3f\n" % (-1.0*self.densityK(tempK),rgb,mat_tempK)
-        for w in self.wflist:
-            mat += "%3d%03d.%s  %14.12f" % (w.Z, w.A, lib, -1.0*w.wf*dens_mod)
-            mat += "    %  "+ self.ELEMENTS[w.Z].symbol +"-"+ str(w.A) +"\n"
-        return mat
+            wfl  = self.wflist
+            u_wf = wfl.wf[wfl.Z == 92]
+            for (A, wf) in zip(wfl.A[wfl.Z == 92], u_wf):
+                print("DEBUG SALT: %d -> %8.3f" % (A, 100.0*wf/u_wf.sum()) )
+        return self._cached_card(('serpent', tempK, mat_tempK, lib, rgb, dens_mod), lambda:
+            "% Fuel salt: " + self.nice_name() + ", U enrichment " + str(self.enr) +
+            "\nmat fuelsalt %12.8f rgb %s burn 1 tmp %8.3f\n" % (-1.0*self.densityK(tempK),rgb,mat_tempK) +
+            self.serpent_isotopes(lib, dens_mod))
 
     def mcnp_mat(self, tempK:float=900.0, mat_number=1, lib="09c", dens_mod=1.0)->str:
         '''Returns MCNP deck for the salt material
         tempK is the temperature for density calculation'''
-        if not self.wflist:         # Generate list of isotopic weight fractions
-            self._isotopic_fractions()
-        mat  = "C Fuel salt: " + self.nice_name() + ", U enrichment " + str(self.enr) + "\n"
-        mat += f"M{mat_number}\n"
-        for w in self.wflist:
-            mat += "       %3d%03d.%s  %14.12f\n" % (w.Z, w.A, lib, -1.0*w.wf*dens_mod)
-        return mat
+        return self._cached_card(('mcnp', mat_number, lib, dens_mod), lambda:
+            "C Fuel salt: " + self.nice_name() + ", U enrichment " + str(self.enr) + "\n" +
+            f"M{mat_number}\n" +
+            ''.join([ MCNP_ISO_CARD % (Z, A, lib, -1.0*wf*dens_mod) for (Z, A, symbol, wf) in self._mat_rows() ]))
 
     def scale_mat(self, tempK:float=900.0, mat_tempK:float=900.0, mix_number=1, dens_mod=1.0)->str:
         '''Returns SCALE deck for the fuel salt material.
         tempK is the temperature for density calculation,
         mat_tempK is the material temperature. This is useful for Doppler feedback calculations.
         dens_mod is density modifier. '''
-        if not self.wflist:         # Generate list of isotopic weight fractions
-            self._isotopic_fractions()
-        Nele = len( set( [x.Z for x in self.wflist] ) ) # number of elements in the mixture
-        mat  = "' Fuel salt: " + self.nice_name() + ", U enrichment " + str(self.enr) + "\n"
-        for w in self.wflist:
-            mat += f"{self.ELEMENTS[w.Z].symbol}-{w.A} {mix_number} den={self.densityK(tempK)*dens_mod} {w.wf} {mat_tempK} end\n"
-        return mat
+        def render() -> str:
+            den = self.densityK(tempK)*dens_mod
+            return "' Fuel salt: " + self.nice_name() + ", U enrichment " + str(self.enr) + "\n" + \
+                ''.join([ SCALE_ISO_CARD % (symbol, A, mix_number, den, wf, mat_tempK)
+                          for (Z, A, symbol, wf) in self._mat_rows() ])
+        return self._cached_card(('scale', tempK, mat_tempK, mix_number, dens_mod), render)
+
+
+class SaltCache(object):
+    '''Bounded LRU cache of frozen salts, keyed on formula, enrichment,
+    Cl-37 fraction, and Li-7 depletion. Use through get_salt()'''
+    def __init__(self, maxsize:int=128):
+        self.maxsize:int = maxsize  # Maximum number of cached salts
+        self.hits:int    = 0        # Lookups served from the cache
+        self.misses:int  = 0        # Lookups that built a new salt
+        self.salts       = OrderedDict()    # key -> Salt, least recently used first
+        self.lock        = threading.Lock()
+    def __len__(self) -> int:
+        return len(self.salts)
+    def __repr__(self):
+        return "SaltCache: %d/%d salts, hits %d, misses %d" % \
+            (len(self.salts), self.maxsize, self.hits, self.misses)
+
+    def get(self, f:str, e:float, cl37:float=None, li7dep:float=0.99990, store=None) -> Salt:
+        '''Returns a frozen salt, builds it if not cached.
+        store is an optional compstore.CompositionStore to read prebuilt salts from and save new ones to'''
+        key = (f.replace(" ", ""), float(e), None if cl37 is None else float(cl37), float(li7dep))
+        with self.lock:
+            s = self.salts.get(key)
+            if s is not None:
+                self.hits += 1
+                self.salts.move_to_end(key)
+                return s
+            self.misses += 1
+        s = None
+        if store is not None:
+            try:
+                s = store.load_salt(f, e, cl37, li7dep)
+            except KeyError:
+                pass
+        if s is None:
+            s = Salt(f, e, li7dep)  # Build outside the lock, MeltParts call back in
+            if cl37 is not None:
+                s.set_chlorine_37Cl_fraction(cl37)
+            s.freeze()
+            if store is not None:
+                store.save_salt(s)
+        with self.lock:
+            self.salts[key] = s
+            self.salts.move_to_end(key)
+            while len(self.salts) > self.maxsize:   # Evict least recently used
+                self.salts.popitem(last=False)
+        return s
+
+    def clear(self):
+        'Empties the cache and resets the counters'
+        with self.lock:
+            self.salts.clear()
+            self.hits   = 0
+            self.misses = 0
+
+
+salt_cache = SaltCache()
+
+def get_salt(f:str, e:float, cl37:float=None, li7dep:float=0.99990, store=None) -> Salt:
+    '''Returns frozen salt from the shared cache. Do not modify it, Cl-37 fraction
+    and Li-7 depletion are part of the cache key instead.
+    store is an optional compstore.CompositionStore with prebuilt salts'''
+    return salt_cache.get(f, e, cl37, li7dep, store)
+
+
+SaltGrid = namedtuple("SaltGrid", "Z A amass wf mol_mass")
+
+def salt_grid(enr, x, cl37=None, components=('NaCl','UCl3'), li7dep:float=0.99990) -> SaltGrid:
+    '''Isotopic weight fractions of (1-x) components[0] + x components[1] salts
+    over a grid of uranium enrichments, mole fractions x, and Cl-37 fractions.
+    enr, x, and cl37 are broadcast together and flattened to N points, cl37=None is natural chlorine.
+    The nuclide set is the same for all points, so the whole grid is evaluated at once.
+    Returns SaltGrid: Z, A, amass of the K nuclides, wf [N x K] weight fractions,
+    and mol_mass [N] molar masses [g/mole]'''
+    nat_cl37 = molmass.ELEMENTS['Cl'].isotopes[37].abundance
+    (enr, x, cl37) = [a.ravel().astype(np.float64) for a in
+        np.broadcast_arrays(enr, x, np.nan if cl37 is None else cl37)]
+    if np.any(enr < 0) or np.any(enr > 1.0):
+        raise ValueError("Enrichment has to be 0-1")
+    if np.any(x < 0) or np.any(x > 1.0):
+        raise ValueError("Mole fraction has to be 0-1")
+    cl37 = np.where(np.isnan(cl37), nat_cl37, cl37)
+    if np.any(cl37 < 0) or np.any(cl37 > 1.0):
+        raise ValueError("Cl37 enrichment has to be 0-1")
+    molefract = np.stack([1.0 - x, x], axis=1)  # [N x 2] mole fractions of the components
+
+    atoms = {}                  # symbol -> atoms per molecule of each component
+    for (c, comp) in enumerate(components):
+        for (symbol, n) in molmass.Formula(comp)._elements.items():
+            atoms.setdefault(symbol, np.zeros(len(components)))[c] += n[0]
+    Z, A, amass, abund, n_atoms = [], [], [], [], []
+    for symbol in sorted(atoms, key=lambda sym: molmass.ELEMENTS[sym].number):
+        ele = molmass.ELEMENTS[symbol]
+        if symbol == 'U':
+            iso_ab = uranium_abundances(enr)
+        elif symbol == 'Cl':
+            iso_ab = {35: 1.0 - cl37, 37: cl37}
+        elif symbol == 'Li':
+            iso_ab = {6: 1.0 - li7dep, 7: li7dep}
+        else:
+            iso_ab = { a: i.abundance for (a, i) in ele.isotopes.items() if i.abundance > 0.0 }
+        for a in sorted(iso_ab):
+            Z.append(ele.number)
+            A.append(a)
+            amass.append(U236_MASS if (symbol, a) == ('U', 236) else ele.isotopes[a].mass)
+            abund.append(np.broadcast_to(iso_ab[a], enr.shape))
+            n_atoms.append(atoms[symbol])
+    amass = np.array(amass)
+    # Mass of each nuclide in a mole of salt [N x K]
+    mass  = (molefract @ np.array(n_atoms).T) * np.stack(abund, axis=1) * amass
+    mol_mass = mass.sum(axis=1)
+    return SaltGrid(np.array(Z), np.array(A), amass, mass / mol_mass[:,None], mol_mass)
 
 
 # This executes if someone tries to run the module
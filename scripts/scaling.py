@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Scaling benchmark of hybrid MPI+OpenMP Serpent runs.
+
+The same deck runs with several layouts (nodes, MPI tasks per node, OMP threads per task),
+each in its own directory. The throughput of each run is read from its _res.m file:
+neutron histories transported (POP x (CYCLES + SKIP) over all burnup steps) per second
+of transport time, per core. Few MPI tasks with many threads share one copy of the data,
+many tasks scale better but multiply the memory, the benchmark shows where the node is best used.
+
+# Example usage:
+import scaling
+b = scaling.ScalingBenchmark('MSFR', {'r': 122.0, 'refl': 522.0, 'e': 0.1975,
+        'salt': "66.66%NaCl+33.34%UCl3", 'queue': 'fill', 'histories': 50000},
+        scaling.layouts(64, nodes=[1, 2]), '/home/ondrejch/APump/scaling')
+b.run()
+print(b.report())
+'''
+
+import os
+import schedulers
+import resfile
+import sweep
+
+THROUGHPUT_KEYS = ['POP', 'CYCLES', 'SKIP', 'TRANSPORT_CYCLE_TIME', 'MPI_TASKS', 'OMP_THREADS']
+
+
+def layouts(cores_per_node:int, nodes:list=(1,), threads:list=None) -> list:
+    '''Layouts (nodes, MPI tasks per node, OMP threads per task) filling cores_per_node,
+    threads per task from threads, or all powers of 2 dividing cores_per_node'''
+    if threads is None:
+        threads = [t for t in (2**i for i in range(cores_per_node.bit_length())) if cores_per_node % t == 0]
+    for t in threads:
+        if t < 1 or cores_per_node % t != 0:
+            raise ValueError("Threads per task do not divide the node cores: ", t, cores_per_node)
+    return [(n, cores_per_node // t, t) for n in nodes for t in sorted(threads, reverse=True)]
+
+def layout_dirname(layout:tuple) -> str:
+    'Run directory name of a layout'
+    return 'nodes%d_mpi%d_omp%d' % tuple(layout)
+
+def throughput(fname:str) -> dict:
+    '''Histories, transport time [s], cores, and histories per second and per second per core
+    of a finished run, from its _res.m file'''
+    res = resfile.read_res(fname, THROUGHPUT_KEYS)
+    missing = [k for k in THROUGHPUT_KEYS if k not in res]
+    if missing:
+        raise ValueError("Results not found: ", missing)
+    n = min(len(res[k]) for k in THROUGHPUT_KEYS)
+    histories = sum(res['POP'][i,0] * (res['CYCLES'][i,0] + res['SKIP'][i,0]) for i in range(n))
+    seconds = 60.0 * res['TRANSPORT_CYCLE_TIME'][n-1,0]     # Cumulative, in minutes
+    cores = int(res['MPI_TASKS'][0,0] * res['OMP_THREADS'][0,0])
+    if seconds <= 0.0:
+        raise ValueError("No transport time in ", fname)
+    rate = float(histories / seconds)
+    return {'histories': float(histories), 'seconds': float(seconds), 'cores': cores,
+            'rate': rate, 'rate_per_core': rate / cores}
+
+
+class ScalingBenchmark(object):
+    '''Runs one deck in several MPI+OpenMP layouts and compares their throughput'''
+    def __init__(self, core:str, fixed:dict, layouts:list, path:str='/tmp/scaling',
+                 scheduler:schedulers.Scheduler=None):
+        if not layouts:
+            raise ValueError("No layouts to benchmark")
+        self.core:str       = core          # 'MSFR' or 'MCRE'
+        self.fixed:dict     = dict(fixed or {})  # Core parameters, as in sweep specs
+        self.layouts:list   = [tuple(l) for l in layouts]  # (nodes, MPI tasks per node, OMP threads per task)
+        self.path:str       = path          # Benchmark directory, one run directory per layout
+        self.concurrent:bool = True         # Submit all layouts at once, else one after another
+        self.poll_interval:float = 30.0     # Seconds between job status polls
+        self.scheduler      = scheduler or schedulers.LocalScheduler()
+        self.results:dict   = {}            # {layout: throughput}
+
+    def __repr__(self):
+        return "ScalingBenchmark of %s, %d layouts" % (self.core, len(self.layouts))
+
+    def make_core(self, layout:tuple):
+        'Core object of a layout, with its deck directory'
+        (nodes, tasks, threads) = layout
+        c = sweep.make_core(self.core, dict(self.fixed, nodes=nodes, mpi_tasks=tasks, ompcores=threads))
+        c.deck_path = os.path.join(self.path, layout_dirname(layout))
+        c.qsub_file = os.path.join(c.deck_path, 'run.sh')
+        c.scheduler = self.scheduler
+        return c
+
+    def run(self) -> dict:
+        '''Runs the layouts that have no results yet, returns {layout: throughput},
+        None for failed runs'''
+        poller = schedulers.JobPoller(self.scheduler, self.poll_interval)
+        (cores, handles) = ({}, [])
+        for layout in self.layouts:
+            c = self.make_core(layout)
+            c.save_deck()
+            c.save_qsub_file()
+            if not os.path.exists(os.path.join(c.deck_path, c.deck_name + '_res.m')):
+                c.run_deck()
+                if c.job is not None:
+                    handles.append(c.job)
+                    if not self.concurrent:     # Layouts do not compete for nodes
+                        poller.wait([c.job])
+            cores[layout] = c
+        poller.wait(handles)
+        for (layout, c) in cores.items():
+            try:
+                self.results[layout] = throughput(os.path.join(c.deck_path, c.deck_name + '_res.m'))
+            except (IOError, ValueError, IndexError) as e:
+                print("[WARNING] No throughput of layout ", layout, e)
+                self.results[layout] = None
+        return self.results
+
+    def report(self) -> str:
+        '''Table of the throughput of each layout, the efficiency is the rate per core
+        relative to the first layout with results'''
+        lines = ['%6s %5s %5s %6s %12s %14s %8s' % ('nodes', 'mpi', 'omp', 'cores', 'hist/s', 'hist/s/core', 'eff')]
+        base = None
+        for layout in self.layouts:
+            t = self.results.get(layout)
+            if t is None:
+                lines.append('%6d %5d %5d %6s %12s' % (layout + ('-', 'failed')))
+                continue
+            if base is None:
+                base = t['rate_per_core']
+            lines.append('%6d %5d %5d %6d %12.4g %14.4g %8.3f' %
+                         (layout + (t['cores'], t['rate'], t['rate_per_core'], t['rate_per_core'] / base)))
+        return '\n'.join(lines)
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a MPI+OpenMP scaling benchmark module.")
@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Batch scheduler backends: TORQUE, Slurm, and local runs.
+
+A backend writes job scripts for a core, submits them, and queries job states.
+Submission returns a JobHandle, JobPoller tracks many handles with asyncio,
+querying job states in batches, until all jobs have ended.
+
+Scheduler commands can be replaced, e.g. by the fakesched.py stand-in
+to try a workflow on a single Linux box without a batch system.
+
+# Example usage:
+import msfr, schedulers
+sched  = schedulers.SlurmScheduler()
+jobs   = []
+for r in [121, 122, 123]:
+    mycore = msfr.MSFR(r, r + 400.0, 0.1975, "66.66%NaCl+33.34%UCl3")
+    mycore.scheduler = sched        # save_qsub_file writes #SBATCH headers, run_deck calls sbatch
+    mycore.queue     = 'batch'
+    mycore.deck_path = "/home/ondrejch/small_core/%06.1f" % r
+    mycore.qsub_file = mycore.deck_path + "/run.sh"
+    mycore.save_qsub_file()
+    mycore.save_deck()
+    mycore.run_deck()
+    jobs.append(mycore.job)
+schedulers.JobPoller(sched, interval=60).wait(jobs, on_change=print)
+'''
+
+import os
+import re
+import time
+import asyncio
+import itertools
+import threading
+import subprocess
+import localrun
+
+HANDLE_STATES = ['queued', 'running', 'done', 'failed', 'unknown']
+
+
+class JobHandle(object):
+    '''Submitted job'''
+    def __init__(self, scheduler:str, job_id:str, cwd:str, name:str=None, result_file:str=None):
+        self.scheduler:str   = scheduler    # Backend name
+        self.job_id:str      = job_id       # Scheduler job id
+        self.cwd:str         = cwd          # Job directory
+        self.name:str        = name or os.path.basename(os.path.normpath(cwd))
+        self.result_file:str = result_file  # File the job makes when it succeeds, e.g. the _res.m file
+        self.state:str       = 'queued'     # One of HANDLE_STATES
+        self.submit_time:float = time.time()
+        self.missing:int     = 0            # Polls in a row the scheduler did not know the job
+
+    def __repr__(self):
+        return "JobHandle %s %s (%s): %s" % (self.scheduler, self.job_id, self.name, self.state)
+
+    def done(self) -> bool:
+        'Whether the job has ended'
+        return self.state in ['done', 'failed']
+
+
+class Scheduler(object):
+    '''Batch scheduler interface'''
+    name:str = 'base'
+    workdir_var:str = '$(pwd)'      # Shell expression of the submission directory in a job
+
+    def header(self, job_name:str, queue:str, cores:int, mem_gb:int=None, nodes:int=1, tasks:int=1) -> str:
+        '''Job script header with the scheduler directives: nodes, MPI tasks per node,
+        cores (OMP threads) per task, and mem_gb the memory request per task'''
+        return '#!/bin/bash\n'
+
+    def job_script(self, core, job_name:str='MSFR_S2') -> str:
+        'Job script that runs the Serpent deck of a core'
+        return self.header(job_name, core.queue, core.ompcores, core.memory_request(),
+                           core.nodes, core.mpi_tasks) + f'''
+hostname
+rm -f done.dat
+cd {self.workdir_var}
+module load mpi
+module load serpent
+
+{core.serpent_command(core.deck_name, 'myout.out')} && \\
+awk 'BEGIN{{ORS="\\t"}} /ANA_KEFF/ || /CONVERSION/ {{print $7" "$8;}}' {core.deck_name}_res.m > done.out
+'''
+
+    def submit(self, script:str, cwd:str, name:str=None, after:list=None, result_file:str=None) -> JobHandle:
+        '''Submits job script from directory cwd, returns the job handle.
+        With after, the job starts only when all of these jobs have succeeded.'''
+        raise NotImplementedError
+
+    def query(self, job_ids:list) -> dict:
+        'Returns {job_id: state} for jobs the scheduler knows, in one batched query'
+        raise NotImplementedError
+
+    def cancel(self, handle:JobHandle):
+        'Removes the job from the scheduler'
+        raise NotImplementedError
+
+    def _run(self, command:list, cwd:str=None, check:bool=True) -> str:
+        'Runs a scheduler command, returns its output'
+        p = subprocess.run(command, cwd=cwd, capture_output=True, text=True)
+        if check and p.returncode != 0:
+            raise RuntimeError("%s failed: %s" % (' '.join(command), p.stderr.strip()))
+        return p.stdout
+
+
+class TorqueScheduler(Scheduler):
+    '''TORQUE/PBS: qsub, qstat, qdel'''
+    name = 'torque'
+    workdir_var = '${PBS_O_WORKDIR}'
+    STATES = {'Q': 'queued', 'H': 'queued', 'W': 'queued', 'T': 'queued', 'R': 'running', 'E': 'running'}
+
+    def __init__(self, commands:dict=None):
+        self.commands:dict = {'qsub': ['qsub'], 'qstat': ['qstat'], 'qdel': ['qdel']}
+        self.commands.update(commands or {})
+
+    def header(self, job_name:str, queue:str, cores:int, mem_gb:int=None, nodes:int=1, tasks:int=1) -> str:
+        mem = '' if mem_gb is None else ',mem=%dgb' % (mem_gb * nodes * tasks)
+        return f'''#!/bin/bash
+#PBS -V
+#PBS -N {job_name}
+#PBS -q {queue}
+#PBS -l nodes={nodes}:ppn={tasks * cores}{mem}
+'''
+
+    def submit(self, script:str, cwd:str, name:str=None, after:list=None, result_file:str=None) -> JobHandle:
+        command = list(self.commands['qsub'])
+        if after:
+            command += ['-W', 'depend=afterok:' + ':'.join(h.job_id for h in after)]
+        job_id = self._run(command + [script], cwd).strip()
+        return JobHandle(self.name, job_id, cwd, name, result_file)
+
+    def query(self, job_ids:list) -> dict:
+        out = self._run(self.commands['qstat'] + ['-f'] + list(job_ids), check=False)
+        states = {}
+        for block in re.split(r'^Job Id:\s*', out, flags=re.M)[1:]:
+            job_id = block.split()[0]
+            state = re.search(r'job_state\s*=\s*(\w)', block)
+            if state is None:
+                continue
+            if state.group(1) == 'C':
+                exit_status = re.search(r'exit_status\s*=\s*(-?\d+)', block)
+                states[job_id] = 'done' if exit_status and int(exit_status.group(1)) == 0 else 'failed'
+            else:
+                states[job_id] = self.STATES.get(state.group(1), 'unknown')
+        return states
+
+    def cancel(self, handle:JobHandle):
+        self._run(self.commands['qdel'] + [handle.job_id], check=False)
+
+
+class SlurmScheduler(Scheduler):
+    '''Slurm: sbatch, squeue, sacct, scancel'''
+    name = 'slurm'
+    workdir_var = '${SLURM_SUBMIT_DIR}'
+    STATES = {'PENDING': 'queued', 'CONFIGURING': 'queued', 'REQUEUED': 'queued', 'SUSPENDED': 'queued',
+              'RUNNING': 'running', 'COMPLETING': 'running', 'COMPLETED': 'done'}
+
+    def __init__(self, commands:dict=None):
+        self.commands:dict = {'sbatch': ['sbatch'], 'squeue': ['squeue'], 'sacct': ['sacct'], 'scancel': ['scancel']}
+        self.commands.update(commands or {})
+
+    def header(self, job_name:str, queue:str, cores:int, mem_gb:int=None, nodes:int=1, tasks:int=1) -> str:
+        mem = '' if mem_gb is None else '#SBATCH --mem=%dG\n' % (mem_gb * tasks)    # Per node
+        return f'''#!/bin/bash
+#SBATCH --export=ALL
+#SBATCH -J {job_name}
+#SBATCH -p {queue}
+#SBATCH -N {nodes}
+#SBATCH --ntasks-per-node={tasks}
+#SBATCH --cpus-per-task={cores}
+{mem}'''
+
+    def submit(self, script:str, cwd:str, name:str=None, after:list=None, result_file:str=None) -> JobHandle:
+        command = self.commands['sbatch'] + ['--parsable']
+        if after:
+            command += ['--dependency=afterok:' + ':'.join(h.job_id for h in after)]
+        job_id = self._run(command + [script], cwd).strip().split(';')[0]
+        return JobHandle(self.name, job_id, cwd, name, result_file)
+
+    def _parse(self, out:str, sep:str) -> dict:
+        states = {}
+        for line in out.splitlines():
+            fields = line.strip().split(sep)
+            if len(fields) < 2:
+                continue
+            state = fields[1].split()[0] if fields[1].strip() else ''
+            states[fields[0]] = self.STATES.get(state, 'failed')  # FAILED, CANCELLED, TIMEOUT, ...
+        return states
+
+    def query(self, job_ids:list) -> dict:
+        ids = ','.join(job_ids)
+        states = self._parse(self._run(self.commands['squeue'] + ['-h', '-o', '%i %T', '-j', ids], check=False), ' ')
+        ended = [i for i in job_ids if i not in states]
+        if ended:           # Jobs that left the queue are in the accounting
+            states.update(self._parse(self._run(self.commands['sacct'] +
+                ['-n', '-X', '-P', '-o', 'JobID,State', '-j', ','.join(ended)], check=False), '|'))
+        return {i: s for (i, s) in states.items() if i in job_ids}
+
+    def cancel(self, handle:JobHandle):
+        self._run(self.commands['scancel'] + [handle.job_id], check=False)
+
+
+class LocalScheduler(Scheduler):
+    '''Runs jobs on this box through a localrun.LocalRunner'''
+    name = 'local'
+    workdir_var = '${PBS_O_WORKDIR}'    # Set by LocalRunner
+    STATES = {'queued': 'queued', 'running': 'running', 'done': 'done'}     # Rest failed
+
+    def __init__(self, runner:localrun.LocalRunner=None):
+        self.runner = runner or localrun.LocalRunner()
+        self.jobs:dict = {}         # job_id: LocalJob
+        self.ids = itertools.count()    # Job ids, unique also for concurrent submits
+        self.lock = threading.Lock()
+
+    def submit(self, script:str, cwd:str, name:str=None, after:list=None, result_file:str=None) -> JobHandle:
+        job = self.runner.submit(['bash', script], cwd, name,
+                                 after=[self.jobs[h.job_id] for h in after] if after else None)
+        with self.lock:
+            job_id = str(next(self.ids))
+            self.jobs[job_id] = job
+        return JobHandle(self.name, job_id, cwd, name, result_file)
+
+    def query(self, job_ids:list) -> dict:
+        return {i: self.STATES.get(self.jobs[i].state, 'failed') for i in job_ids if i in self.jobs}
+
+    def cancel(self, handle:JobHandle):
+        self.runner.cancel(self.jobs[handle.job_id])
+
+
+SCHEDULERS = {'torque': TorqueScheduler, 'slurm': SlurmScheduler, 'local': LocalScheduler}
+
+def get_scheduler(name:str, **kwargs) -> Scheduler:
+    'Returns scheduler backend by name'
+    if name not in SCHEDULERS:
+        raise ValueError("Unknown scheduler: ", name, list(SCHEDULERS))
+    return SCHEDULERS[name](**kwargs)
+
+
+class JobPoller(object):
+    '''Tracks job handles until they end, querying the scheduler in batches'''
+    def __init__(self, scheduler:Scheduler, interval:float=30.0, batch_size:int=500,
+                 max_queries:int=4, missing_limit:int=3):
+        self.scheduler           = scheduler
+        self.interval:float      = interval     # Seconds between polls
+        self.batch_size:int      = batch_size   # Job ids per status query
+        self.max_queries:int     = max_queries  # Status queries running at the same time
+        self.missing_limit:int   = missing_limit # Polls a job may be unknown before it is resolved
+
+    async def _query(self, batch:list, semaphore) -> dict:
+        async with semaphore:
+            return await asyncio.to_thread(self.scheduler.query, batch)
+
+    def _resolve_missing(self, h:JobHandle) -> str:
+        '''State of a job the scheduler forgot: done if its result file exists,
+        failed if not, done if no result file is known'''
+        if h.result_file is None:
+            return 'done'
+        return 'done' if os.path.exists(h.result_file) else 'failed'
+
+    async def poll(self, handles:list, on_change=None) -> list:
+        '''Polls until all jobs end. on_change(handle, old_state) is called
+        on every state change. Returns the handles.'''
+        semaphore = asyncio.Semaphore(self.max_queries)
+        while True:
+            active = [h for h in handles if not h.done()]
+            if not active:
+                return handles
+            batches = [active[i:i+self.batch_size] for i in range(0, len(active), self.batch_size)]
+            results = await asyncio.gather(*(self._query([h.job_id for h in b], semaphore) for b in batches))
+            for (batch, states) in zip(batches, results):
+                for h in batch:
+                    old = h.state
+                    if h.job_id in states:
+                        h.missing = 0
+                        h.state = states[h.job_id]
+                    else:
+                        h.missing += 1
+                        h.state = self._resolve_missing(h) if h.missing >= self.missing_limit else 'unknown'
+                    if h.state != old and on_change is not None:
+                        on_change(h, old)
+            if all(h.done() for h in handles):
+                return handles
+            await asyncio.sleep(self.interval)
+
+    def wait(self, handles:list, on_change=None) -> list:
+        'Blocking poll, see poll()'
+        return asyncio.run(self.poll(handles, on_change))
+
+    @staticmethod
+    def summary(handles:list) -> dict:
+        'Returns {state: count}'
+        states = [h.state for h in handles]
+        return {s: states.count(s) for s in HANDLE_STATES if s in states}
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a batch scheduler module.")
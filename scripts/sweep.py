@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Declarative parameter sweeps over MSFR and MCRE cores.
+
+A sweep spec is a dictionary:
+    core    - core class name in msfr, 'MSFR' or 'MCRE'
+    fixed   - constructor arguments and attributes shared by all points
+    product - axes combined as a Cartesian product
+    zip     - lists varied together, one product axis; a list of such dicts for several groups
+Axis values are lists or arrays, or {'linspace': [start, stop, num]}, {'geomspace': [start, stop, num]},
+{'arange': [start, stop, step]}. Names matching the core constructor arguments (r, refl, e, salt, Ag_r, ...)
+are passed to the constructor, all other names are set as core attributes after construction.
+
+Each point gets a deck directory named after its varied parameters, so the layout
+does not depend on the order of points or on the number of workers.
+All decks are written by a process pool, the manifest of points is returned
+and saved as manifest.json in the sweep directory.
+
+With warm_start, every point saves its converged fission source, and points generated
+after some neighbours have finished start from the source of the nearest finished point
+with fewer inactive cycles (MSFRbase.warm_inactive).
+
+# Example usage:
+import sweep
+spec = {'core': 'MSFR',
+        'fixed': {'r': 122.0, 'refl': 522.0, 'e': 0.1975, 'salt': "66.66%NaCl+33.34%UCl3", 'Ag_r': 300.0,
+                  'power': 1e9, 'deplete': 10, 'queue': 'fill', 'ompcores': 32, 'histories': 10000},
+        'product': {'refuel_flow': {'linspace': [2.8e-10, 2.9e-10, 11]}}}
+s = sweep.Sweep(spec, '/home/ondrejch/APump/final_run/refuel_search')
+manifest = s.generate()
+s.submit_array()            # One TORQUE job array over all points
+# or one job per point:
+for core in s.cores():
+    core.run_deck()
+'''
+
+import os
+import re
+import json
+import inspect
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import msfr
+import deckcache
+
+SWEEP_CORES = ['MSFR', 'MCRE']
+AXIS_GENERATORS = {'linspace': np.linspace, 'geomspace': np.geomspace, 'arange': np.arange}
+
+
+def expand_axis(values) -> list:
+    'Returns list of plain Python values of an axis'
+    if isinstance(values, dict):
+        if len(values) != 1 or list(values)[0] not in AXIS_GENERATORS:
+            raise ValueError("Bad axis, use one of %s: " % list(AXIS_GENERATORS), values)
+        (gen, args) = list(values.items())[0]
+        values = AXIS_GENERATORS[gen](*args)
+    if isinstance(values, (str, bytes)) or np.ndim(values) == 0:
+        values = [values]
+    return [v.item() if isinstance(v, np.generic) else v for v in values]
+
+def sweep_points(spec:dict) -> list:
+    'Returns list of {name: value} of all the varied parameters, in spec order'
+    axes = []                       # Each axis is a list of {name: value}
+    for (name, values) in spec.get('product', {}).items():
+        axes.append([{name: v} for v in expand_axis(values)])
+    zips = spec.get('zip', [])
+    for group in ([zips] if isinstance(zips, dict) else zips):
+        columns = {name: expand_axis(values) for (name, values) in group.items()}
+        lengths = set(len(c) for c in columns.values())
+        if len(lengths) > 1:
+            raise ValueError("Zipped lists differ in length: ", {n: len(c) for (n, c) in columns.items()})
+        axes.append([dict(zip(columns, row)) for row in zip(*columns.values())])
+    points = []
+    for combination in itertools.product(*axes):
+        point = {}
+        for part in combination:
+            if set(point) & set(part):
+                raise ValueError("Parameter varied twice: ", set(point) & set(part))
+            point.update(part)
+        points.append(point)
+    return points
+
+def point_dirname(point:dict) -> str:
+    'Deck directory name of a point, from its varied parameters'
+    if not point:
+        return 'point'
+    return '_'.join('%s-%s' % (name, re.sub(r'[^\w.+-]', '', str(value))) for (name, value) in point.items())
+
+def make_core(core:str, params:dict):
+    'Returns core object, constructor arguments and attributes are picked from params'
+    if core not in SWEEP_CORES:
+        raise ValueError("Unknown core: ", core)
+    cls = getattr(msfr, core)
+    ctor_args = list(inspect.signature(cls.__init__).parameters)[1:]
+    c = cls(**{k: v for (k, v) in params.items() if k in ctor_args})
+    for (k, v) in params.items():
+        if k in ctor_args:
+            continue
+        if not hasattr(c, k):
+            raise ValueError("Unknown %s parameter: " % core, k)
+        setattr(c, k, v)
+    return c
+
+def nearest_source(point:dict, candidates:list) -> str:
+    '''Fission source file of the candidate point nearest to point, None if there is none.
+    candidates are (point, source file) pairs, only existing source files count.
+    Numeric parameters are compared relative to their range, the others have to match.'''
+    candidates = [(q, f) for (q, f) in candidates if q != point and os.path.exists(f)]
+    candidates = [(q, f) for (q, f) in candidates if set(q) == set(point) and
+                  all(q[n] == v for (n, v) in point.items() if not isinstance(v, (int, float)))]
+    if not candidates:
+        return None
+    numeric = [n for (n, v) in point.items() if isinstance(v, (int, float))]
+    scale = {}
+    for n in numeric:
+        values = [q[n] for (q, f) in candidates] + [point[n]]
+        scale[n] = (max(values) - min(values)) or 1.0
+    distance = lambda q: sum(((q[n] - point[n]) / scale[n])**2 for n in numeric)
+    return min(candidates, key=lambda c: distance(c[0]))[1]
+
+def _save_point(args:tuple) -> tuple:
+    '''Pool worker: builds the core of one point and saves its deck.
+    Returns deck file, and deck cache key and deck hash.'''
+    (core, params, deck_path) = args
+    c = make_core(core, params)
+    c.deck_path = deck_path
+    sections = c.save_deck()
+    if sections is None:
+        raise IOError("Unable to write deck of point " + deck_path)
+    return (os.path.abspath(os.path.join(c.deck_path, c.deck_name)),
+            deckcache.deck_key(sections, c.histories, c.ompcores, c.nuc_libs),
+            deckcache.text_sha1(''.join(sections)))
+
+
+class Sweep(object):
+    '''Parameter sweep, see module description for the spec'''
+    def __init__(self, spec:dict, path:str, workers:int=None, cache:deckcache.DeckCache=None,
+                 warm_start:bool=False):
+        self.spec:dict   = spec                 # Sweep spec
+        self.cache       = cache                # deckcache.DeckCache, runs identical decks once
+        self.warm_start:bool = warm_start       # Start points from sources of finished neighbours
+        self.path:str    = path                 # Sweep directory, decks go to subdirectories
+        self.workers:int = workers or os.cpu_count() # Processes writing decks, 1 writes in this process
+        self.core:str    = spec.get('core', 'MSFR')
+        self.fixed:dict  = dict(spec.get('fixed', {}))
+        self.manifest:list = []                 # Points, see generate()
+        unknown = set(spec) - {'core', 'fixed', 'product', 'zip'}
+        if unknown:
+            raise ValueError("Unknown sweep spec keys: ", unknown)
+
+    def __repr__(self):
+        return "Sweep of %s: %s, %d points" % (self.core, self.path, len(self.points()))
+
+    def points(self) -> list:
+        'Returns varied parameters of all points'
+        return sweep_points(self.spec)
+
+    def plan(self) -> list:
+        '''Returns the manifest without writing anything: list of dicts with index,
+        varied parameters, all parameters, deck directory and deck file'''
+        manifest = []
+        dirnames = {}
+        prototype = make_core(self.core, self.fixed)    # Validates the fixed part
+        ctor_args = list(inspect.signature(prototype.__init__).parameters)
+        for (i, point) in enumerate(self.points()):
+            for name in point:
+                if name not in ctor_args and not hasattr(prototype, name):
+                    raise ValueError("Unknown %s parameter: " % self.core, name)
+            params = dict(self.fixed, **point)
+            dirname = point_dirname(point)
+            if dirname in dirnames:
+                raise ValueError("Points %d and %d share deck directory: " % (dirnames[dirname], i), dirname)
+            dirnames[dirname] = i
+            deck_path = os.path.join(self.path, dirname)
+            manifest.append({'index': i, 'point': point, 'params': params, 'deck_path': deck_path,
+                             'deck_file': os.path.join(deck_path, params.get('deck_name', prototype.deck_name))})
+        return manifest
+
+    def generate(self) -> list:
+        '''Writes decks of all points, returns and saves the manifest.
+        With the deck cache, points with identical decks are collapsed: the first of them
+        in the manifest (or an earlier run) owns the deck, the rest get 'same_as' set.
+        Points that do not need to run get 'cached' set, see MSFRbase.cached_run().
+        With warm_start, see set_warm_sources().'''
+        manifest = self.plan()
+        if self.warm_start:
+            self.set_warm_sources(manifest)
+        jobs = [(self.core, p['params'], p['deck_path']) for p in manifest]
+        if self.workers > 1 and len(jobs) > 1:
+            chunksize = max(1, len(jobs) // (4 * self.workers))
+            with ProcessPoolExecutor(self.workers) as pool:
+                saved = list(pool.map(_save_point, jobs, chunksize=chunksize))
+        else:
+            saved = [_save_point(job) for job in jobs]
+        for (p, (deck_file, key, deck_sha1)) in zip(manifest, saved):
+            p['deck_file'] = deck_file
+            p['key'] = key
+            if self.cache is None:
+                continue
+            owner = self.cache.claim(key, deck_file, deck_sha1)     # In manifest order
+            finished = self.cache.is_finished(owner)
+            p['cache_owner'] = owner
+            p['same_as'] = owner['deck_file'] if owner['deck_file'] != deck_file else None
+            p['cached'] = p['same_as'] is not None or finished
+            if p['same_as'] and finished:
+                self.cache.link_results(owner, deck_file)
+        self.manifest = manifest
+        self.save_manifest()
+        return manifest
+
+    def set_warm_sources(self, manifest:list):
+        '''All points save their converged fission source. Points that have not finished
+        start from the source of the nearest finished point, with fewer inactive cycles.
+        Generate again after some points have finished to warm start the rest.
+        Points keep the source they were given in an earlier generate(), so their decks do not change.'''
+        try:
+            with open(os.path.join(self.path, 'manifest.json')) as f:
+                earlier = {p['deck_path']: p['params'].get('warm_source') for p in json.load(f)['points']}
+        except (IOError, ValueError, KeyError):
+            earlier = {}
+        sources = [(p['point'], os.path.join(p['deck_path'], os.path.basename(p['deck_file']) + '.src'))
+                   for p in manifest]
+        finished = [(q, f) for (q, f) in sources if os.path.exists(f)]
+        for (p, (q, f)) in zip(manifest, sources):
+            p['params']['save_source'] = True
+            if earlier.get(p['deck_path']) or os.path.exists(f):
+                p['params']['warm_source'] = earlier.get(p['deck_path'])
+            else:
+                p['params']['warm_source'] = nearest_source(q, finished)
+
+    def save_manifest(self, fname:str='manifest.json'):
+        'Saves the manifest with the spec into the sweep directory'
+        try:
+            os.makedirs(self.path, exist_ok = True)
+            with open(os.path.join(self.path, fname), 'w') as f:
+                json.dump({'spec': self.spec, 'points': self.manifest}, f, indent=1, default=_json_value)
+        except IOError as e:
+            print("[ERROR] Unable to write sweep manifest: ", os.path.join(self.path, fname))
+            print(e)
+
+    def cores(self):
+        '''Yields core objects of the manifest points, with deck paths set.
+        After generate() with the deck cache, run_deck() skips the cached points.'''
+        for p in (self.manifest or self.plan()):
+            c = make_core(self.core, p['params'])
+            c.deck_path   = p['deck_path']
+            c.deck_cache  = self.cache
+            c.cache_owner = p.get('cache_owner')
+            yield c
+
+    def unique(self) -> list:
+        'Manifest points that need to run'
+        return [p for p in self.manifest if not p.get('cached')]
+
+    def save_qsub_array(self, qsub_file:str=None, max_running:int=None):
+        '''Writes one TORQUE job array over the points that need to run,
+        to qsub_file, by default run_array.sh in the sweep directory. Returns the core that wrote it.'''
+        core = make_core(self.core, self.fixed)
+        core.qsub_file = qsub_file or os.path.join(self.path, 'run_array.sh')
+        core.deck_path = self.path
+        core.save_qsub_file([p['deck_path'] for p in self.unique()], max_running)
+        return core
+
+    def submit_array(self, qsub_file:str=None, max_running:int=None):
+        'Writes and submits the job array, one qsub for the whole sweep'
+        if not self.unique():
+            print("[sweep] Nothing to run in ", self.path)
+            return
+        core = self.save_qsub_array(qsub_file, max_running)
+        if core.queue == 'local':
+            raise ValueError("Job arrays need a cluster queue, use cores() and localrun for local runs")
+        core.run_deck()
+
+
+def _json_value(v):
+    'Numpy values in user specs for json'
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    raise TypeError("Not JSON serializable: ", v)
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    print("This is a parameter sweep module.")
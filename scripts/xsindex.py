@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+#
+# GNU/GPL
+
+'''
+Index of Serpent nuclear data libraries, and a deck checker built on it.
+
+NuclideIndex reads the cross section directory (acelib, Serpent xsdata or MCNP xsdir format)
+and the ENDF decay library (declib) that a deck sets. The index is saved as json in INDEX_DIR,
+keyed by the library files and their modification times, so reading it again is fast.
+
+check_deck() finds problems that make Serpent jobs fail right at the start:
+nuclides missing in the library, library temperatures above the material temperature,
+nuclides without cross sections and without decay data, and references to undefined
+materials, mass flows and reprocessing schemes.
+
+# Example usage:
+import xsindex
+index = xsindex.get_index('/opt/JEFF-3.3/sss_jeff33.xsdir', '/opt/JEFF-3.3/jeff33.dec')
+index.has_xs(922350, '09c')
+with open('/tmp/mcfr_input') as f:
+    for problem in xsindex.check_deck(f.read(), deck_dir='/tmp'):
+        print(problem)
+'''
+
+import os
+import re
+import json
+import hashlib
+
+INDEX_DIR = os.path.expanduser('~/.cache/msfr-xsindex')    # Saved indexes
+M_OFFSET:int = 400          # Isomer offset of Serpent nuclide names, ZA + 400*I
+KT_MEV_PER_K = 8.617333e-11 # Boltzmann constant [MeV/K], MCNP xsdir temperatures are kT
+
+# Serpent cards split a deck, material options with their argument counts
+CARDS = {'mat', 'mix', 'cell', 'surf', 'set', 'det', 'ene', 'plot', 'mesh', 'dep', 'mflow', 'rep', 'rc',
+         'src', 'include', 'therm', 'pin', 'lat', 'particle', 'trans', 'div', 'pbed', 'ures', 'datamesh',
+         'branch', 'coef', 'wwin', 'solid', 'umsh', 'thermstoch', 'casematrix', 'nest', 'disp', 'fun'}
+MAT_OPTIONS = {'tmp': 1, 'tms': 1, 'tft': 2, 'rgb': 3, 'vol': 1, 'mass': 1, 'burn': 1, 'fix': 2, 'moder': 2}
+NO_MATERIAL = {'void', 'outside', 'fill'}
+TOKEN = re.compile(r'"[^"]*"|\S+')
+COMMENT = re.compile(r'/\*.*?\*/|%[^\n]*', re.S)
+NUCLIDE = re.compile(r'^(\d+)\.(\w+)$')
+
+
+def find_library(path:str) -> str:
+    'Library file path, relative names are looked up in $SERPENT_DATA as Serpent does'
+    if not os.path.isabs(path) and not os.path.exists(path):
+        data_dir = os.environ.get('SERPENT_DATA')
+        if data_dir is not None:
+            return os.path.join(data_dir, path)
+    return path
+
+def library_paths(text:str) -> dict:
+    'Returns {acelib, declib, nfylib: path} set in deck text'
+    return {card: path for (card, path) in re.findall(r'^\s*set\s+(acelib|declib|nfylib)\s+"([^"]+)"', text, re.M)}
+
+def read_xsdir(fname:str) -> dict:
+    '''Returns {nuclide name: [ZA, isomeric state, temperature K]} of a cross section
+    directory, Serpent xsdata (alias name type ZA I AW T bin path) or MCNP xsdir format'''
+    names = {}
+    with open(fname) as f:
+        lines = f.read().splitlines()
+    if any(line.strip().lower() == 'directory' for line in lines):    # MCNP xsdir
+        start = [i for (i, line) in enumerate(lines) if line.strip().lower() == 'directory'][0]
+        for line in lines[start + 1:]:
+            fields = line.split()
+            if len(fields) < 10 or not NUCLIDE.match(fields[0]):
+                continue
+            (z, a) = divmod(int(fields[0].split('.')[0]), 1000)     # Isomers have A + 400*I
+            names[fields[0]] = [1000*z + a % M_OFFSET, a // M_OFFSET, round(float(fields[9]) / KT_MEV_PER_K, 1)]
+        return names
+    for line in lines:                                              # Serpent xsdata
+        fields = line.split()
+        if len(fields) < 7 or fields[2] != '1':     # Continuous energy neutron data only
+            continue
+        entry = [int(fields[3]), int(fields[4]), float(fields[6])]
+        names[fields[0]] = entry
+        names[fields[1]] = entry
+    return names
+
+def endf_float(field:str) -> float:
+    'ENDF number, e.g. 9.223500+4'
+    return float(re.sub(r'(?<=[\d.])([+-])', r'e\1', field.strip()))
+
+def read_decay(fname:str) -> set:
+    'Returns ZAIs of the nuclides in an ENDF decay library'
+    zais = set()
+    (prev_mat, pending) = (None, None)
+    with open(fname) as f:
+        for line in f:
+            if len(line) < 75:
+                continue
+            mat = line[66:70]
+            if pending is not None:     # Second record of MF1 MT451: ELIS, STA, LIS, LISO, 0, NFOR
+                zais.add(10 * pending + int(endf_float(line[33:44])))
+                pending = None
+            if line[70:75] == ' 1451' and mat != prev_mat:
+                pending = int(endf_float(line[0:11]))   # ZA of the head record
+            prev_mat = mat
+    return zais
+
+
+class NuclideIndex(object):
+    '''Nuclides in a cross section directory and a decay library'''
+    def __init__(self, acelib:str, declib:str=None, names:dict=None, decay:set=None):
+        self.acelib:str  = acelib       # Cross section directory file
+        self.declib:str  = declib       # Decay library, None if not indexed
+        self.names:dict  = read_xsdir(acelib) if names is None else names   # name: [ZA, I, T]
+        if decay is None:
+            decay = read_decay(declib) if declib is not None else set()
+        self.decay:set   = decay        # ZAIs with decay data
+
+    def __repr__(self):
+        return "NuclideIndex %s: %d cross section tables, %d decay nuclides" % (self.acelib, len(self.names),
+                                                                                len(self.decay))
+
+    @staticmethod
+    def xs_name(zai:int, lib:str) -> str:
+        'Serpent cross section name of ZAI, isomers get the isomer offset'
+        return '%d.%s' % (zai // 10 + M_OFFSET * (zai % 10), lib)
+
+    def has_xs(self, zai:int, lib:str) -> bool:
+        'Whether the library has cross sections of ZAI with suffix lib'
+        return self.xs_name(zai, lib) in self.names
+
+    def has_decay(self, zai:int) -> bool:
+        'Whether the decay library has ZAI'
+        return zai in self.decay
+
+    def temperature(self, name:str) -> float:
+        'Temperature [K] of the cross section table, None if unknown'
+        entry = self.names.get(name)
+        return None if entry is None else entry[2]
+
+    def save(self, fname:str):
+        'Writes the index as json, atomically'
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp = fname + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump({'acelib': self.acelib, 'declib': self.declib, 'names': self.names,
+                       'decay': sorted(self.decay)}, f)
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname:str):
+        'Reads an index saved by save()'
+        with open(fname) as f:
+            d = json.load(f)
+        return cls(d['acelib'], d['declib'], d['names'], set(d['decay']))
+
+
+_INDEXES = {}   # Index file name: NuclideIndex
+
+def get_index(acelib:str, declib:str=None) -> NuclideIndex:
+    '''Index of the libraries, from memory, INDEX_DIR, or read and saved there.
+    Raises IOError if a library file is missing.'''
+    files = [os.path.abspath(find_library(p)) for p in [acelib, declib] if p is not None]
+    stamp = ['%s %s %s' % (p, os.path.getmtime(p), os.path.getsize(p)) for p in files]
+    fname = os.path.join(INDEX_DIR, hashlib.sha1('\n'.join(stamp).encode()).hexdigest()[:16] + '.json')
+    if fname not in _INDEXES:
+        try:
+            _INDEXES[fname] = NuclideIndex.load(fname)
+        except (IOError, ValueError, KeyError):
+            _INDEXES[fname] = NuclideIndex(files[0], files[1] if declib is not None else None)
+            try:
+                _INDEXES[fname].save(fname)
+            except IOError as e:
+                print("[WARNING] Unable to save nuclide index ", fname, e)
+    return _INDEXES[fname]
+
+def expand_includes(text:str, deck_dir:str='.', problems:list=None) -> str:
+    'Deck text with include cards replaced by the included files'
+    def include(m):
+        fname = m.group(1) if os.path.isabs(m.group(1)) else os.path.join(deck_dir, m.group(1))
+        try:
+            with open(fname) as f:
+                return expand_includes(f.read(), os.path.dirname(fname), problems)
+        except IOError:
+            if problems is not None:
+                problems.append("include: file %s not found" % fname)
+            return ''
+    return re.sub(r'^\s*include\s+"([^"]+)"', include, text, flags=re.M)
+
+def deck_cards(text:str) -> list:
+    'Splits a deck without comments into cards, lists of tokens'
+    cards = []
+    for token in TOKEN.findall(COMMENT.sub(' ', text)):
+        if token in CARDS or not cards:
+            cards.append([token])
+        else:
+            cards[-1].append(token.strip('"'))
+    return cards
+
+def _is_number(token:str) -> bool:
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+def check_deck(text:str, index:NuclideIndex=None, deck_dir:str='.') -> list:
+    '''Returns the problems found in a Serpent deck, an empty list if none.
+    Without index, the libraries the deck sets are indexed if they are on this machine,
+    otherwise a warning is printed and only material references are checked.'''
+    problems = []
+    text = expand_includes(text, deck_dir, problems)
+    if index is None:
+        paths = library_paths(text)
+        if 'acelib' in paths:
+            try:
+                index = get_index(paths['acelib'], paths.get('declib'))
+            except IOError as e:
+                print("[WARNING] Libraries not indexed, checking material references only: ", e)
+    cards = deck_cards(text)
+    defined = {'mat': set(), 'mflow': set(), 'rep': set()}
+    used = []           # (kind, name, card)
+    for card in cards:
+        (kind, args) = (card[0], card[1:])
+        if kind in ('mat', 'mix', 'mflow', 'rep') and args:
+            defined['mat' if kind == 'mix' else kind].add(args[0])
+        if kind == 'mat' and len(args) >= 2:
+            problems += _check_material(args, index)
+        elif kind == 'mix':
+            used += [('mat', m, 'mix ' + args[0]) for m in args[1::2]]
+        elif kind == 'cell' and len(args) >= 3 and args[2] not in NO_MATERIAL:
+            used.append(('mat', args[2], 'cell ' + args[0]))
+        elif kind == 'set' and args[:1] == ['mvol']:
+            used += [('mat', m, 'set mvol') for m in args[1::3]]
+        elif kind in ('det', 'src'):
+            key = 'dm' if kind == 'det' else 'sg'
+            used += [('mat', args[i + 1], kind + ' ' + args[0]) for (i, a) in enumerate(args[:-1]) if a == key]
+        elif kind == 'rc' and len(args) >= 3:
+            used += [('mat', args[0], 'rc'), ('mat', args[1], 'rc'), ('mflow', args[2], 'rc')]
+        elif kind == 'dep':
+            used += [('rep', args[i + 1], 'dep') for (i, a) in enumerate(args[:-1]) if a == 'pro']
+    for (kind, name, where) in used:
+        if name not in defined[kind]:
+            problems.append("%s: %s %s is not defined" % (where, 'material' if kind == 'mat' else kind, name))
+    return problems
+
+def _check_material(args:list, index:NuclideIndex) -> list:
+    'Checks the nuclides of a mat card'
+    (name, i, tmp, problems) = (args[0], 2, None, [])
+    while i < len(args) and args[i] in MAT_OPTIONS:
+        if args[i] == 'tmp' and i + 1 < len(args) and _is_number(args[i + 1]):
+            tmp = float(args[i + 1])
+        i += 1 + MAT_OPTIONS[args[i]]
+    nuclides = args[i:]
+    if len(nuclides) % 2:
+        problems.append("mat %s: odd number of nuclide entries" % name)
+    for (nuc, frac) in zip(nuclides[0::2], nuclides[1::2]):
+        if not _is_number(frac):
+            problems.append("mat %s: bad fraction %s of %s" % (name, frac, nuc))
+        if index is None:
+            continue
+        m = NUCLIDE.match(nuc)
+        if m is not None:
+            lib_T = index.temperature(nuc)
+            if lib_T is None:
+                problems.append("mat %s: nuclide %s not in %s" % (name, nuc, index.acelib))
+            elif tmp is not None and lib_T > tmp + 1.0:
+                problems.append("mat %s: library temperature %g K of %s above material temperature %g K" %
+                                (name, lib_T, nuc, tmp))
+        elif nuc.isdigit():     # ZAI, decay data only
+            if index.declib is not None and not index.has_decay(int(nuc)):
+                problems.append("mat %s: nuclide %s has no decay data in %s" % (name, nuc, index.declib))
+        else:
+            problems.append("mat %s: bad nuclide %s" % (name, nuc))
+    return problems
+
+def check_read_decay() -> bool:
+    'Checks read_decay on synthetic MF1 MT451 records of Ag-110 and its isomer Ag-110m'
+    import tempfile
+    def record(fields:list, mat:int) -> str:
+        return ''.join('%11s' % f for f in fields) + '%4d 1451    1\n' % mat
+    text = (record(['4.711000+4', '1.089090+2', 0, 0, 0, 6], 4725) + record(['0.000000+0', '0.000000+0', 0, 0, 0, 6], 4725) +
+            record(['4.711000+4', '1.089090+2', 0, 0, 0, 6], 4726) + record(['1.175950+5', '0.000000+0', 1, 1, 0, 6], 4726))
+    with tempfile.NamedTemporaryFile('w', suffix='.dec', delete=False) as f:
+        f.write(text)
+    try:
+        zais = read_decay(f.name)
+    finally:
+        os.remove(f.name)
+    ok = zais == {471100, 471101}
+    print("read_decay ground and isomer states: ", "OK" if ok else "FAILED %s" % sorted(zais))
+    return ok
+
+
+# This executes if someone tries to run the module
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2:       # No decks to check, check the readers
+        sys.exit(0 if check_read_decay() else 1)
+    for fname in sys.argv[1:]:
+        with open(fname) as f:
+            for problem in check_deck(f.read(), deck_dir=os.path.dirname(os.path.abspath(fname))):
+                print(fname + ': ' + problem)
@@ -21,7 +21,7 @@ for r in radia:
     mycore.queue     = 'fill'
     mycore.ompcores  = 64
     mycore.histories = 50000
-    mycore.s.set_chlorine_37Cl_fraction(0.24)
+    mycore.cl37      = 0.24
     mycore.qsub_file = my_path + "/run.sh"
     if r == radia[0]:
         mycore.save_qsub_file()
@@ -0,0 +1,53 @@
+'''
+Import time regression tests: the deck generation modules import within their budget,
+and the heavy modules (scipy, serpentTools, matplotlib) are not loaded until used.
+'''
+
+import os
+import sys
+import subprocess
+import pytest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.insert(0, SCRIPTS)
+
+import benchmarks
+
+HEAVY_MODULES = ['scipy', 'serpentTools', 'matplotlib']
+
+
+def loaded_modules(code:str) -> set:
+    'Heavy modules loaded after running code in a fresh interpreter'
+    check = code + "\nimport sys; print(' '.join(m for m in %r if m in sys.modules))" % HEAVY_MODULES
+    out = subprocess.run([sys.executable, '-c', check], cwd=SCRIPTS, check=True,
+                         capture_output=True, text=True).stdout
+    return set(out.split())
+
+
+@pytest.mark.parametrize('module', sorted(benchmarks.IMPORT_TIME_BUDGET))
+def test_import_budget(module):
+    t = benchmarks.measure_import_time(module)
+    assert t <= benchmarks.IMPORT_TIME_BUDGET[module], \
+        "import %s took %.3f s, budget %.2f s" % (module, t, benchmarks.IMPORT_TIME_BUDGET[module])
+
+@pytest.mark.parametrize('module', ['salts', 'msfr', 'agmsfr'])
+def test_heavy_modules_deferred(module):
+    assert loaded_modules('import ' + module) == set()
+
+def test_deck_generation_stays_light():
+    code = '''import msfr
+core = msfr.MSFR(122, 522, 0.1975, "66.66%NaCl+33.34%UCl3")
+core.deplete = 10
+core.deck_sections()'''
+    assert loaded_modules(code) == set()
+
+def test_lazy_module_imports_on_first_use():
+    code = '''from lazyimport import LazyModule
+import sys
+m = LazyModule('colorsys')
+before = 'colorsys' in sys.modules
+m.rgb_to_hsv(0.1, 0.2, 0.3)
+print(before, 'colorsys' in sys.modules)'''
+    out = subprocess.run([sys.executable, '-c', code], cwd=SCRIPTS, check=True,
+                         capture_output=True, text=True).stdout.split()
+    assert out == ['False', 'True']